@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Index, Column, Integer, String, DateTime
 from base import Base
 import datetime
 
@@ -7,6 +7,11 @@ class AnomalyStats(Base):
     """ Anomaly """
 
     __tablename__ = "anomaly_stats"
+    __table_args__ = (
+        Index("ix_anomaly_stats_anomaly_type_date_created", "anomaly_type", "date_created"),
+        Index("ix_anomaly_stats_device_id_date_created", "device_id", "date_created"),
+        Index("ix_anomaly_stats_date_created", "date_created"),
+    )
 
     id = Column(Integer, primary_key=True)
     device_id = Column(String(250), nullable=False)
@@ -34,5 +39,6 @@ class AnomalyStats(Base):
         dict['event_type'] = self.event_type
         dict['anomaly_type'] = self.anomaly_type
         dict['description'] = self.description
+        dict['date_created'] = self.date_created
 
         return dict
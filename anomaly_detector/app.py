@@ -1,18 +1,20 @@
 import connexion
-from connexion import NoContent
-from sqlalchemy import create_engine, func
+from sqlalchemy import create_engine, func, insert, select
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import text
 from base import Base
 from anomaly_stats import AnomalyStats
+from sqlite_pipeline import configure_sqlite, process_batches
+from rules import compile_rules, evaluate_rules
+from device_state import DeviceStateStore
+from event_stream import Broadcaster, EventStreamMiddleware
+from metrics import RequestMetricsMiddleware, ConsumerLag, DB_COMMIT_SECONDS, DB_QUERY_SECONDS
 import datetime
 import yaml
 import logging
 import logging.config
-import json
-from pykafka import KafkaClient
-from pykafka.common import OffsetType
-from threading import Thread
+import message_bus
+from contextlib import asynccontextmanager
+from threading import Thread, Lock
 import time
 import os
 from connexion.middleware import MiddlewarePosition
@@ -42,29 +44,106 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
-logger.info(f"Low SoC Threshold: {app_config['low_soc_threshold']}\n High Temp Threshold: {app_config['high_temp_threshold']}")
+# Compiled once, every batch of readings is checked against all of them
+RULES = compile_rules(app_config['rules'], app_config['device_state']['fields'])
+logger.info("Anomaly rules: %s", ", ".join(rule.name for rule in RULES))
+
+# Rolling per-device statistics, shared by the consumer threads through device_state_lock and restored
+# by run_background. Each device's readings come from one partition, so one consumer, in order
+DEVICE_STATE = DeviceStateStore(app_config['device_state']['fields'],
+                                app_config['device_state']['alpha'],
+                                app_config['device_state']['warmup'],
+                                app_config['device_state']['capacity'])
+device_state_lock = Lock()
+next_state_checkpoint = time.time() + app_config['device_state']['checkpoint_sec']
 
 # Create the database connection
 DB_ENGINE = create_engine(f"sqlite:///{app_config['datastore']['filename']}")
-Base.metadata.create_all(DB_ENGINE)
+configure_sqlite(DB_ENGINE, app_config['sqlite'])
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
 
-def get_anomaly_stats():
+def create_tables():
+    """ Creates the tables that do not exist yet
+
+    server.py calls it once before it starts the workers and the background process, which would
+    otherwise race to create them in a new database file.
+    """
+    Base.metadata.create_all(DB_ENGINE)
+
+
+# Summaries computed since the consumer last stored anomalies, keyed by the query's filters
+summary_cache = {}
+summary_cache_generation = 0
+summary_cache_lock = Lock()
+
+# Pushes the unfiltered summary to the dashboard's /anomaly_stats/stream subscribers after every insert
+anomaly_stats_stream = Broadcaster()
+
+
+def invalidate_summary_cache():
+    """ Drops every cached summary, called by the consumer after it stores new anomalies """
+    global summary_cache_generation
+
+    with summary_cache_lock:
+        summary_cache.clear()
+        summary_cache_generation += 1
+
+
+def publish_anomaly_stats():
+    """ Computes the unfiltered summary once and pushes it to every stream subscriber """
+    results, status = get_anomaly_stats()
+    if status == 200:
+        anomaly_stats_stream.publish(results)
+
+
+def anomaly_filters(anomaly_type=None, device_id=None, start_timestamp=None, end_timestamp=None):
+    """ WHERE clauses of the optional anomaly query filters, raises ValueError for a malformed timestamp """
+    filters = []
+    if anomaly_type is not None:
+        filters.append(AnomalyStats.anomaly_type == anomaly_type)
+    if device_id is not None:
+        filters.append(AnomalyStats.device_id == device_id)
+    if start_timestamp is not None:
+        filters.append(AnomalyStats.date_created >= datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S"))
+    if end_timestamp is not None:
+        filters.append(AnomalyStats.date_created < datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S"))
+
+    return filters
+
+
+def get_anomaly_stats(anomaly_type=None, device_id=None, start_timestamp=None, end_timestamp=None):
+    key = (anomaly_type, device_id, start_timestamp, end_timestamp)
+    with summary_cache_lock:
+        results = summary_cache.get(key)
+        generation = summary_cache_generation
+    if results is not None:
+        logger.debug("Anomaly statistics served from cache")
+        return results, 200
+
     session = DB_SESSION()
 
     try:
-        latest_row = session.query(AnomalyStats).order_by(AnomalyStats.date_created.desc()).first()
+        filters = anomaly_filters(anomaly_type, device_id, start_timestamp, end_timestamp)
+    except ValueError as e:
+        session.close()
+        logger.error(f"Invalid anomaly statistics filter: {e}")
+        return {"message": "Invalid timestamp, expected YYYY-MM-DDTHH:MM:SS"}, 400
+
+    try:
+        with DB_QUERY_SECONDS.labels("latest_anomaly").time():
+            latest_row = session.query(AnomalyStats).filter(*filters).order_by(AnomalyStats.date_created.desc()).first()
         if not latest_row:
             logger.error("No anomalies found")
             return {"message": "Anomalies do not exist"}, 404
 
         # Retrieve counts for each anomaly type
-        stats = session.query(
-            AnomalyStats.anomaly_type,
-            func.count(AnomalyStats.anomaly_type).label('count')
-        ).group_by(AnomalyStats.anomaly_type).all()
+        with DB_QUERY_SECONDS.labels("anomaly_counts").time():
+            stats = session.query(
+                AnomalyStats.anomaly_type,
+                func.count(AnomalyStats.anomaly_type).label('count')
+            ).filter(*filters).group_by(AnomalyStats.anomaly_type).all()
 
         # Construct a dictionary of anomaly types and their counts
         anomaly_counts = {anomaly_type: count for anomaly_type, count in stats}
@@ -75,9 +154,6 @@ def get_anomaly_stats():
             "most_recent_datetime": latest_row.date_created.strftime('%Y-%m-%d %H:%M:%S'),
         }
 
-        logger.info("Query for anomaly statistics successful")
-        return results, 200
-
     except Exception as e:
         logger.error(f"Error retrieving anomaly statistics: {e}")
         return {"message": "Invalid Anomaly Type"}, 400
@@ -85,61 +161,128 @@ def get_anomaly_stats():
     finally:
         session.close()
 
+    # Not cached if the consumer stored anomalies while this summary was being computed
+    with summary_cache_lock:
+        if generation == summary_cache_generation and len(summary_cache) < app_config['summary_cache']['max_entries']:
+            summary_cache[key] = results
+
+    logger.info("Query for anomaly statistics successful")
+    return results, 200
 
-def report_anomaly(body, msg_type, anomaly_type, anomaly_message):
-    """ Receives a power usage anomaly reading """
+
+def get_device_anomalies(device_id, anomaly_type=None, start_timestamp=None, end_timestamp=None, limit=100):
+    """ Returns the most recent anomalies of a device, newest first """
+    try:
+        filters = anomaly_filters(anomaly_type, device_id, start_timestamp, end_timestamp)
+    except ValueError as e:
+        logger.error(f"Invalid device anomalies filter: {e}")
+        return {"message": "Invalid timestamp, expected YYYY-MM-DDTHH:MM:SS"}, 400
 
     session = DB_SESSION()
+    with DB_QUERY_SECONDS.labels("device_anomalies").time():
+        anomalies = session.scalars(select(AnomalyStats).where(*filters)
+                                    .order_by(AnomalyStats.date_created.desc())
+                                    .limit(limit))
+        results = [anomaly.to_dict() for anomaly in anomalies]
+    session.close()
 
-    anomaly_stats_instance = AnomalyStats(
-        body['device_id'],
-        body['trace_id'],
-        msg_type,
-        anomaly_type,
-        anomaly_message
-    )
+    logger.info("Query for anomalies of device %s returns %d results", device_id, len(results))
 
-    session.add(anomaly_stats_instance)
+    return results, 200
 
-    logger.debug(f"Stored anomaly event power_usage request with a trace_id of {body['trace_id']}")
 
-    session.commit()
-    session.close()
+def anomaly_row(body, msg_type, anomaly_type, anomaly_message):
+    """ Builds the anomaly_stats row of an anomaly found in a reading """
+    return {
+        "device_id": body['device_id'],
+        "trace_id": body['trace_id'],
+        "event_type": msg_type,
+        "anomaly_type": anomaly_type,
+        "description": anomaly_message,
+        "date_created": datetime.datetime.now()
+    }
+
+
+def anomaly_rows(messages):
+    """ Evaluates the rules on a batch of readings, returns the rows of the anomalies found
+
+    Folds the readings into the device state, so it is called once per batch, outside the
+    retries of store_anomaly_rows.
+    """
+    global next_state_checkpoint
 
-    return NoContent, 201
+    with device_state_lock:
+        anomalies = evaluate_rules(RULES, DEVICE_STATE, messages)
 
+        # A restart loses at most checkpoint_sec of state updates instead of the whole warm-up
+        if time.time() >= next_state_checkpoint:
+            try:
+                DEVICE_STATE.checkpoint(app_config['device_state']['checkpoint_file'])
+            except Exception as e:
+                logger.error("Failed to checkpoint device state: %s", e)
+            next_state_checkpoint = time.time() + app_config['device_state']['checkpoint_sec']
 
-def process_messages():
-    # Create a consume on a consumer group, that only reads new messages
-    # (uncommitted messages) when the service re-starts (i.e., it doesn't read all the old messages from the history in the message queue).
-    consumer = topic.get_simple_consumer(consumer_group=b'event_group', reset_offset_on_start=False, auto_offset_reset=OffsetType.LATEST)
+    logger.debug("Found %d anomalies in %d readings", len(anomalies), len(messages))
+    return [anomaly_row(payload, event_type, anomaly_type, anomaly_message)
+            for payload, event_type, anomaly_type, anomaly_message in anomalies]
 
-    # This is blocking - it will wait for a new message
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        # logger.info("Message: %s" % msg)
 
-        payload = msg['payload']
-        logger.info("Payload: %s" % payload)
+def store_anomaly_rows(rows):
+    """ Stores the anomalies found in a batch of readings with one multi-row insert """
+    with DB_COMMIT_SECONDS.labels("anomalies").time(), DB_ENGINE.begin() as connection:
+        connection.execute(insert(AnomalyStats), rows)
+    invalidate_summary_cache()
+    publish_anomaly_stats()
 
-        if msg["type"] == "power_usage":
-            if payload['power_data']['state_of_charge_%'] < app_config['low_soc_threshold']:
-                anomaly_type = "Low SoC"
-                anomaly_message = f"SoC of {payload['power_data']['state_of_charge_%']}% is below the set safe threshold of {app_config['low_soc_threshold']}%"
-                
-                report_anomaly(payload, msg["type"], anomaly_type, anomaly_message)
-            if payload['power_data']['temperature_C'] > app_config['high_temp_threshold']:
-                anomaly_type = "High Temp"
-                anomaly_message = f"Temperature of {payload['power_data']['temperature_C']}C is above the set safe threshold of {app_config['high_temp_threshold']}C"
-                
-                report_anomaly(payload, msg["type"], anomaly_type, anomaly_message)
-            
-        # Commit the new message as being read
-        consumer.commit_offsets()
 
+def refresh_anomaly_stats():
+    """ Drops the cached summaries when the background process stores new anomalies
+
+    Checks the latest anomaly id every stream.poll_sec, so every HTTP worker of server.py
+    keeps its summary cache and stream in step with the consumer.
+    """
+    last_id = None
+    while True:
+        try:
+            session = DB_SESSION()
+            latest_id = session.scalar(select(func.max(AnomalyStats.id)))
+            session.close()
+
+            if latest_id is not None and latest_id != last_id:
+                invalidate_summary_cache()
+                publish_anomaly_stats()
+                last_id = latest_id
+        except Exception as e:
+            logger.error(f"Exception while refreshing anomaly statistics: {e}")
 
-app = connexion.FlaskApp(__name__, specification_dir='')
+        time.sleep(app_config['stream']['poll_sec'])
+
+
+def process_messages(bus):
+    # Create consumers on a consumer group, that only read new messages
+    # (uncommitted messages) when the service re-starts (i.e., they don't read all the old messages from the history in the message queue).
+    # The group is balanced and its own: storage's consumers would otherwise share the partitions
+    # out with these ones, each of them then seeing only some of the readings
+    consumers = [bus.consumer(app_config['events']['topic'], group="anomaly_group", offset_reset="latest",
+                              timeout_ms=app_config['consumer']['batch_timeout_ms'], balanced=True)
+                 for _ in range(app_config['consumer']['workers'])]
+    lag = ConsumerLag(consumers, app_config['metrics']['lag_interval_sec'])
+
+    message_bus.run_consumers(consumers, lambda consumer: process_batches(
+        consumer, anomaly_rows, store_anomaly_rows, app_config['consumer'],
+        app_config['max_retries'], app_config['sleep_time'], lag))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """ Starts following the anomalies stored by the background process when a worker starts """
+    t1 = Thread(target=refresh_anomaly_stats)
+    t1.daemon = True
+    t1.start()
+    yield
+
+
+app = connexion.FlaskApp(__name__, specification_dir='', lifespan=lifespan)
 app.add_api("openapi.yaml", base_path="/anomaly_detector", strict_validation=True, validate_responses=True)
 
 app.add_middleware(
@@ -150,28 +293,35 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    EventStreamMiddleware,
+    position=MiddlewarePosition.BEFORE_SWAGGER,
+    path="/anomaly_detector/anomaly_stats/stream",
+    broadcaster=anomaly_stats_stream,
+    keepalive_sec=app_config['stream']['keepalive_sec'],
+)
+# Inside the stream middleware, so the open streams are not timed as requests
+app.add_middleware(RequestMetricsMiddleware, position=MiddlewarePosition.BEFORE_SWAGGER)
 
-if __name__ == "__main__":
-    """ Process event messages """
-    hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
 
-    retry_count = 0
+def run_background():
+    """ Connects to the message bus and checks readings for anomalies, once however many HTTP workers serve the API """
+    bus = message_bus.connect(app_config['events'], app_config['max_retries'], app_config['sleep_time'])
 
-    while (retry_count < app_config['max_retries']):
-        logger.info("Attempting to connect to Kafka. Attempt #: %s", retry_count + 1)
-        try:
-            client = KafkaClient(hosts=hostname)
-            topic = client.topics[str.encode(app_config["events"]["topic"])]
-            logger.info("Successfully connected to Kafka on attempt #: %s", retry_count + 1)
-            break
-        except Exception as e:
-            logger.error("Failed to connect to Kafka on attempt #:%s, error: %s", retry_count + 1, e)
-            time.sleep(app_config['sleep_time'])
-            retry_count += 1
-    else:
-        logger.error("Exceeded maximum number of retries (%s) for Kafka connection", app_config['max_retries'])
+    DEVICE_STATE.restore(app_config['device_state']['checkpoint_file'])
+    try:
+        process_messages(bus)
+    finally:
+        # Keeps the updates since the last periodic checkpoint when the process is stopped
+        with device_state_lock:
+            DEVICE_STATE.checkpoint(app_config['device_state']['checkpoint_file'])
+
+
+if __name__ == "__main__":
+    """ Development server, the consumer and the API share one process """
+    create_tables()
 
-    t1 = Thread(target=process_messages)
+    t1 = Thread(target=run_background)
     t1.setDaemon(True)
     t1.start()
-    app.run(host='0.0.0.0', port=8130)
+    app.run(host='0.0.0.0', port=app_config['server']['port'])
@@ -0,0 +1,27 @@
+import sqlite3
+import yaml
+
+# Adds the anomaly_stats indexes to databases that were created before they were part of create_tables.py
+with open('app_conf.yaml', 'r') as f:
+    app_config = yaml.safe_load(f.read())
+
+conn = sqlite3.connect(app_config['datastore']['filename'])
+
+c = conn.cursor()
+c.execute('''
+          CREATE INDEX IF NOT EXISTS ix_anomaly_stats_anomaly_type_date_created
+          ON anomaly_stats (anomaly_type, date_created)
+          ''')
+
+c.execute('''
+          CREATE INDEX IF NOT EXISTS ix_anomaly_stats_device_id_date_created
+          ON anomaly_stats (device_id, date_created)
+          ''')
+
+c.execute('''
+          CREATE INDEX IF NOT EXISTS ix_anomaly_stats_date_created
+          ON anomaly_stats (date_created)
+          ''')
+
+conn.commit()
+conn.close()
@@ -19,5 +19,20 @@ c.execute('''
           date_created VARCHAR(100) NOT NULL)
           ''')
 
+c.execute('''
+          CREATE INDEX ix_anomaly_stats_anomaly_type_date_created
+          ON anomaly_stats (anomaly_type, date_created)
+          ''')
+
+c.execute('''
+          CREATE INDEX ix_anomaly_stats_device_id_date_created
+          ON anomaly_stats (device_id, date_created)
+          ''')
+
+c.execute('''
+          CREATE INDEX ix_anomaly_stats_date_created
+          ON anomaly_stats (date_created)
+          ''')
+
 conn.commit()
 conn.close()
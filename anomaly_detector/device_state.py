@@ -0,0 +1,160 @@
+import logging
+import os
+import numpy as np
+
+logger = logging.getLogger('basicLogger')
+
+
+class DeviceStateStore:
+    """ Rolling statistics of each device's readings, kept in arrays indexed by a slot per device_id
+
+    For every tracked field a device has an EWMA mean and variance and its last value, plus a
+    reading count and last timestamp, so the memory per device is fixed. The last timestamp is
+    NaN until the device sends a reading with a valid one.
+    """
+
+    def __init__(self, fields, alpha, warmup, capacity):
+        """ Initializes an empty store with room for capacity devices """
+        self.fields = list(fields)
+        self.alpha = alpha
+        self.warmup = warmup
+        self.slots = {}
+        self.count = np.zeros(capacity, dtype=np.int32)
+        self.last_timestamp = np.full(capacity, np.nan)
+        self.mean = np.zeros((capacity, len(self.fields)), dtype=np.float64)
+        self.var = np.zeros((capacity, len(self.fields)), dtype=np.float64)
+        self.last_value = np.zeros((capacity, len(self.fields)), dtype=np.float64)
+
+    def slots_for(self, device_ids):
+        """ Returns the slot of each device_id, assigning slots to devices seen for the first time """
+        unique_ids, inverse = np.unique(device_ids, return_inverse=True)
+        unique_slots = np.empty(len(unique_ids), dtype=np.int64)
+        for position, device_id in enumerate(unique_ids.tolist()):
+            slot = self.slots.get(device_id)
+            if slot is None:
+                slot = len(self.slots)
+                self.slots[device_id] = slot
+            unique_slots[position] = slot
+
+        if len(self.slots) > len(self.count):
+            self.grow(max(len(self.slots), 2 * len(self.count)))
+
+        return unique_slots[inverse]
+
+    def grow(self, capacity):
+        """ Extends the arrays to hold capacity devices """
+        extra = capacity - len(self.count)
+        self.count = np.concatenate((self.count, np.zeros(extra, dtype=np.int32)))
+        self.last_timestamp = np.concatenate((self.last_timestamp, np.full(extra, np.nan)))
+        self.mean = np.concatenate((self.mean, np.zeros((extra, len(self.fields)))))
+        self.var = np.concatenate((self.var, np.zeros((extra, len(self.fields)))))
+        self.last_value = np.concatenate((self.last_value, np.zeros((extra, len(self.fields)))))
+
+    def update(self, device_ids, timestamps, columns):
+        """ Folds a batch of readings into the state of their devices
+
+        Returns the z-score against the device's EWMA, the rate of change per second since the
+        device's previous reading and the EWMA mean each reading was compared with, as
+        {"zscore": {field: array}, "rate": {...}, "mean": {...}}. They are NaN while a device
+        is warming up or when a reading is not newer than the previous one. A reading with a
+        NaN timestamp has no rate and is not the previous reading of the next one.
+        """
+        slots = self.slots_for(device_ids)
+        values = np.column_stack([columns[field] for field in self.fields])
+
+        # Readings of the same device are applied in timestamp order, one round per reading of
+        # the busiest device, so each round updates every device at most once
+        order = np.lexsort((timestamps, slots))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = slots[order][1:] != slots[order][:-1]
+        rank = np.arange(len(order)) - np.maximum.accumulate(np.where(first, np.arange(len(order)), 0))
+
+        zscores = np.full(values.shape, np.nan)
+        rates = np.full(values.shape, np.nan)
+        means = np.full(values.shape, np.nan)
+
+        for round_number in range(rank.max() + 1 if len(order) else 0):
+            events = order[rank == round_number]
+            slot = slots[events]
+            value = values[events]
+            timestamp = timestamps[events]
+            count = self.count[slot]
+            mean = self.mean[slot]
+            var = self.var[slot]
+
+            seen = count > 0
+            previous = self.last_timestamp[slot]
+            elapsed = timestamp - previous
+            # False when either timestamp is NaN
+            has_rate = elapsed > 0
+            newer = has_rate | (np.isnan(previous) & ~np.isnan(timestamp))
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                zscore = (value - mean) / np.sqrt(var)
+                rate = (value - self.last_value[slot]) / elapsed[:, None]
+            zscore[count < self.warmup] = np.nan
+            rate[~has_rate] = np.nan
+
+            zscores[events] = zscore
+            rates[events] = rate
+            means[events] = np.where(seen[:, None], mean, np.nan)
+
+            # EWMA of the mean and variance, a device's first reading starts both
+            diff = value - mean
+            increment = self.alpha * diff
+            self.mean[slot] = np.where(seen[:, None], mean + increment, value)
+            self.var[slot] = np.where(seen[:, None], (1 - self.alpha) * (var + diff * increment), 0)
+            self.count[slot] = count + 1
+
+            self.last_value[slot[newer]] = value[newer]
+            self.last_timestamp[slot[newer]] = timestamp[newer]
+
+        return {
+            "zscore": {field: zscores[:, position] for position, field in enumerate(self.fields)},
+            "rate": {field: rates[:, position] for position, field in enumerate(self.fields)},
+            "mean": {field: means[:, position] for position, field in enumerate(self.fields)}
+        }
+
+    def checkpoint(self, filename):
+        """ Writes the state of every device to filename, replacing the previous checkpoint atomically """
+        devices = len(self.slots)
+        device_ids = np.empty(devices, dtype=object)
+        for device_id, slot in self.slots.items():
+            device_ids[slot] = device_id
+
+        temp_file = filename + ".tmp"
+        with open(temp_file, 'wb') as f:
+            np.savez(f,
+                     fields=np.array(self.fields),
+                     device_ids=device_ids.astype(str),
+                     count=self.count[:devices],
+                     last_timestamp=self.last_timestamp[:devices],
+                     mean=self.mean[:devices],
+                     var=self.var[:devices],
+                     last_value=self.last_value[:devices])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, filename)
+
+        logger.debug("Checkpointed state of %d devices to %s", devices, filename)
+
+    def restore(self, filename):
+        """ Loads a checkpoint written by checkpoint() into the empty store, if it tracked the same fields """
+        if not os.path.exists(filename):
+            return
+
+        with np.load(filename, allow_pickle=False) as checkpoint:
+            if checkpoint['fields'].tolist() != self.fields:
+                logger.warning("Ignoring device state checkpoint %s of fields %s", filename, checkpoint['fields'].tolist())
+                return
+
+            device_ids = checkpoint['device_ids'].tolist()
+            self.slots = {device_id: slot for slot, device_id in enumerate(device_ids)}
+            self.grow(max(len(self.count), len(device_ids)))
+            self.count[:len(device_ids)] = checkpoint['count']
+            self.last_timestamp[:len(device_ids)] = checkpoint['last_timestamp']
+            self.mean[:len(device_ids)] = checkpoint['mean']
+            self.var[:len(device_ids)] = checkpoint['var']
+            self.last_value[:len(device_ids)] = checkpoint['last_value']
+
+        logger.info("Restored state of %d devices from %s", len(device_ids), filename)
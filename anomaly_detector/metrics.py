@@ -0,0 +1,98 @@
+import logging
+import os
+import time
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+
+logger = logging.getLogger('basicLogger')
+
+# server.py sets PROMETHEUS_MULTIPROC_DIR before starting the workers and the background
+# process, each of them then writes its samples there and /metrics adds them up
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time to serve a request, by Connexion operationId",
+                            ["operation", "method", "status"])
+KAFKA_PRODUCED = Counter("kafka_messages_produced_total", "Messages produced to Kafka", ["topic"])
+KAFKA_CONSUMED = Counter("kafka_messages_consumed_total", "Messages consumed from Kafka", ["topic"])
+KAFKA_CONSUMER_LAG = Gauge("kafka_consumer_lag_messages", "Messages in the topic not consumed yet", ["topic"],
+                           multiprocess_mode="mostrecent")
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Time to run a database query", ["query"])
+DB_COMMIT_SECONDS = Histogram("db_commit_duration_seconds", "Time to write and commit a database transaction",
+                              ["transaction"])
+BATCH_SIZE = Histogram("batch_size", "Number of items processed together", ["batch"],
+                       buckets=(1, 5, 10, 25, 50, 100, 200, 500, 1000, 2500, 5000, 10000))
+
+
+def get_metrics():
+    """ Returns every metric of the service in the Prometheus text format """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    # Served as text/plain, which Prometheus reads as version 0.0.4 of the text format
+    return generate_latest(registry).decode('utf-8'), 200
+
+
+class RequestMetricsMiddleware:
+    """ ASGI middleware timing every request, labelled with the operationId Connexion routed it to
+
+    It sits outside the routing middleware, which adds the operationId on its way in.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # The routing middleware works on a shallow copy of the scope, it only adds the
+        # operationId to a dict the copy shares with this scope
+        extensions = scope.setdefault("extensions", {})
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception as e:
+            # Routing and validation errors are raised to the exception middleware further out
+            status = getattr(e, "status_code", 500)
+            raise
+        finally:
+            operation = extensions.get("connexion_routing", {}).get("operation_id") or "unrouted"
+            REQUEST_SECONDS.labels(operation, scope["method"], str(status)).observe(time.perf_counter() - start)
+
+
+class ConsumerLag:
+    """ Samples how far the message bus consumers of a topic are behind its end, at most every interval_sec
+
+    The consumers of a balanced group each hold some of the partitions, so their lags add up.
+    """
+
+    def __init__(self, consumers, interval_sec):
+        self.consumers = consumers
+        self.topic_name = consumers[0].topic_name
+        self.interval_sec = interval_sec
+        self.next_sample = 0
+
+    def update(self):
+        """ Sets kafka_consumer_lag_messages if interval_sec has passed since the last sample """
+        if time.time() < self.next_sample:
+            return
+        self.next_sample = time.time() + self.interval_sec
+
+        try:
+            lag = sum(consumer.lag() for consumer in self.consumers)
+        except Exception as e:
+            logger.warning("Failed to sample consumer lag of %s: %s", self.topic_name, e)
+            return
+
+        KAFKA_CONSUMER_LAG.labels(self.topic_name).set(lag)
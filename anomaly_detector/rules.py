@@ -0,0 +1,228 @@
+import datetime
+import warnings
+from abc import ABC, abstractmethod
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+# Event type whose readings are folded into the per-device state, and the checks that read it
+STATE_EVENT_TYPE = "power_usage"
+STATE_CHECKS = ["rate_of_change", "zscore"]
+
+# Numeric columns decoded from each event type and where they are found in its payload
+COLUMNS = {
+    "power_usage": {
+        "power_W": ("power_data", "power_W"),
+        "energy_out_Wh": ("power_data", "energy_out_Wh"),
+        "state_of_charge_%": ("power_data", "state_of_charge_%"),
+        "temperature_C": ("power_data", "temperature_C")
+    },
+    "location": {
+        "gps_latitude": ("location_data", "gps_latitude"),
+        "gps_longitude": ("location_data", "gps_longitude")
+    }
+}
+
+
+def parse_timestamp(value):
+    """ Seconds since the epoch of an ISO 8601 timestamp, UTC when it has no offset, or NaN if it is not one """
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return np.nan
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def parse_timestamps(values):
+    """ Seconds since the epoch of each timestamp, NaN for the ones that cannot be parsed
+
+    A batch of UTC timestamps such as 2024-01-01T00:00:00.000Z is parsed in one go, any other
+    batch one timestamp at a time.
+    """
+    try:
+        with warnings.catch_warnings():
+            # NumPy only warns when it converts a timestamp with an offset
+            warnings.simplefilter("error", DeprecationWarning)
+            parsed = np.array([value.rstrip('Z') for value in values], dtype="M8[ms]")
+    except (AttributeError, TypeError, ValueError, DeprecationWarning):
+        return np.array([parse_timestamp(value) for value in values], dtype=np.float64)
+
+    seconds = parsed.astype(np.int64) / 1000
+    seconds[np.isnat(parsed)] = np.nan
+    return seconds
+
+
+def decode_batch(messages):
+    """ Splits a batch of decoded messages by event type into NumPy columns """
+    batches = {}
+    for event_type, columns in COLUMNS.items():
+        payloads = [msg['payload'] for msg in messages if msg['type'] == event_type]
+        if not payloads:
+            continue
+
+        batch = {
+            "payloads": payloads,
+            "device_id": np.array([payload['device_id'] for payload in payloads]),
+            "device_type": np.array([payload['device_type'] for payload in payloads]),
+            # Seconds since the epoch of the device's own timestamp, NaN when it cannot be parsed
+            "timestamp": parse_timestamps([payload['timestamp'] for payload in payloads])
+        }
+        for name, (group, key) in columns.items():
+            batch[name] = np.array([payload[group][key] for payload in payloads], dtype=np.float64)
+
+        batches[event_type] = batch
+
+    return batches
+
+
+class Rule(ABC):
+    """ A check applied to every event of one type, with parameters that can be overridden per device_type """
+
+    def __init__(self, config):
+        """ Compiles a rule from its app_conf.yaml entry """
+        self.name = config['name']
+        self.event_type = config['event_type']
+        self.field = config.get('field')
+        self.description = config['description']
+        self.defaults = {name: value for name, value in config.items()
+                         if isinstance(value, (int, float)) and not isinstance(value, bool)}
+        self.device_types = config.get('device_types', {})
+
+        if self.event_type not in COLUMNS:
+            raise ValueError(f"Rule {self.name}: unknown event_type {self.event_type}")
+        if self.field is not None and self.field not in COLUMNS[self.event_type]:
+            raise ValueError(f"Rule {self.name}: {self.event_type} events have no field {self.field}")
+
+    def parameter(self, batch, name):
+        """ Value of a parameter for every event of the batch, NaN where the event's device_type has none """
+        values = np.full(len(batch['device_type']), self.defaults.get(name, np.nan), dtype=np.float64)
+        for device_type, overrides in self.device_types.items():
+            if name in overrides:
+                values[batch['device_type'] == str(device_type)] = overrides[name]
+        return values
+
+    def evaluate(self, batch):
+        """ Returns the (position, description) of every event of the batch that breaks the rule """
+        flagged, values = self.check(batch)
+        positions = np.flatnonzero(flagged)
+
+        return [(position, self.description.format(**{name: column[position] for name, column in values.items()}))
+                for position in positions]
+
+    @abstractmethod
+    def check(self, batch):
+        """ Returns the mask of events breaking the rule and the columns its description is formatted with """
+
+
+class AboveRule(Rule):
+    """ Field is above a threshold """
+
+    def check(self, batch):
+        value = batch[self.field]
+        threshold = self.parameter(batch, 'threshold')
+        return value > threshold, {"value": value, "threshold": threshold}
+
+
+class BelowRule(Rule):
+    """ Field is below a threshold """
+
+    def check(self, batch):
+        value = batch[self.field]
+        threshold = self.parameter(batch, 'threshold')
+        return value < threshold, {"value": value, "threshold": threshold}
+
+
+class RangeRule(Rule):
+    """ Field is outside the [min, max] range """
+
+    def check(self, batch):
+        value = batch[self.field]
+        minimum = self.parameter(batch, 'min')
+        maximum = self.parameter(batch, 'max')
+        return (value < minimum) | (value > maximum), {"value": value, "min": minimum, "max": maximum}
+
+
+class RateOfChangeRule(Rule):
+    """ Field changes faster than max_per_sec since the device's previous reading """
+
+    def check(self, batch):
+        rate = np.abs(batch['rate'][self.field])
+        max_per_sec = self.parameter(batch, 'max_per_sec')
+        return rate > max_per_sec, {"value": batch[self.field], "rate": rate, "max_per_sec": max_per_sec}
+
+
+class ZScoreRule(Rule):
+    """ Field is more than max_zscore standard deviations from the device's own EWMA """
+
+    def check(self, batch):
+        zscore = batch['zscore'][self.field]
+        max_zscore = self.parameter(batch, 'max_zscore')
+        return np.abs(zscore) > max_zscore, {"value": batch[self.field], "zscore": zscore,
+                                             "mean": batch['mean'][self.field], "max_zscore": max_zscore}
+
+
+class GeofenceRule(Rule):
+    """ Location is further than radius_km from the (latitude, longitude) centre """
+
+    def check(self, batch):
+        latitude = np.radians(batch['gps_latitude'])
+        longitude = np.radians(batch['gps_longitude'])
+        centre_latitude = np.radians(self.parameter(batch, 'latitude'))
+        centre_longitude = np.radians(self.parameter(batch, 'longitude'))
+        radius_km = self.parameter(batch, 'radius_km')
+
+        # Haversine distance to the centre
+        a = (np.sin((latitude - centre_latitude) / 2) ** 2 +
+             np.cos(latitude) * np.cos(centre_latitude) * np.sin((longitude - centre_longitude) / 2) ** 2)
+        distance_km = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+        return distance_km > radius_km, {"distance_km": distance_km, "radius_km": radius_km}
+
+
+CHECKS = {
+    "above": AboveRule,
+    "below": BelowRule,
+    "range": RangeRule,
+    "rate_of_change": RateOfChangeRule,
+    "zscore": ZScoreRule,
+    "geofence": GeofenceRule
+}
+
+
+def compile_rules(rules_config, state_fields):
+    """ Builds the enabled rules listed in app_conf.yaml, raising ValueError for an invalid one """
+    rules = []
+    for config in rules_config:
+        if not config.get('enabled', True):
+            continue
+        if config.get('check') not in CHECKS:
+            raise ValueError(f"Rule {config.get('name')}: unknown check {config.get('check')}")
+        if config['check'] in STATE_CHECKS and (config.get('event_type') != STATE_EVENT_TYPE or
+                                                config.get('field') not in state_fields):
+            raise ValueError(f"Rule {config.get('name')}: {config['check']} needs a {STATE_EVENT_TYPE} field "
+                             f"tracked in device_state, one of {state_fields}")
+        rules.append(CHECKS[config['check']](config))
+
+    return rules
+
+
+def evaluate_rules(rules, state_store, messages):
+    """ Returns the (payload, event_type, anomaly_type, description) of every rule broken in a batch of messages """
+    batches = decode_batch(messages)
+
+    # Each reading is compared with its device's state before the reading is folded in
+    batch = batches.get(STATE_EVENT_TYPE)
+    if batch is not None:
+        batch.update(state_store.update(batch['device_id'], batch['timestamp'], batch))
+
+    anomalies = []
+    for rule in rules:
+        batch = batches.get(rule.event_type)
+        if batch is None:
+            continue
+        for position, description in rule.evaluate(batch):
+            anomalies.append((batch['payloads'][position], rule.event_type, rule.name, description))
+
+    return anomalies
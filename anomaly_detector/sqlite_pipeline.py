@@ -0,0 +1,129 @@
+import logging
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import DataError, DisconnectionError, IntegrityError, InterfaceError, OperationalError
+import wire_format
+from metrics import KAFKA_CONSUMED, BATCH_SIZE
+
+logger = logging.getLogger('basicLogger')
+
+# Rows the database rejects, a batch failing with one is stored again row by row to find it
+REJECTED_ROW_ERRORS = (IntegrityError, DataError)
+# Errors of the connection to the database, a batch is retried as it is on these, such as a locked database
+CONNECTION_ERRORS = (OperationalError, InterfaceError, DisconnectionError)
+
+
+def configure_sqlite(engine, pragmas):
+    """ Runs PRAGMA name=value for each of pragmas on every connection the engine opens
+
+    journal_mode=WAL lets the Flask thread read while the consumer thread writes, and is
+    kept in the database file once set.
+    """
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def consume_batch(consumer, batch_size, batch_timeout_sec):
+    """ Waits for a message, then gathers up to batch_size messages or until batch_timeout_sec has passed """
+    messages = []
+    deadline = None
+
+    while len(messages) < batch_size:
+        if deadline is None:
+            # Blocks for up to consumer_timeout_ms while the topic is idle
+            msg = consumer.consume(block=True)
+        else:
+            msg = consumer.consume(block=False)
+
+        if msg is not None:
+            try:
+                messages.append(wire_format.decode(msg.value))
+            except ValueError as e:
+                logger.error("Skipping message that cannot be decoded at offset %d of partition %d: %s",
+                             msg.offset, msg.partition_id, e)
+            if deadline is None:
+                deadline = time.time() + batch_timeout_sec
+        elif deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 0.01))
+
+    return messages
+
+
+def batch_rows(to_rows, messages):
+    """ Maps a batch of messages with to_rows, or one message at a time to skip the ones it cannot map """
+    try:
+        return to_rows(messages)
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning("Batch of %d messages cannot be mapped to rows, mapping them one by one: %s", len(messages), e)
+
+    rows = []
+    for msg in messages:
+        try:
+            rows.extend(to_rows([msg]))
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Skipping message that cannot be stored, error: %s: %s", e, msg)
+    return rows
+
+
+def store_rows(store_batch, rows, max_retries, sleep_time):
+    """ Stores rows in one transaction with store_batch, retrying while the database cannot be reached
+
+    When the database rejects the batch, its rows are stored one per transaction so only the
+    rejected ones are skipped. Raises the connection error after max_retries attempts, so the
+    consumer stops before committing offsets past rows that were not stored.
+    """
+    for attempt in range(max_retries):
+        try:
+            store_batch(rows)
+            return
+        except REJECTED_ROW_ERRORS as e:
+            if len(rows) == 1:
+                logger.error("Skipping row rejected by the database: %s, error: %s", rows[0], e)
+                return
+            logger.warning("Batch of %d rows rejected by the database, storing them one by one: %s", len(rows), e)
+            for row in rows:
+                store_rows(store_batch, [row], max_retries, sleep_time)
+            return
+        except CONNECTION_ERRORS as e:
+            logger.error("Failed to store batch of %d rows on attempt #%s, error: %s", len(rows), attempt + 1, e)
+            error = e
+            time.sleep(sleep_time)
+
+    logger.error("Could not store batch of %d rows after %s attempts, stopping before its offsets are committed",
+                 len(rows), max_retries)
+    raise error
+
+
+def process_batches(consumer, to_rows, store_batch, consumer_config, max_retries, sleep_time, lag):
+    """ Stores consumed messages a batch per transaction, committing the offsets once each batch is stored
+
+    to_rows maps a list of messages to the rows store_batch stores, it is called once per batch,
+    outside the retries of store_batch. lag is the metrics.ConsumerLag of the consumer, or of
+    every consumer of the group in this process.
+    """
+    batch_size = consumer_config['batch_size']
+    batch_timeout_sec = consumer_config['batch_timeout_ms'] / 1000
+    consumed = KAFKA_CONSUMED.labels(consumer.topic_name)
+
+    while True:
+        messages = consume_batch(consumer, batch_size, batch_timeout_sec)
+        consumed.inc(len(messages))
+        BATCH_SIZE.labels("consumed").observe(len(messages))
+        lag.update()
+
+        # The offsets are only committed once the batch is stored, store_rows raises otherwise
+        rows = batch_rows(to_rows, messages)
+        if rows:
+            store_rows(store_batch, rows, max_retries, sleep_time)
+
+        logger.info("Stored batch of %d messages", len(messages))
+
+        # Commit the batch as being read
+        consumer.commit()
@@ -0,0 +1,69 @@
+import numpy as np
+
+from device_state import DeviceStateStore
+
+FIELDS = ["power_W", "temperature_C"]
+
+
+def fold(store, device_ids, timestamps, power, temperature):
+    """ Folds one batch of readings into store """
+    return store.update(np.array(device_ids), np.array(timestamps, dtype=np.float64),
+                        {"power_W": np.array(power, dtype=np.float64),
+                         "temperature_C": np.array(temperature, dtype=np.float64)})
+
+
+def test_checkpoint_restores_every_device(tmp_path):
+    filename = str(tmp_path / "device_state.npz")
+    store = DeviceStateStore(FIELDS, alpha=0.5, warmup=1, capacity=4)
+    fold(store, ["a", "b", "a"], [1, 1, 2], [100, 200, 110], [20, 30, 21])
+    store.checkpoint(filename)
+
+    restored = DeviceStateStore(FIELDS, alpha=0.5, warmup=1, capacity=4)
+    restored.restore(filename)
+
+    assert restored.slots == store.slots
+    for name in ["count", "last_timestamp", "mean", "var", "last_value"]:
+        np.testing.assert_array_equal(getattr(restored, name)[:2], getattr(store, name)[:2])
+
+    # The next reading is compared with the restored state, as it would have been without the restart
+    expected = fold(store, ["a"], [3], [120], [23])
+    actual = fold(restored, ["a"], [3], [120], [23])
+    for kind in ["zscore", "rate", "mean"]:
+        for field in FIELDS:
+            np.testing.assert_array_equal(actual[kind][field], expected[kind][field])
+
+
+def test_restore_ignores_checkpoint_of_other_fields(tmp_path):
+    filename = str(tmp_path / "device_state.npz")
+    store = DeviceStateStore(FIELDS, alpha=0.5, warmup=1, capacity=4)
+    fold(store, ["a"], [1], [100], [20])
+    store.checkpoint(filename)
+
+    restored = DeviceStateStore(["power_W"], alpha=0.5, warmup=1, capacity=4)
+    restored.restore(filename)
+
+    assert restored.slots == {}
+
+
+def test_restore_without_checkpoint_keeps_store_empty(tmp_path):
+    store = DeviceStateStore(FIELDS, alpha=0.5, warmup=1, capacity=4)
+    store.restore(str(tmp_path / "missing.npz"))
+
+    assert store.slots == {}
+
+
+def test_store_grows_past_capacity_keeping_state():
+    store = DeviceStateStore(FIELDS, alpha=0.5, warmup=1, capacity=2)
+    fold(store, ["a", "b"], [1, 1], [100, 200], [20, 30])
+
+    device_ids = [f"device-{number}" for number in range(5)]
+    fold(store, device_ids, [1] * 5, [10] * 5, [10] * 5)
+
+    assert len(store.slots) == 7
+    assert len(store.count) >= 7
+    assert all(len(getattr(store, name)) == len(store.count) for name in ["last_timestamp", "mean", "var", "last_value"])
+
+    # The devices seen before the arrays grew still have their state
+    result = fold(store, ["a", "b"], [2, 2], [101, 202], [20, 30])
+    np.testing.assert_array_equal(result["mean"]["power_W"], [100, 200])
+    np.testing.assert_array_equal(result["rate"]["power_W"], [1, 2])
@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import yaml
+
+from device_state import DeviceStateStore
+from rules import compile_rules, decode_batch, evaluate_rules
+
+RULES_CONFIG = [
+    {"name": "High Temp", "event_type": "power_usage", "check": "above", "field": "temperature_C",
+     "threshold": 45, "description": "Temperature of {value:g}C is above {threshold:g}C"},
+    {"name": "Rapid Temp Change", "event_type": "power_usage", "check": "rate_of_change",
+     "field": "temperature_C", "max_per_sec": 0.5, "description": "Temperature changed by {rate:.2f}C/s"}
+]
+
+
+def reading(timestamp, temperature, device_id="device-1"):
+    """ A power_usage event message as the consumer decodes it """
+    return {
+        "type": "power_usage",
+        "datetime": "2024-01-01T00:00:00",
+        "payload": {
+            "device_id": device_id,
+            "device_type": "10k",
+            "timestamp": timestamp,
+            "power_data": {"power_W": 1000, "energy_out_Wh": 10, "state_of_charge_%": 50,
+                           "temperature_C": temperature},
+            "trace_id": "trace"
+        }
+    }
+
+
+def test_decode_batch_parses_utc_timestamps():
+    batch = decode_batch([reading("2024-01-01T00:00:00.000Z", 20), reading("2024-01-01T00:00:01.500Z", 20)])
+
+    np.testing.assert_array_equal(batch["power_usage"]["timestamp"], [1704067200.0, 1704067201.5])
+
+
+def test_decode_batch_maps_malformed_timestamps_to_nan():
+    batch = decode_batch([reading("2024-01-01T00:00:00.000Z", 20),
+                          reading("garbage", 20),
+                          reading("2024-01-01T01:00:00+01:00", 20),
+                          reading(None, 20)])
+
+    timestamps = batch["power_usage"]["timestamp"]
+    assert timestamps[0] == 1704067200.0
+    assert np.isnan(timestamps[1])
+    assert timestamps[2] == 1704067200.0
+    assert np.isnan(timestamps[3])
+
+
+def test_malformed_timestamp_only_skips_rate_rule():
+    rules = compile_rules(RULES_CONFIG, ["temperature_C"])
+    state = DeviceStateStore(["temperature_C"], alpha=0.1, warmup=1, capacity=4)
+
+    evaluate_rules(rules, state, [reading("2024-01-01T00:00:00Z", 20)])
+    anomalies = evaluate_rules(rules, state, [reading("garbage", 50)])
+    assert [anomaly_type for _, _, anomaly_type, _ in anomalies] == ["High Temp"]
+
+    # The rate is measured from the last reading with a valid timestamp
+    anomalies = evaluate_rules(rules, state, [reading("2024-01-01T00:00:10Z", 30)])
+    assert [anomaly_type for _, _, anomaly_type, _ in anomalies] == ["Rapid Temp Change"]
+    assert anomalies[0][3] == "Temperature changed by 1.00C/s"
+
+
+def test_malformed_first_timestamp_does_not_block_rates():
+    rules = compile_rules(RULES_CONFIG, ["temperature_C"])
+    state = DeviceStateStore(["temperature_C"], alpha=0.1, warmup=1, capacity=4)
+
+    evaluate_rules(rules, state, [reading("garbage", 20)])
+    assert evaluate_rules(rules, state, [reading("2024-01-01T00:00:00Z", 20)]) == []
+
+    anomalies = evaluate_rules(rules, state, [reading("2024-01-01T00:00:01Z", 25)])
+    assert [anomaly_type for _, _, anomaly_type, _ in anomalies] == ["Rapid Temp Change"]
+
+
+ZSCORE_CONFIG = [
+    {"name": "Unusual Temp", "event_type": "power_usage", "check": "zscore", "field": "temperature_C",
+     "max_zscore": 3, "description": "Temperature of {value:g}C is {zscore:.1f} deviations from {mean:.1f}C"}
+]
+
+
+def test_zscore_rule_flags_outliers_after_warmup():
+    rules = compile_rules(ZSCORE_CONFIG, ["temperature_C"])
+    state = DeviceStateStore(["temperature_C"], alpha=0.5, warmup=4, capacity=4)
+
+    # Nothing is flagged while the device warms up
+    temperatures = [20, 22, 20, 22]
+    for second, temperature in enumerate(temperatures):
+        assert evaluate_rules(rules, state, [reading(f"2024-01-01T00:00:0{second}Z", temperature)]) == []
+    assert evaluate_rules(rules, state, [reading("2024-01-01T00:00:05Z", 21)]) == []
+
+    anomalies = evaluate_rules(rules, state, [reading("2024-01-01T00:00:06Z", 40)])
+    assert [anomaly_type for _, _, anomaly_type, _ in anomalies] == ["Unusual Temp"]
+    payload, event_type, _, description = anomalies[0]
+    assert payload["power_data"]["temperature_C"] == 40
+    assert event_type == "power_usage"
+    assert description.startswith("Temperature of 40C is ")
+
+
+def test_zscore_rule_is_per_device():
+    rules = compile_rules(ZSCORE_CONFIG, ["temperature_C"])
+    state = DeviceStateStore(["temperature_C"], alpha=0.5, warmup=2, capacity=4)
+
+    for second, (hot, cold) in enumerate([(60, 20), (62, 22), (60, 20)]):
+        evaluate_rules(rules, state, [reading(f"2024-01-01T00:00:0{second}Z", hot, "hot"),
+                                      reading(f"2024-01-01T00:00:0{second}Z", cold, "cold")])
+
+    # 61C is normal for the hot device and far off for the cold one
+    anomalies = evaluate_rules(rules, state, [reading("2024-01-01T00:00:05Z", 61, "hot"),
+                                              reading("2024-01-01T00:00:05Z", 61, "cold")])
+    assert [payload["device_id"] for payload, _, _, _ in anomalies] == ["cold"]
+
+
+def test_disabled_rules_are_not_compiled():
+    rules = compile_rules([dict(RULES_CONFIG[0], enabled=False), RULES_CONFIG[1]], ["temperature_C"])
+
+    assert [rule.name for rule in rules] == ["Rapid Temp Change"]
+    assert "enabled" not in rules[0].defaults
+
+
+def test_default_config_enables_baseline_rules_only():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_conf.yaml"), 'r') as f:
+        app_config = yaml.safe_load(f.read())
+
+    rules = compile_rules(app_config['rules'], app_config['device_state']['fields'])
+
+    assert [(rule.name, rule.defaults, rule.device_types) for rule in rules] == [
+        ("Low SoC", {"threshold": 10}, {}),
+        ("High Temp", {"threshold": 45}, {})
+    ]
@@ -3,18 +3,18 @@ from connexion import NoContent
 import yaml
 import logging
 import logging.config
-import json
-from pykafka import KafkaClient
-from pykafka.common import OffsetType
+import message_bus
+import wire_format
+from offset_index import OffsetIndex
+from message_cache import MessageCache
+from metrics import RequestMetricsMiddleware, ConsumerLag, KAFKA_CONSUMED, BATCH_SIZE
+from contextlib import asynccontextmanager
 from threading import Thread
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
+import time
 import os
 
-if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
-    CORS(app.app)
-    app.app.config['CORS_HEADERS'] = 'Content-Type'
-
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
     app_conf_file = "/config/app_conf.yml"
@@ -39,6 +39,12 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
+EVENT_TYPES = ["power_usage", "location"]
+
+# Follows the index written by run_background, which replaces it with the writable index in its own process
+offset_index = OffsetIndex(app_config["index"]["directory"], EVENT_TYPES, read_only=True)
+message_cache = MessageCache(app_config["cache"]["max_bytes"])
+
 def get_power_usage_reading(index):
     """ Get Power Usage Reading in History """
     return get_event_reading_by_type(index, "power_usage")
@@ -49,43 +55,130 @@ def get_location_reading(index):
 
 def get_event_reading_by_type(index, event_type):
     """ General function to retrieve event reading by type and index """
-    hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-
     logger.info("Retrieving %s at index %d", event_type, index)
-    current_index = 0
-    try:
-        for message in consumer:
-            if message is not None and message.value is not None:
-                msg_str = message.value.decode('utf-8')
-                msg = json.loads(msg_str)
 
-                if msg["type"] == event_type:
-                    if current_index == index:
-                        logger.info("Found %s at index %d", event_type, index)
-                        return msg, 200
-                    current_index += 1
+    event = message_cache.get((event_type, index))
+    if event is not None:
+        logger.info("Found %s at index %d in cache", event_type, index)
+        return event, 200
+
+    # Anything past the indexed high-water mark is a miss without going to the message bus
+    location = offset_index.lookup(event_type, index)
+    if location is None:
+        logger.error("Could not find %s at index %d", event_type, index)
+        return {"message": "Not Found"}, 404
 
+    partition_id, offset = location
+    try:
+        message = bus.fetch(app_config["events"]["topic"], partition_id, offset,
+                            max_bytes=app_config["index"]["fetch_max_bytes"],
+                            timeout_ms=app_config["index"]["fetch_timeout_ms"])
     except Exception as e:
         logger.error("Error retrieving message: %s", str(e))
+        message = None
+
+    if message is None:
+        logger.error("Could not find %s at index %d", event_type, index)
+        return {"message": "Not Found"}, 404
+
+    try:
+        event = wire_format.decode(message.value)
+    except ValueError as e:
+        logger.error("Could not decode %s at index %d: %s", event_type, index, e)
+        return {"message": "Not Found"}, 404
+    message_cache.put((event_type, index), event, len(message.value))
+
+    logger.info("Found %s at index %d", event_type, index)
+    return event, 200
+
+def index_events():
+    """ Appends the partition and offset of every new event to the offset index """
+    consumer = bus.consumer(app_config["events"]["topic"], offset_reset="earliest", reset_offset_on_start=True,
+                            timeout_ms=app_config["index"]["batch_timeout_ms"])
 
-    logger.error("Could not find %s at index %d", event_type, index)
-    return {"message": "Not Found"}, 404
+    # Resume after the last indexed offset
+    if offset_index.next_offsets:
+        consumer.seek(offset_index.next_offsets)
+
+    entries = []
+    next_offsets = {}
+    next_checkpoint = time.time() + app_config["index"]["checkpoint_sec"]
+    consumed = KAFKA_CONSUMED.labels(app_config["events"]["topic"])
+    lag = ConsumerLag([consumer], app_config["metrics"]["lag_interval_sec"])
+
+    while True:
+        message = consumer.consume()
+        lag.update()
+        if message is not None:
+            consumed.inc()
+        if message is not None and message.value is not None:
+            try:
+                event_type = wire_format.message_type(message.value)
+            except (ValueError, KeyError, TypeError) as e:
+                # Skipped like any other message that is not indexed, so the indexer moves past it
+                logger.error("Skipping message that cannot be read at offset %d of partition %d: %s",
+                             message.offset, message.partition_id, e)
+                event_type = None
+            if event_type in EVENT_TYPES:
+                entries.append((event_type, message.partition_id, message.offset))
+        if message is not None:
+            next_offsets[message.partition_id] = message.offset + 1
+
+        if next_offsets and (message is None or len(entries) >= app_config["index"]["batch_size"]):
+            BATCH_SIZE.labels("index_entries").observe(len(entries))
+            offset_index.append(entries, next_offsets)
+            entries = []
+            next_offsets = {}
+
+        if time.time() >= next_checkpoint:
+            offset_index.checkpoint()
+            logger.debug("Checkpointed offset index: %s", offset_index.next_offsets)
+            next_checkpoint = time.time() + app_config["index"]["checkpoint_sec"]
+
+def connect_bus():
+    """ Connects to the message bus shared by the requests and the indexer, retrying until Kafka is reachable """
+    global bus
+
+    # One connection for the lifetime of the service, requests reuse its broker connections
+    bus = message_bus.connect(app_config["events"], app_config['max_retries'], app_config['sleep_time'])
+
+def run_background():
+    """ Indexes the events topic, once however many HTTP workers serve the API """
+    global offset_index
+
+    connect_bus()
+    offset_index = OffsetIndex(app_config["index"]["directory"], EVENT_TYPES)
+    try:
+        index_events()
+    finally:
+        # Saves the entries indexed since the last periodic checkpoint when the process is stopped
+        offset_index.checkpoint()
+
+@asynccontextmanager
+async def lifespan(app):
+    """ Connects the worker to the message bus when it starts, to fetch the messages found in the index """
+    connect_bus()
+    yield
+
+app = connexion.FlaskApp(__name__, specification_dir='', lifespan=lifespan)
+app.add_api("openapi.yaml", base_path="/audit_log", strict_validation=True, validate_responses=True)
+app.add_middleware(
+    CORSMiddleware,
+    position=MiddlewarePosition.BEFORE_EXCEPTION,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+app.add_middleware(RequestMetricsMiddleware, position=MiddlewarePosition.BEFORE_SWAGGER)
 
 def main():
-    app = connexion.FlaskApp(__name__, specification_dir='')
-    app.add_api("openapi.yaml", base_path="/audit_log", strict_validation=True, validate_responses=True)
-    app.add_middleware(
-        CORSMiddleware,
-        position=MiddlewarePosition.BEFORE_EXCEPTION,
-        allow_origins=["*"],
-        allow_credentials=True,
-        allow_methods=["*"],
-        allow_headers=["*"],
-    )
-    app.run(host='0.0.0.0', port=8110)
+    """ Development server, the indexer and the API share one process """
+    t1 = Thread(target=run_background)
+    t1.daemon = True
+    t1.start()
+
+    app.run(host='0.0.0.0', port=app_config['server']['port'])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,33 @@
+import os
+import shutil
+import sys
+
+import pytest
+import yaml
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """ app.py imported with the memory bus and its files in a temporary directory """
+    directory = tmp_path_factory.mktemp("audit_log")
+    for name in ["app_conf.yml", "log_conf.yml", "openapi.yaml"]:
+        shutil.copy(os.path.join(SERVICE_DIR, name), directory)
+
+    with open(directory / "app_conf.yml", 'r') as f:
+        app_config = yaml.safe_load(f.read())
+    app_config["events"]["backend"] = "memory"
+    app_config["index"]["directory"] = str(directory / "index")
+    app_config["index"]["batch_timeout_ms"] = 50
+    with open(directory / "app_conf.yml", 'w') as f:
+        yaml.safe_dump(app_config, f)
+
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        import app
+        yield app
+    finally:
+        os.chdir(cwd)
+        sys.modules.pop("app", None)
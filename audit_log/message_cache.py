@@ -0,0 +1,39 @@
+from collections import OrderedDict
+import threading
+
+
+class MessageCache:
+    """ Least recently used cache of decoded events, bounded by the size of their Kafka messages """
+
+    def __init__(self, max_bytes):
+        """ Initializes an empty cache holding at most max_bytes of message values """
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """ Returns the event cached under key and marks it as recently used, or None """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, event, size):
+        """ Caches event under key, evicting the least recently used events until it fits """
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+
+            while self.size + size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+            self.entries[key] = (event, size)
+            self.size += size
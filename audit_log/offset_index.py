@@ -0,0 +1,117 @@
+import json
+import mmap
+import os
+import struct
+import threading
+
+# One index entry: the Kafka partition id and offset an event was stored at
+ENTRY = struct.Struct('<iq')
+
+
+class OffsetIndex:
+    """ Maps the n-th event of each type to the Kafka partition and offset it is stored at
+
+    Each event type has its own file of fixed size entries, so the n-th entry is read
+    straight out of the memory mapped file. offsets.json records how far into each
+    partition the index is complete, and is only rewritten after the entries it covers
+    are on disk.
+
+    A read_only index follows the files of an index another process appends to. It only
+    serves the entries covered by that process's last checkpoint, which are never truncated.
+    """
+
+    def __init__(self, directory, event_types, read_only=False):
+        """ Opens the index files in directory, dropping entries written after the last checkpoint """
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.checkpoint_file = os.path.join(directory, "offsets.json")
+        self.read_only = read_only
+        self.checkpoint_mtime = None
+
+        checkpoint = self.read_checkpoint()
+
+        # Next offset to index in each partition
+        self.next_offsets = {int(partition_id): offset
+                             for partition_id, offset in checkpoint["next_offsets"].items()}
+
+        self.files = {}
+        self.counts = {}
+        self.maps = {}
+        self.mapped_counts = {}
+        for event_type in event_types:
+            f = open(os.path.join(directory, f"{event_type}.idx"), 'a+b')
+            if not read_only:
+                # The indexer appends these again when it resumes from the checkpointed offsets
+                f.truncate(checkpoint["counts"].get(event_type, 0) * ENTRY.size)
+            self.files[event_type] = f
+            self.counts[event_type] = checkpoint["counts"].get(event_type, 0)
+            self.maps[event_type] = None
+            self.mapped_counts[event_type] = 0
+
+    def read_checkpoint(self):
+        """ Loads offsets.json, or an empty checkpoint if there is none yet """
+        if not os.path.exists(self.checkpoint_file):
+            return {"counts": {}, "next_offsets": {}}
+
+        self.checkpoint_mtime = os.stat(self.checkpoint_file).st_mtime
+        with open(self.checkpoint_file, 'r') as f:
+            return json.load(f)
+
+    def follow(self):
+        """ Picks up the counts of a newer checkpoint of the indexing process, read_only indexes only """
+        if not os.path.exists(self.checkpoint_file) or os.stat(self.checkpoint_file).st_mtime == self.checkpoint_mtime:
+            return
+
+        checkpoint = self.read_checkpoint()
+        for event_type in self.counts:
+            self.counts[event_type] = checkpoint["counts"].get(event_type, 0)
+
+    def append(self, entries, next_offsets):
+        """ Appends (event_type, partition_id, offset) entries and advances the indexed offsets """
+        with self.lock:
+            for event_type, partition_id, offset in entries:
+                self.files[event_type].write(ENTRY.pack(partition_id, offset))
+                self.counts[event_type] += 1
+            for f in self.files.values():
+                f.flush()
+            self.next_offsets.update(next_offsets)
+
+    def checkpoint(self):
+        """ Syncs the index files and records the counts and offsets they are complete up to """
+        with self.lock:
+            for f in self.files.values():
+                os.fsync(f.fileno())
+            checkpoint = {"counts": self.counts, "next_offsets": self.next_offsets}
+
+            # Written to a temporary file first so a crash never leaves a partial checkpoint
+            temp_file = self.checkpoint_file + ".tmp"
+            with open(temp_file, 'w') as f:
+                json.dump(checkpoint, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, self.checkpoint_file)
+
+    def lookup(self, event_type, index):
+        """ Returns the (partition_id, offset) of the index-th event of event_type, or None """
+        with self.lock:
+            if self.read_only and index >= self.counts[event_type]:
+                self.follow()
+
+            if index < 0 or index >= self.counts[event_type]:
+                return None
+
+            # The file has grown since it was last mapped
+            if index >= self.mapped_counts[event_type]:
+                if self.maps[event_type] is not None:
+                    self.maps[event_type].close()
+                self.maps[event_type] = mmap.mmap(self.files[event_type].fileno(), 0, access=mmap.ACCESS_READ)
+                self.mapped_counts[event_type] = self.counts[event_type]
+
+            return ENTRY.unpack_from(self.maps[event_type], index * ENTRY.size)
+
+    def count(self, event_type):
+        """ Number of events of event_type indexed so far """
+        with self.lock:
+            if self.read_only:
+                self.follow()
+            return self.counts[event_type]
@@ -0,0 +1,47 @@
+import json
+import threading
+import time
+
+import wire_format
+from offset_index import OffsetIndex
+
+
+def reading(event_type, number):
+    """ An event message of event_type as the receiver produces it """
+    return {"type": event_type, "datetime": "2024-01-01T00:00:00", "payload": {"number": number}}
+
+
+def wait_for(condition, timeout_sec=5):
+    """ Waits until condition() is true, the indexer runs in a thread of its own """
+    deadline = time.time() + timeout_sec
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_indexer_skips_garbage_message(app_module, tmp_path):
+    app_module.connect_bus()
+    topic = app_module.bus.topic(app_module.app_config["events"]["topic"])
+    producer = app_module.bus.sync_producer(app_module.app_config["events"]["topic"])
+    start = len(topic.partitions[0])
+
+    producer.produce(json.dumps(reading("power_usage", 0)).encode('utf-8'))
+    producer.produce(b"garbage")
+    producer.produce(wire_format.MAGIC + b"\x01")
+    producer.produce(json.dumps({"payload": {}}).encode('utf-8'))
+    producer.produce(json.dumps(reading("power_usage", 1)).encode('utf-8'))
+    producer.produce(json.dumps(reading("location", 2)).encode('utf-8'))
+
+    app_module.offset_index = OffsetIndex(str(tmp_path), app_module.EVENT_TYPES)
+    threading.Thread(target=app_module.index_events, daemon=True).start()
+    wait_for(lambda: app_module.offset_index.next_offsets.get(0) == start + 6)
+
+    index = app_module.offset_index
+    assert index.count("power_usage") == 2
+    assert index.lookup("power_usage", 0) == (0, start)
+    assert index.lookup("power_usage", 1) == (0, start + 4)
+    assert index.lookup("location", 0) == (0, start + 5)
+
+    event, status = app_module.get_location_reading(0)
+    assert status == 200
+    assert event == reading("location", 2)
@@ -0,0 +1,66 @@
+import os
+
+from offset_index import OffsetIndex
+
+EVENT_TYPES = ["power_usage", "location"]
+
+
+def test_lookup_after_reopen(tmp_path):
+    index = OffsetIndex(str(tmp_path), EVENT_TYPES)
+    index.append([("power_usage", 0, 10), ("location", 1, 11), ("power_usage", 1, 12)], {0: 11, 1: 13})
+    index.checkpoint()
+
+    reopened = OffsetIndex(str(tmp_path), EVENT_TYPES)
+
+    assert reopened.lookup("power_usage", 0) == (0, 10)
+    assert reopened.lookup("power_usage", 1) == (1, 12)
+    assert reopened.lookup("location", 0) == (1, 11)
+    assert reopened.count("power_usage") == 2
+    assert reopened.next_offsets == {0: 11, 1: 13}
+
+
+def test_lookup_out_of_range(tmp_path):
+    index = OffsetIndex(str(tmp_path), EVENT_TYPES)
+    index.append([("power_usage", 0, 10)], {0: 11})
+
+    assert index.lookup("power_usage", 1) is None
+    assert index.lookup("power_usage", -1) is None
+    assert index.lookup("location", 0) is None
+
+
+def test_reopen_drops_entries_after_checkpoint(tmp_path):
+    index = OffsetIndex(str(tmp_path), EVENT_TYPES)
+    index.append([("power_usage", 0, 10)], {0: 11})
+    index.checkpoint()
+    index.append([("power_usage", 0, 11)], {0: 12})
+
+    reopened = OffsetIndex(str(tmp_path), EVENT_TYPES)
+
+    assert reopened.count("power_usage") == 1
+    assert reopened.lookup("power_usage", 1) is None
+    assert reopened.next_offsets == {0: 11}
+
+    # Resuming from the checkpointed offsets indexes the dropped entry again at the same position
+    reopened.append([("power_usage", 0, 11)], {0: 12})
+    assert reopened.lookup("power_usage", 1) == (0, 11)
+
+
+def test_read_only_index_follows_checkpoints(tmp_path):
+    index = OffsetIndex(str(tmp_path), EVENT_TYPES)
+    index.append([("location", 0, 5)], {0: 6})
+    index.checkpoint()
+
+    follower = OffsetIndex(str(tmp_path), EVENT_TYPES, read_only=True)
+    assert follower.lookup("location", 0) == (0, 5)
+
+    index.append([("location", 0, 6)], {0: 7})
+    assert follower.lookup("location", 1) is None
+
+    index.checkpoint()
+    # The follower notices a checkpoint by its mtime, which may not have ticked yet
+    checkpoint_file = os.path.join(str(tmp_path), "offsets.json")
+    mtime = os.stat(checkpoint_file).st_mtime + 1
+    os.utime(checkpoint_file, (mtime, mtime))
+
+    assert follower.lookup("location", 1) == (0, 6)
+    assert follower.count("location") == 2
@@ -0,0 +1,514 @@
+""" End-to-end benchmark of the readings pipeline: receiver -> events topic -> storage, anomaly_detector, processing
+
+Usage: python3 benchmark/run_benchmark.py [--readings 20000] [--devices 1000] [--concurrency 8] [--rate 0]
+                                          [--batch-size 0] [--partitions 1] [--wire-format json] [--seed 42]
+                                          [--save results.json] [--compare baseline.json]
+
+The services run in this process, offline: they share the memory backend of message_bus.py instead
+of Kafka, and storage writes to a SQLite file instead of MySQL. Each service is imported from a scratch
+working directory holding a copy of its app_conf with the file paths pointed there, and processing runs
+in push mode so it consumes the events topic like the other stages. Readings go through the receiver's
+whole Connexion app, from as many client threads as --concurrency, as fast as it answers or at --rate
+readings per second, which it produces in --wire-format.
+
+It reports the bytes each reading takes on the events topic and, per stage, times in milliseconds:
+- readings/s: readings the stage took in per second, from its first to its last
+- latency: the receiver's response time per request, or the time from a consumer reading a message
+  to committing its offset
+- freshness: the time from a reading being sent to it being on the topic (receiver) or committed by
+  the consumer, so it includes every stage before it
+
+Every stage shares this process and its GIL, so the figures compare runs of the benchmark with each
+other rather than with a deployment. The readings are the same for the same --seed. --save keeps the
+figures of a run as JSON and --compare prints the change of each figure against such a file.
+"""
+import argparse
+import datetime
+import importlib
+import importlib.util
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import numpy as np
+import sqlalchemy
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONSUMERS = ["storage", "anomaly_detector", "processing"]
+
+# Modules every service has the same copy of, imported once for all of them. metrics can only register
+# its metrics once per process, and message_bus holds the memory bus the services share
+SHARED_MODULES = ["metrics", "message_bus", "wire_format"]
+
+# app_conf settings replaced in the copy each service reads, {workdir} is the service's working directory
+OVERRIDES = {
+    "receiver": {"recent.filename": "{workdir}/events.json"},
+    "storage": {},
+    "anomaly_detector": {"datastore.filename": "{workdir}/stats.sqlite",
+                         "device_state.checkpoint_file": "{workdir}/device_state.npz"},
+    "processing": {"datastore.filename": "{workdir}/stats.sqlite",
+                   "stats.window_file": "{workdir}/window_stats.json",
+                   "stats.running_file": "{workdir}/running_stats.json",
+                   "stats.mode": "push"}
+}
+
+PATHS = {
+    "power_usage": "/receiver/readings/power-usage",
+    "location": "/receiver/readings/location"
+}
+
+# The readings are timestamped when they are sent, which is what freshness is measured from
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+DEVICE_TYPES = {"10k": 10000, "20k": 20000, "30k": 30000, "50k": 50000}
+BASE_LATITUDE = 49.253581
+BASE_LONGITUDE = -123.001242
+
+FIGURES = ["readings", "readings_per_sec", "latency_p50_ms", "latency_p99_ms", "freshness_p50_ms", "freshness_p99_ms"]
+
+
+class RecordingConsumer:
+    """ Wraps a consumer of the memory bus, recording when it consumes and commits each message """
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        # The benchmark runs each service on a thread named after it
+        self.owner = threading.current_thread().name
+        # (partition_id, offset) -> time consumed, the last offsets consumed and (time, offsets) of each commit
+        self.consumed_at = {}
+        self.consumed = {}
+        self.commits = []
+
+    def consume(self, block=True):
+        message = self.consumer.consume(block)
+        if message is not None:
+            self.consumed_at[(message.partition_id, message.offset)] = time.time()
+            self.consumed[message.partition_id] = message.offset
+        return message
+
+    def commit(self):
+        self.consumer.commit()
+        self.commits.append((time.time(), dict(self.consumed)))
+
+    def __getattr__(self, name):
+        return getattr(self.consumer, name)
+
+
+class RecordingBus:
+    """ Wraps the memory bus the services share, so their consumers record when they handle each message """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.consumers = []
+        self.lock = threading.Lock()
+
+    def consumer(self, *args, **kwargs):
+        consumer = RecordingConsumer(self.bus.consumer(*args, **kwargs))
+        with self.lock:
+            self.consumers.append(consumer)
+        return consumer
+
+    def consumers_of(self, owner):
+        with self.lock:
+            return [consumer for consumer in self.consumers if consumer.owner == owner]
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+
+def import_shared_module(name):
+    """ Imports the receiver's copy of a module of SHARED_MODULES, which the other services then find imported """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, "receiver", f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def set_setting(config, key, value):
+    """ Sets a dotted key such as "stats.mode" of a nested configuration """
+    *sections, name = key.split(".")
+    for section in sections:
+        config = config[section]
+    config[name] = value
+
+
+def benchmark_log_config(log_conf_file, log_file):
+    """ A service's log configuration without its console handlers and with its log file replaced by log_file """
+    with open(log_conf_file, 'r') as f:
+        log_config = yaml.safe_load(f.read())
+
+    consoles = [name for name, handler in log_config['handlers'].items() if handler['class'] == "logging.StreamHandler"]
+    for name in consoles:
+        del log_config['handlers'][name]
+    for logger_config in list(log_config.get('loggers', {}).values()) + [log_config.get('root', {})]:
+        logger_config['handlers'] = [name for name in logger_config.get('handlers', []) if name not in consoles]
+    for handler in log_config['handlers'].values():
+        if 'filename' in handler:
+            handler['filename'] = log_file
+
+    return log_config
+
+
+def sqlite_create_engine(database_file):
+    """ Stands in for sqlalchemy.create_engine while storage is imported, opening database_file instead of MySQL """
+    create_engine = sqlalchemy.create_engine
+
+    def create_sqlite_engine(url, **kwargs):
+        return create_engine(f"sqlite:///{database_file}")
+
+    return create_sqlite_engine
+
+
+def load_service(name, workdir, overrides):
+    """ Imports the app module of a service from a working directory holding its benchmark configuration
+
+    overrides are app_conf settings replaced on top of the service's OVERRIDES.
+    """
+    service_dir = os.path.join(ROOT, name)
+    service_workdir = os.path.join(workdir, name)
+    os.makedirs(service_workdir)
+
+    extension = "yml" if os.path.exists(os.path.join(service_dir, "app_conf.yml")) else "yaml"
+    with open(os.path.join(service_dir, f"app_conf.{extension}"), 'r') as f:
+        app_config = yaml.safe_load(f.read())
+    for key, value in dict(OVERRIDES[name], **{"events.backend": "memory"}, **overrides).items():
+        set_setting(app_config, key, value.format(workdir=service_workdir) if isinstance(value, str) else value)
+
+    with open(os.path.join(service_workdir, f"app_conf.{extension}"), 'w') as f:
+        yaml.safe_dump(app_config, f)
+    with open(os.path.join(service_workdir, f"log_conf.{extension}"), 'w') as f:
+        yaml.safe_dump(benchmark_log_config(os.path.join(service_dir, f"log_conf.{extension}"),
+                                            os.path.join(workdir, "benchmark.log")), f)
+    shutil.copy(os.path.join(service_dir, "openapi.yaml"), service_workdir)
+
+    cwd = os.getcwd()
+    create_engine = sqlalchemy.create_engine
+    os.chdir(service_workdir)
+    sys.path.insert(0, service_dir)
+    if name == "storage":
+        sqlalchemy.create_engine = sqlite_create_engine(os.path.join(service_workdir, "readings.sqlite"))
+    try:
+        module = importlib.import_module("app")
+        if hasattr(module, "create_tables"):
+            module.create_tables()
+        # Connexion resolves the operationIds on the first request, which has to come while the
+        # modules of this service are the ones imported as app, base and so on
+        module.app.test_client().get("/")
+    finally:
+        sqlalchemy.create_engine = create_engine
+        sys.path.remove(service_dir)
+        os.chdir(cwd)
+        # The next service imports its own app, base and other modules under the same names
+        for module_name, loaded in list(sys.modules.items()):
+            if module_name not in SHARED_MODULES and os.path.dirname(getattr(loaded, "__file__", None) or "") == service_dir:
+                del sys.modules[module_name]
+
+    if name == "storage":
+        module.Base.metadata.create_all(module.DB_ENGINE)
+
+    return module
+
+
+def start_consumer(name, module, bus, timeout_sec=30):
+    """ Runs the background process of a service on a thread named after it, until its consumers are created
+
+    They are all in the group before the first reading is sent, so none of them starts on partitions
+    that a rebalance then hands to another.
+    """
+    thread = threading.Thread(target=module.run_background, name=name, daemon=True)
+    thread.start()
+
+    workers = module.app_config.get('consumer', {}).get('workers', 1)
+    deadline = time.time() + timeout_sec
+    while len(bus.consumers_of(name)) < workers:
+        if time.time() > deadline or not thread.is_alive():
+            raise RuntimeError(f"{name} did not start consuming, see benchmark.log")
+        time.sleep(0.01)
+
+
+def make_readings(count, num_devices, seed):
+    """ Builds count (event_type, reading) pairs of num_devices devices, timestamped when they are sent
+
+    Four in five are power usage readings. Every device stays close to its own power, temperature
+    and position, so the anomaly detector mostly reports the random states of charge below 10%.
+    """
+    rng = random.Random(seed)
+
+    devices = []
+    for _ in range(num_devices):
+        device_type = rng.choice(list(DEVICE_TYPES))
+        devices.append({
+            "device_id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "device_type": device_type,
+            "power_W": rng.uniform(0.1, 0.9) * DEVICE_TYPES[device_type],
+            "temperature_C": rng.gauss(35, 3),
+            "gps_latitude": BASE_LATITUDE + rng.uniform(-2, 2),
+            "gps_longitude": BASE_LONGITUDE + rng.uniform(-2, 2)
+        })
+
+    readings = []
+    for _ in range(count):
+        device = rng.choice(devices)
+        reading = {"device_id": device['device_id'], "device_type": device['device_type']}
+        if rng.random() < 0.8:
+            reading["power_data"] = {
+                "power_W": round(device['power_W'] * rng.uniform(0.95, 1.05), 1),
+                "energy_out_Wh": round(rng.uniform(0, 1000), 1),
+                "state_of_charge_%": rng.randint(0, 100),
+                "temperature_C": round(device['temperature_C'] + rng.gauss(0, 0.02), 2)
+            }
+            readings.append(("power_usage", reading))
+        else:
+            reading["location_data"] = {
+                "gps_latitude": device['gps_latitude'] + rng.gauss(0, 0.001),
+                "gps_longitude": device['gps_longitude'] + rng.gauss(0, 0.001)
+            }
+            readings.append(("location", reading))
+
+    return readings
+
+
+def make_requests(readings, batch_size):
+    """ Groups the readings into (index, event_type, readings) requests, one reading each unless batch_size is set
+
+    index is the position of the request's last reading, which --rate paces the requests by.
+    """
+    requests = []
+    pending = {event_type: [] for event_type in PATHS}
+    for index, (event_type, reading) in enumerate(readings):
+        pending[event_type].append(reading)
+        if len(pending[event_type]) >= max(batch_size, 1):
+            requests.append((index, event_type, pending[event_type]))
+            pending[event_type] = []
+
+    for event_type, batch in pending.items():
+        if batch:
+            requests.append((len(readings) - 1, event_type, batch))
+
+    return requests
+
+
+def send_requests(client, requests, batch, start, rate, latencies, failures):
+    """ Posts the requests in order, each once start + index / rate has passed if rate is set """
+    for index, event_type, readings in requests:
+        if rate > 0:
+            delay = start + index / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime(TIMESTAMP_FORMAT)
+        for reading in readings:
+            reading['timestamp'] = timestamp
+
+        request_start = time.perf_counter()
+        if batch:
+            response = client.post(f"{PATHS[event_type]}:batch", json=readings)
+        else:
+            response = client.post(PATHS[event_type], json=readings[0])
+        latencies.append(time.perf_counter() - request_start)
+
+        if response.status_code not in (201, 207):
+            failures.append(f"{response.status_code} {response.text}")
+        elif batch and response.json()['rejected'] > 0:
+            failures.append(f"{response.json()['rejected']} of {len(readings)} readings rejected")
+
+
+def run_load(receiver, requests, args):
+    """ Sends the requests from args.concurrency threads, returns the request latencies and the failures """
+    latencies = []
+    failures = []
+
+    with receiver.app.test_client() as client:
+        start = time.time()
+        threads = [threading.Thread(target=send_requests,
+                                    args=(client, requests[thread::args.concurrency], args.batch_size > 0,
+                                          start, args.rate, latencies, failures))
+                   for thread in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return latencies, failures
+
+
+def wait_for_consumers(bus, timeout_sec):
+    """ Waits until every consumer consumed the whole topic and committed it, returns False on timeout """
+    deadline = time.time() + timeout_sec
+    while time.time() < deadline:
+        # A consumer given no partitions has nothing to consume or commit
+        if all(consumer.lag() == 0 and (consumer.commits[-1][1] if consumer.commits else {}) == consumer.consumed
+               for name in CONSUMERS for consumer in bus.consumers_of(name)):
+            return True
+        time.sleep(0.1)
+
+    return False
+
+
+def sent_at(event):
+    """ Time the load generator sent the reading of an event message, from the reading's timestamp """
+    timestamp = event['payload']['timestamp']
+    return datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def figures(readings, start, end, latencies, freshness):
+    """ The figures reported for a stage, times in milliseconds """
+    latency_p50, latency_p99 = np.percentile(latencies, [50, 99]) * 1000 if latencies else (None, None)
+    freshness_p50, freshness_p99 = np.percentile(freshness, [50, 99]) * 1000 if freshness else (None, None)
+
+    return {
+        "readings": readings,
+        "readings_per_sec": readings / (end - start) if end > start else None,
+        "latency_p50_ms": latency_p50,
+        "latency_p99_ms": latency_p99,
+        "freshness_p50_ms": freshness_p50,
+        "freshness_p99_ms": freshness_p99
+    }
+
+
+def receiver_figures(messages, sent, latencies):
+    """ Figures of the receiver, from the request latencies and the time each reading was produced to the topic """
+    start = min(sent.values())
+    end = max(message.timestamp / 1000 for message in messages)
+    freshness = [message.timestamp / 1000 - sent[(message.partition_id, message.offset)] for message in messages]
+
+    return figures(len(messages), start, end, latencies, freshness)
+
+
+def consumer_figures(consumers, sent):
+    """ Figures of a stage's consumers, from the time they consumed and committed each message """
+    consumed_at = {}
+    committed_at = {}
+    for consumer in consumers:
+        consumed_at.update(consumer.consumed_at)
+
+        committed = {}
+        for commit_time, offsets in consumer.commits:
+            for partition_id, offset in offsets.items():
+                for committed_offset in range(committed.get(partition_id, -1) + 1, offset + 1):
+                    committed_at.setdefault((partition_id, committed_offset), commit_time)
+                committed[partition_id] = max(committed.get(partition_id, -1), offset)
+
+    keys = [key for key in sent if key in consumed_at and key in committed_at]
+    if not keys:
+        return figures(0, 0, 0, [], [])
+
+    return figures(len(keys),
+                   min(consumed_at[key] for key in keys),
+                   max(consumed_at[key] for key in keys),
+                   [committed_at[key] - consumed_at[key] for key in keys],
+                   [committed_at[key] - sent[key] for key in keys])
+
+
+def format_figure(value, change=False):
+    if value is None:
+        return "-"
+    if change:
+        return f"{value:+.1%}"
+    return f"{value:.0f}" if value >= 100 else f"{value:.2f}"
+
+
+def print_figures(results, baseline=None):
+    """ Prints the figures of every stage, and their change against baseline if given """
+    header = (f"{'stage':>16} {'readings':>9} {'readings/s':>11} {'latency p50':>12} {'p99':>8} "
+              f"{'freshness p50':>14} {'p99':>8}")
+    widths = [9, 11, 12, 8, 14, 8]
+
+    print(header)
+    for stage, stage_figures in results.items():
+        print(f"{stage:>16} " + " ".join(f"{format_figure(stage_figures[figure]):>{width}}"
+                                         for figure, width in zip(FIGURES, widths)))
+
+    if baseline is None:
+        return
+
+    print("\nchange against the baseline:")
+    print(header)
+    for stage, stage_figures in results.items():
+        changes = []
+        for figure in FIGURES:
+            before = baseline.get(stage, {}).get(figure)
+            after = stage_figures[figure]
+            changes.append(None if not before or after is None else after / before - 1)
+        print(f"{stage:>16} " + " ".join(f"{format_figure(change, change=True):>{width}}"
+                                         for change, width in zip(changes, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the readings pipeline end to end on the in-memory message bus")
+    parser.add_argument("--readings", type=int, default=20000)
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0, help="readings per second to send, 0 sends as fast as possible")
+    parser.add_argument("--batch-size", type=int, default=0, help="readings per request to the batch endpoints, 0 uses the single ones")
+    parser.add_argument("--partitions", type=int, default=1)
+    parser.add_argument("--wire-format", choices=["json", "binary"], default="json", help="format the receiver produces readings in")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--drain-timeout", type=float, default=120, help="seconds to wait for the consumers to catch up")
+    parser.add_argument("--workdir", help="directory for the services' files, a new temporary one by default")
+    parser.add_argument("--save", help="file to save the figures of the run to")
+    parser.add_argument("--compare", help="figures saved by an earlier run to compare with")
+    args = parser.parse_args()
+
+    settings = {name: getattr(args, name) for name in ["readings", "devices", "concurrency", "rate", "batch_size", "partitions", "wire_format", "seed"]}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            saved = json.load(f)
+        if saved['settings'] != settings:
+            print(f"Warning: {args.compare} was run with different settings: {saved['settings']}")
+        baseline = saved['stages']
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="benchmark-")
+    os.environ.pop("TARGET_ENV", None)
+    os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
+
+    shared_modules = {name: import_shared_module(name) for name in SHARED_MODULES}
+    bus = RecordingBus(shared_modules["message_bus"].MemoryBus(args.partitions))
+    shared_modules["message_bus"].MEMORY_BUS = bus
+
+    services = {name: load_service(name, workdir, {"events.format": args.wire_format} if name == "receiver" else {})
+                for name in ["receiver"] + CONSUMERS}
+    for name in CONSUMERS:
+        start_consumer(name, services[name], bus)
+
+    requests = make_requests(make_readings(args.readings, args.devices, args.seed), args.batch_size)
+    print(f"Sending {args.readings} readings in {len(requests)} requests from {args.concurrency} threads")
+    latencies, failures = run_load(services["receiver"], requests, args)
+    if failures:
+        print(f"{len(failures)} requests failed, the first one: {failures[0]}")
+
+    if not wait_for_consumers(bus, args.drain_timeout):
+        print(f"Warning: the consumers did not catch up within {args.drain_timeout} seconds")
+
+    topic = bus.topic(services["receiver"].app_config['events']['topic'])
+    messages = [message for partition in topic.partitions.values() for message in partition]
+    sent = {(message.partition_id, message.offset): sent_at(shared_modules["wire_format"].decode(message.value))
+            for message in messages}
+
+    results = {"receiver": receiver_figures(messages, sent, latencies)}
+    for name in CONSUMERS:
+        results[name] = consumer_figures(bus.consumers_of(name), sent)
+
+    print(f"\nEvents topic: {sum(len(message.value) for message in messages) / max(len(messages), 1):.0f} bytes per reading "
+          f"in the {args.wire_format} format")
+    print()
+    print_figures(results, baseline)
+    print(f"\nLogs and databases of the run are in {workdir}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({"settings": settings, "stages": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,25 +6,22 @@ export default function AnomalyStats() {
     const [stats, setStats] = useState({});
     const [error, setError] = useState(null);
 
-    const getEventStats = () => {
-        fetch(`http://ec2-52-40-150-21.us-west-2.compute.amazonaws.com/anomaly_detector/anomaly_stats`) 
-            .then(res => res.json())
-            .then(
-                (result) => {
-                    console.log("Received Event Stats", result);
-                    setStats(result);
-                    setIsLoaded(true);
-                },
-                (error) => {
-                    setError(error);
-                    setIsLoaded(true);
-                }
-            );
-    };
-
     useEffect(() => {
-        const interval = setInterval(getEventStats, 2000); // Update every 2 seconds
-        return () => clearInterval(interval);
+        // The service pushes every new snapshot, the browser reconnects if the stream drops
+        const source = new EventSource(`http://ec2-52-40-150-21.us-west-2.compute.amazonaws.com/anomaly_detector/anomaly_stats/stream`);
+        source.onmessage = (event) => {
+            const result = JSON.parse(event.data);
+            console.log("Received Event Stats", result);
+            setStats(result);
+            setIsLoaded(true);
+        };
+        source.onerror = (error) => {
+            if (source.readyState === EventSource.CLOSED) {
+                setError(error);
+                setIsLoaded(true);
+            }
+        };
+        return () => source.close();
     }, []);
 
     if (error) {
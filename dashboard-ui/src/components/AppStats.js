@@ -6,23 +6,22 @@ export default function AppStats() {
     const [stats, setStats] = useState({});
     const [error, setError] = useState(null)
 
-	const getStats = () => {
-	
-        fetch(`http://ec2-52-40-150-21.us-west-2.compute.amazonaws.com/processing/stats`)
-            .then(res => res.json())
-            .then((result)=>{
-				console.log("Received Stats")
-                setStats(result);
-                setIsLoaded(true);
-            },(error) =>{
-                setError(error)
-                setIsLoaded(true);
-            })
-    }
     useEffect(() => {
-		const interval = setInterval(() => getStats(), 2000); // Update every 2 seconds
-		return() => clearInterval(interval);
-    }, [getStats]);
+		// The processing service pushes every new snapshot, the browser reconnects if the stream drops
+		const source = new EventSource(`http://ec2-52-40-150-21.us-west-2.compute.amazonaws.com/processing/stats/stream`);
+		source.onmessage = (event) => {
+			console.log("Received Stats")
+			setStats(JSON.parse(event.data));
+			setIsLoaded(true);
+		};
+		source.onerror = (error) => {
+			if (source.readyState === EventSource.CLOSED) {
+				setError(error)
+				setIsLoaded(true);
+			}
+		};
+		return() => source.close();
+    }, []);
 
     if (error){
         return (<div className={"error"}>Error found when fetching from API</div>)
@@ -1,17 +1,21 @@
 import connexion
-from connexion import NoContent
-from sqlalchemy import create_engine, text, func
+from sqlalchemy import create_engine, func, select, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker
 from base import Base
 from stats import Statistics
+from event_count import EventCount
+from sqlite_pipeline import configure_sqlite, process_batches
+from event_stream import Broadcaster, EventStreamMiddleware
+from metrics import RequestMetricsMiddleware, ConsumerLag, DB_COMMIT_SECONDS
+from collections import Counter
 import datetime
 import yaml
 import logging
 import logging.config
-import json
-from pykafka import KafkaClient
-from pykafka.common import OffsetType
-from threading import Thread
+import message_bus
+from contextlib import asynccontextmanager
+from threading import Thread, Lock
 import time
 import os
 from connexion.middleware import MiddlewarePosition
@@ -43,62 +47,125 @@ logger.info("Log Conf File: %s" % log_conf_file)
 
 # Create the database connection
 DB_ENGINE = create_engine(f"sqlite:///{app_config['datastore']['filename']}")
-Base.metadata.create_all(DB_ENGINE)
+configure_sqlite(DB_ENGINE, app_config['sqlite'])
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
 
-def event_stats():
+def create_tables():
+    """ Creates the tables that do not exist yet
+
+    server.py calls it once before it starts the workers and the background process, which would
+    otherwise race to create them in a new database file.
+    """
+    Base.metadata.create_all(DB_ENGINE)
+
+
+def load_event_counts():
+    """ Reads the stored count of every event code """
     session = DB_SESSION()
-    stats = session.query(
-        Statistics.code, 
-        func.count(Statistics.code).label('count')
-    ).group_by(Statistics.code).all()
-
-    if stats is not None:
-        results = {code: count for code, count in stats}
-        logger.info("Query for statistics successful")
-    else:
-        results = {}
-        logger.error("No statistics found")
+    counts = {row.code: row.count for row in session.execute(select(EventCount)).scalars()}
+    session.close()
+
+    logger.info("Loaded counts of %d event codes", len(counts))
+    return counts
+
+
+# Counts of every event code, kept in step with the event_counts table by store_event_message. They
+# are loaded by run_background and, in every HTTP worker, by refresh_event_counts, once the tables exist
+event_counts = {}
+event_counts_lock = Lock()
+
+# Pushes the counts to the dashboard's /event_stats/stream subscribers after every stored batch
+event_stats_stream = Broadcaster()
+event_stats_stream.publish(event_counts)
 
+
+def event_stats():
+    with event_counts_lock:
+        results = dict(event_counts)
+
+    logger.info("Query for statistics successful")
     return results, 200
 
 
-def store_event_message(payload):
-    session = DB_SESSION()
+def event_rows(messages):
+    """ The Statistics rows of a batch of event log messages """
+    date_created = datetime.datetime.now()
+    return [{"message": msg['payload']['message'],
+             "code": msg['payload']['code'],
+             "date_created": date_created} for msg in messages]
 
-    event_log_instance = Statistics(payload['message'], payload['code'], datetime.datetime.now())
 
-    session.add(event_log_instance)
+def store_event_rows(rows):
+    """ Stores a batch of event log rows and the counts of their codes in a single transaction """
+    codes = Counter(row['code'] for row in rows)
 
-    session.commit()
-    session.close()
+    # The counters are incremented in the same transaction, so they never drift from the rows stored
+    stmt = sqlite_insert(EventCount)
+    stmt = stmt.on_conflict_do_update(index_elements=[EventCount.code],
+                                      set_={"count": EventCount.count + stmt.excluded["count"]})
 
-    return NoContent, 201
+    with DB_COMMIT_SECONDS.labels("event_logs").time(), DB_ENGINE.begin() as connection:
+        connection.execute(insert(Statistics), rows)
+        connection.execute(stmt, [{"code": code, "count": count} for code, count in codes.items()])
 
+    with event_counts_lock:
+        for code, count in codes.items():
+            event_counts[code] = event_counts.get(code, 0) + count
+        snapshot = dict(event_counts)
 
-def process_messages():
-    # Create a consume on a consumer group, that only reads new messages
-    consumer = topic.get_simple_consumer(consumer_group=b'event_group', 
-                                         reset_offset_on_start=False, 
-                                         auto_offset_reset=OffsetType.LATEST)
+    event_stats_stream.publish(snapshot)
 
-    # This is blocking - it will wait for a new message
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s" % msg)
-        
-        payload = msg["payload"]
 
-        store_event_message(payload)
-            
-        # Commit the new message as being read
-        consumer.commit_offsets()
+def refresh_event_counts():
+    """ Reloads the counts when the background process stores new events
+
+    Checks the latest event id every stream.poll_sec, so every HTTP worker of server.py serves
+    /event_stats and its stream from memory.
+    """
+    global event_counts
+
+    last_id = None
+    while True:
+        try:
+            session = DB_SESSION()
+            latest_id = session.scalar(select(func.max(Statistics.id)))
+            session.close()
+
+            if latest_id is not None and latest_id != last_id:
+                counts = load_event_counts()
+                with event_counts_lock:
+                    event_counts = counts
+                event_stats_stream.publish(counts)
+                last_id = latest_id
+        except Exception as e:
+            logger.error(f"Exception while refreshing event counts: {e}")
 
+        time.sleep(app_config['stream']['poll_sec'])
 
-app = connexion.FlaskApp(__name__, specification_dir='')
+
+def process_messages(bus):
+    # Create a consume on a consumer group, that only reads new messages. storage has event_group
+    # to itself now that it is a balanced group, which a simple consumer cannot commit to
+    consumer = bus.consumer(app_config['events']['topic'], group="event_log_group", offset_reset="latest",
+                            timeout_ms=app_config['consumer']['batch_timeout_ms'])
+
+    process_batches(consumer, event_rows, store_event_rows, app_config['consumer'],
+                    app_config['max_retries'], app_config['sleep_time'],
+                    ConsumerLag([consumer], app_config['metrics']['lag_interval_sec']))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """ Starts reloading the counts stored by the background process when a worker starts """
+    t1 = Thread(target=refresh_event_counts)
+    t1.daemon = True
+    t1.start()
+    yield
+
+
+app = connexion.FlaskApp(__name__, specification_dir='', lifespan=lifespan)
 app.add_api("openapi.yaml", base_path="/event_logger", strict_validation=True, validate_responses=True)
 
 app.add_middleware(
@@ -109,26 +176,35 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    EventStreamMiddleware,
+    position=MiddlewarePosition.BEFORE_SWAGGER,
+    path="/event_logger/event_stats/stream",
+    broadcaster=event_stats_stream,
+    keepalive_sec=app_config['stream']['keepalive_sec'],
+)
+# Inside the stream middleware, so the open streams are not timed as requests
+app.add_middleware(RequestMetricsMiddleware, position=MiddlewarePosition.BEFORE_SWAGGER)
 
-if __name__ == "__main__":
-    retry_count = 0
 
-    while (retry_count < app_config['max_retries']):
-        logger.info("Attempting to connect to Kafka. Attempt #: %s", retry_count + 1)
-        try:
-            client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
-            topic = client.topics[str.encode(app_config["events"]["topic"])]
-            logger.info("Successfully connected to Kafka on attempt #: %s", retry_count + 1)
-            break
-        except Exception as e:
-            logger.error("Failed to connect to Kafka on attempt #:%s, error: %s", retry_count + 1, e)
-            time.sleep(app_config['sleep_time'])
-            retry_count += 1
-    else:
-        logger.error("Exceeded maximum number of retries (%s) for Kafka connection", app_config['max_retries'])
+def run_background():
+    """ Connects to the message bus and stores event log messages, once however many HTTP workers serve the API """
+    global event_counts
+
+    counts = load_event_counts()
+    with event_counts_lock:
+        event_counts = counts
+
+    bus = message_bus.connect(app_config['events'], app_config['max_retries'], app_config['sleep_time'])
+    process_messages(bus)
+
+
+if __name__ == "__main__":
+    """ Development server, the consumer and the API share one process """
+    create_tables()
 
-    t1 = Thread(target=process_messages)
+    t1 = Thread(target=run_background)
     t1.setDaemon(True)
     t1.start()
 
-    app.run(host='0.0.0.0', port=8120)
+    app.run(host='0.0.0.0', port=app_config['server']['port'])
@@ -15,6 +15,11 @@ c.execute('''
            `code` TEXT NOT NULL,
            `date_created` VARCHAR(100) NOT NULL)
           ''')
+c.execute('''
+          CREATE TABLE event_counts
+          (`code` TEXT PRIMARY KEY,
+           `count` INTEGER NOT NULL)
+          ''')
 
 conn.commit()
 conn.close()
\ No newline at end of file
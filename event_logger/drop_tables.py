@@ -6,6 +6,9 @@ c = conn.cursor()
 c.execute('''
           DROP TABLE Statistics
           ''')
+c.execute('''
+          DROP TABLE event_counts
+          ''')
 
 conn.commit()
 conn.close()
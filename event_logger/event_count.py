@@ -0,0 +1,19 @@
+from sqlalchemy import Column, Integer, String
+from base import Base
+
+
+class EventCount(Base):
+    """ Number of event log messages stored for one code """
+
+    __tablename__ = "event_counts"
+
+    code = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+    def to_dict(self):
+        """ Dictionary Representation of an event count """
+        dict = {}
+        dict['code'] = self.code
+        dict['count'] = self.count
+
+        return dict
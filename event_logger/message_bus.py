@@ -0,0 +1,443 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+from hashlib import sha1
+from pykafka import KafkaClient
+from pykafka.common import CompressionType, OffsetType
+from pykafka.partitioners import RandomPartitioner, hashing_partitioner
+from pykafka.protocol import PartitionFetchRequest
+
+logger = logging.getLogger('basicLogger')
+
+# Every service has the same copy of this module. A bus gives out:
+# - sync_producer(topic): produce(value, partition_key) returns once the message is stored
+# - producer(topic, ...): produce(value, partition_key) queues the message, get_delivery_report() and
+#   produce_batch() tell when it is stored
+# - consumer(topic, group, ...): consume(), commit(), seek(), lag()
+# - fetch(topic, partition_id, offset): the message at an offset
+# Messages have value, partition_id and offset attributes whatever the backend. Every message of a
+# partition_key goes to the same partition, so a consumer gets them in the order they were produced.
+
+
+def connect(events_config, max_retries, sleep_time):
+    """ Connects to the bus set by events.backend of app_conf, retrying a Kafka connection max_retries times
+
+    kafka connects to events.hostname:events.port, through librdkafka if events.use_rdkafka is set.
+    memory returns the bus held in this process, for development and benchmarks only: it connects
+    the services running in one process and loses its messages when the process exits.
+    """
+    backend = events_config.get('backend', "kafka")
+    if backend == "memory":
+        logger.info("Using the in-memory message bus")
+        return MEMORY_BUS
+    if backend != "kafka":
+        raise ValueError(f"Unknown message bus backend: {backend}")
+
+    hostname = f"{events_config['hostname']}:{events_config['port']}"
+    for attempt in range(max_retries):
+        logger.info("Attempting to connect to Kafka. Attempt #: %s", attempt + 1)
+        try:
+            bus = KafkaBus(hostname, events_config.get('use_rdkafka', False))
+            logger.info("Successfully connected to Kafka on attempt #: %s", attempt + 1)
+            return bus
+        except Exception as e:
+            logger.error("Failed to connect to Kafka on attempt #:%s, error: %s", attempt + 1, e)
+            time.sleep(sleep_time)
+
+    logger.error("Exceeded maximum number of retries (%s) for Kafka connection", max_retries)
+    raise ConnectionError(f"Could not connect to Kafka at {hostname}")
+
+
+def produce_batch(producer, messages, timeout_sec):
+    """ Produces (value, partition_key) messages with a producer() and returns the delivery error (or None) of each """
+    errors = [None] * len(messages)
+    pending = {}
+
+    for position, (msg_bytes, partition_key) in enumerate(messages):
+        try:
+            message = producer.produce(msg_bytes, partition_key=partition_key)
+        except Exception as e:
+            errors[position] = f"Failed to produce reading: {e}"
+            continue
+        pending[id(message)] = (position, message)
+
+    # Delivery reports are queued per producing thread, so any report left over from an
+    # earlier batch that timed out on this thread is skipped
+    deadline = time.time() + timeout_sec
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            message, exc = producer.get_delivery_report(timeout=remaining)
+        except queue.Empty:
+            break
+        delivered = pending.pop(id(message), None)
+        if delivered is not None and exc is not None:
+            errors[delivered[0]] = f"Failed to deliver reading: {exc}"
+
+    for position, _ in pending.values():
+        errors[position] = "Delivery report not received before timeout"
+
+    return errors
+
+
+def run_consumers(consumers, consume):
+    """ Runs consume(consumer) on a thread per consumer, until the first of them returns or raises
+
+    Raises what that consume raised, so a failing worker stops the background process and
+    server.py restarts the service, like a single consumer did.
+    """
+    finished = queue.Queue()
+
+    def run(consumer):
+        try:
+            consume(consumer)
+            finished.put(None)
+        except BaseException as e:
+            finished.put(e)
+
+    for position, consumer in enumerate(consumers):
+        threading.Thread(target=run, args=(consumer,), name=f"{threading.current_thread().name}-consumer-{position}",
+                         daemon=True).start()
+
+    error = finished.get()
+    if error is not None:
+        raise error
+
+
+def partition_by_key(partitions, key=None):
+    """ Partitioner sending every message of a key to the partition its SHA-1 picks, and the others in turn """
+    if key is None:
+        return ROUND_ROBIN_PARTITIONER(partitions, key)
+    return hashing_partitioner(partitions, key)
+
+
+ROUND_ROBIN_PARTITIONER = RandomPartitioner()
+
+
+class KafkaBus:
+    """ Message bus on Kafka, all producers and consumers share one pykafka client """
+
+    def __init__(self, hosts, use_rdkafka=False):
+        self.client = KafkaClient(hosts=hosts)
+        self.use_rdkafka = use_rdkafka
+
+    def topic(self, name):
+        return self.client.topics[name.encode('utf-8')]
+
+    def sync_producer(self, topic):
+        return self.topic(topic).get_sync_producer(partitioner=partition_by_key)
+
+    def producer(self, topic, linger_ms=5000, min_queued_messages=70000, max_queued_messages=100000, compression="none"):
+        """ Producer batching messages by size (min_queued_messages) and time (linger_ms), with delivery reports """
+        return self.topic(topic).get_producer(use_rdkafka=self.use_rdkafka,
+                                              delivery_reports=True,
+                                              partitioner=partition_by_key,
+                                              linger_ms=linger_ms,
+                                              min_queued_messages=min_queued_messages,
+                                              max_queued_messages=max_queued_messages,
+                                              compression=getattr(CompressionType, compression.upper()))
+
+    def consumer(self, topic, group=None, offset_reset="latest", reset_offset_on_start=False, timeout_ms=-1,
+                 balanced=False):
+        """ Consumer of topic, starting after the offsets last committed by group
+
+        Without committed offsets, or with reset_offset_on_start, it starts at the offset_reset end
+        of each partition. consume() waits for up to timeout_ms for a message, forever if it is -1.
+        A balanced consumer joins group, managed by Kafka, and only consumes the partitions the
+        group gives it, so each partition is consumed by one member of the group at a time.
+        """
+        kafka_topic = self.topic(topic)
+        options = dict(auto_offset_reset=OffsetType.LATEST if offset_reset == "latest" else OffsetType.EARLIEST,
+                       reset_offset_on_start=reset_offset_on_start,
+                       consumer_timeout_ms=timeout_ms,
+                       use_rdkafka=self.use_rdkafka)
+        if balanced:
+            consumer = kafka_topic.get_balanced_consumer(group.encode('utf-8'), managed=True,
+                                                         auto_commit_enable=False, **options)
+        else:
+            consumer = kafka_topic.get_simple_consumer(
+                consumer_group=group.encode('utf-8') if group is not None else None, **options)
+        return KafkaConsumer(kafka_topic, consumer)
+
+    def fetch(self, topic, partition_id, offset, max_bytes=1048576, timeout_ms=1000):
+        """ Fetches the message at offset from the partition leader, or returns None if there is none """
+        kafka_topic = self.topic(topic)
+        request = PartitionFetchRequest(kafka_topic.name, partition_id, offset, max_bytes)
+        try:
+            response = kafka_topic.partitions[partition_id].leader.fetch_messages([request], timeout=timeout_ms)
+        except Exception as e:
+            # The leader may have moved, refresh the metadata once and retry on the new one
+            logger.warning("Fetch from partition %d leader failed, refreshing metadata: %s", partition_id, e)
+            self.client.update_cluster()
+            response = kafka_topic.partitions[partition_id].leader.fetch_messages([request], timeout=timeout_ms)
+
+        # A compressed message set is returned whole, so it can start before the offset asked for
+        for message in response.topics[kafka_topic.name][partition_id].messages:
+            if message.offset == offset:
+                return message
+
+        return None
+
+
+class KafkaConsumer:
+    """ A pykafka SimpleConsumer or ManagedBalancedConsumer behind the consumer interface of the bus """
+
+    def __init__(self, topic, consumer):
+        self.topic = topic
+        self.topic_name = topic.name.decode('utf-8')
+        self.consumer = consumer
+
+    def consume(self, block=True):
+        return self.consumer.consume(block=block)
+
+    def commit(self):
+        """ Commits the offsets consumed so far for the consumer group """
+        self.consumer.commit_offsets()
+
+    def seek(self, next_offsets):
+        """ Continues each partition of next_offsets, {partition_id: offset}, from the offset given """
+        # reset_offsets takes the offset consumed last
+        self.consumer.reset_offsets([(self.topic.partitions[partition_id], offset - 1 if offset > 0 else OffsetType.EARLIEST)
+                                     for partition_id, offset in next_offsets.items()
+                                     if partition_id in self.topic.partitions])
+
+    def lag(self):
+        """ Number of messages in the partitions of the consumer not consumed yet """
+        latest_offsets = self.topic.latest_available_offsets()
+        # A held offset below 0 means nothing was consumed from the partition yet, and a balanced
+        # consumer holds no offsets until the group gave it partitions
+        return sum(max(latest_offsets[partition_id].offset[0] - held_offset - 1, 0)
+                   for partition_id, held_offset in (self.consumer.held_offsets or {}).items()
+                   if held_offset >= 0 and partition_id in latest_offsets)
+
+    def stop(self):
+        self.consumer.stop()
+
+
+class MemoryMessage:
+    """ A message of the memory bus, timestamp is when it was produced in milliseconds since the epoch """
+
+    __slots__ = ("value", "partition_key", "partition_id", "offset", "timestamp")
+
+    def __init__(self, value, partition_key, partition_id, offset):
+        self.value = value
+        self.partition_key = partition_key
+        self.partition_id = partition_id
+        self.offset = offset
+        self.timestamp = time.time() * 1000
+
+
+class MemoryTopic:
+    """ A topic held in memory, partitioning messages like partition_by_key """
+
+    def __init__(self, name, partitions):
+        self.name = name
+        self.partitions = {partition_id: [] for partition_id in range(partitions)}
+        self.next_partition = itertools.cycle(range(partitions))
+        # Last offset committed in each partition by every consumer group
+        self.committed = {}
+        # Balanced consumers of every group, and how many times each group was rebalanced
+        self.members = {}
+        self.generations = {}
+        self.condition = threading.Condition()
+
+    def append(self, value, partition_key=None):
+        """ Adds a message to its partition and wakes up the consumers waiting for one """
+        with self.condition:
+            if partition_key is None:
+                partition_id = next(self.next_partition)
+            else:
+                partition_id = int(sha1(partition_key).hexdigest(), 16) % len(self.partitions)
+            partition = self.partitions[partition_id]
+            message = MemoryMessage(value, partition_key, partition_id, len(partition))
+            partition.append(message)
+            self.condition.notify_all()
+        return message
+
+    def join(self, group, consumer):
+        """ Adds a balanced consumer to group, which then shares out the partitions again """
+        with self.condition:
+            self.members.setdefault(group, []).append(consumer)
+            self.generations[group] = self.generations.get(group, 0) + 1
+
+    def leave(self, group, consumer):
+        with self.condition:
+            self.members[group].remove(consumer)
+            self.generations[group] += 1
+
+    def assignment(self, group, consumer):
+        """ Partitions of a balanced consumer, every member of its group getting the same share give or take one """
+        members = self.members[group]
+        return list(self.partitions)[members.index(consumer)::len(members)]
+
+
+class MemoryBus:
+    """ Message bus held in memory, shared by the services of one process through MEMORY_BUS """
+
+    def __init__(self, partitions=1):
+        self.partitions = partitions
+        self.topics = {}
+        self.lock = threading.Lock()
+
+    def topic(self, name):
+        with self.lock:
+            if name not in self.topics:
+                self.topics[name] = MemoryTopic(name, self.partitions)
+            return self.topics[name]
+
+    def sync_producer(self, topic):
+        return MemoryProducer(self.topic(topic), delivery_reports=False)
+
+    def producer(self, topic, **options):
+        """ Producer storing every message as soon as it is produced, the batching options do not apply """
+        return MemoryProducer(self.topic(topic), delivery_reports=True)
+
+    def consumer(self, topic, group=None, offset_reset="latest", reset_offset_on_start=False, timeout_ms=-1,
+                 balanced=False):
+        return MemoryConsumer(self.topic(topic), group, offset_reset, reset_offset_on_start, timeout_ms, balanced)
+
+    def fetch(self, topic, partition_id, offset, **options):
+        memory_topic = self.topic(topic)
+        with memory_topic.condition:
+            partition = memory_topic.partitions.get(partition_id, [])
+            return partition[offset] if 0 <= offset < len(partition) else None
+
+
+class MemoryProducer:
+    """ Producer of the memory bus """
+
+    def __init__(self, topic, delivery_reports):
+        self.topic = topic
+        self.delivery_reports = delivery_reports
+        # Delivery reports are queued per producing thread, like pykafka's
+        self.reports = threading.local()
+
+    def report_queue(self):
+        if not hasattr(self.reports, "queue"):
+            self.reports.queue = queue.Queue()
+        return self.reports.queue
+
+    def produce(self, message, partition_key=None):
+        produced = self.topic.append(message, partition_key)
+        if self.delivery_reports:
+            self.report_queue().put((produced, None))
+        return produced
+
+    def get_delivery_report(self, block=True, timeout=None):
+        """ Returns (message, exception) of a produced message, raises queue.Empty if there is none """
+        return self.report_queue().get(block, timeout)
+
+    def stop(self):
+        pass
+
+
+class MemoryConsumer:
+    """ Consumer of the memory bus, reading its partitions in turn like pykafka's consumers
+
+    A balanced consumer reads the partitions its group gives it, taking them over from the
+    offsets the group last committed whenever a member joins or leaves.
+    """
+
+    def __init__(self, topic, group, offset_reset, reset_offset_on_start, timeout_ms, balanced):
+        self.topic = topic
+        self.topic_name = topic.name
+        self.group = group
+        self.offset_reset = offset_reset
+        self.reset_offset_on_start = reset_offset_on_start
+        self.timeout_sec = None if timeout_ms < 0 else timeout_ms / 1000
+        self.balanced = balanced
+
+        # Last offset consumed in each partition of the consumer, -1 before the first one
+        self.held_offsets = {}
+        self.generation = None
+        with topic.condition:
+            if balanced:
+                topic.join(group, self)
+            self.rebalance()
+
+    def rebalance(self):
+        """ Starts reading the partitions given to the consumer since it last looked, called holding the condition """
+        if self.balanced:
+            generation = self.topic.generations[self.group]
+            if generation == self.generation:
+                return
+            self.generation = generation
+            partition_ids = self.topic.assignment(self.group, self)
+        elif self.generation is None:
+            self.generation = 0
+            partition_ids = list(self.topic.partitions)
+        else:
+            return
+
+        committed = self.topic.committed.get(self.group, {})
+        held_offsets = {}
+        for partition_id in partition_ids:
+            if partition_id in self.held_offsets:
+                held_offsets[partition_id] = self.held_offsets[partition_id]
+            elif partition_id in committed and not self.reset_offset_on_start:
+                held_offsets[partition_id] = committed[partition_id]
+            elif self.offset_reset == "latest":
+                held_offsets[partition_id] = len(self.topic.partitions[partition_id]) - 1
+            else:
+                held_offsets[partition_id] = -1
+        self.held_offsets = held_offsets
+        self.next_partition = itertools.cycle(partition_ids)
+
+    def next_message(self):
+        """ The next unconsumed message of the partitions, taken in turn, or None if all are consumed """
+        self.rebalance()
+        for _ in range(len(self.held_offsets)):
+            partition_id = next(self.next_partition)
+            offset = self.held_offsets[partition_id] + 1
+            partition = self.topic.partitions[partition_id]
+            if offset < len(partition):
+                self.held_offsets[partition_id] = offset
+                return partition[offset]
+        return None
+
+    def consume(self, block=True):
+        """ Returns the next message, waiting for up to timeout_ms for one if block is set """
+        deadline = None if self.timeout_sec is None else time.time() + self.timeout_sec
+
+        with self.topic.condition:
+            message = self.next_message()
+            while message is None and block:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.topic.condition.wait(remaining)
+                message = self.next_message()
+
+        return message
+
+    def commit(self):
+        if self.group is None:
+            return
+        with self.topic.condition:
+            # Like Kafka, the offsets of partitions given to another member since are not committed
+            self.rebalance()
+            self.topic.committed.setdefault(self.group, {}).update(self.held_offsets)
+
+    def seek(self, next_offsets):
+        with self.topic.condition:
+            self.rebalance()
+            for partition_id, offset in next_offsets.items():
+                if partition_id in self.held_offsets:
+                    self.held_offsets[partition_id] = offset - 1
+
+    def lag(self):
+        with self.topic.condition:
+            self.rebalance()
+            return sum(len(self.topic.partitions[partition_id]) - held_offset - 1
+                       for partition_id, held_offset in self.held_offsets.items())
+
+    def stop(self):
+        if self.balanced:
+            self.topic.leave(self.group, self)
+
+
+MEMORY_BUS = MemoryBus()
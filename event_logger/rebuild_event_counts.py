@@ -0,0 +1,38 @@
+""" Backfills the event_counts table from the rows already in Statistics
+
+Run once with the event_logger stopped, it loads the counters into memory when it starts.
+"""
+import sqlite3
+import yaml
+import os
+
+# The same configuration file as app.py
+if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
+    app_conf_file = "/config/app_conf.yml"
+else:
+    app_conf_file = "app_conf.yml"
+
+# Load the app_conf.yml configuration
+with open(app_conf_file, 'r') as f:
+    app_config = yaml.safe_load(f.read())
+
+conn = sqlite3.connect(app_config['datastore']['filename'])
+
+c = conn.cursor()
+c.execute('''
+          CREATE TABLE IF NOT EXISTS event_counts
+          (`code` TEXT PRIMARY KEY,
+           `count` INTEGER NOT NULL)
+          ''')
+c.execute('DELETE FROM event_counts')
+c.execute('''
+          INSERT INTO event_counts (code, count)
+          SELECT code, COUNT(*) FROM Statistics GROUP BY code
+          ''')
+
+conn.commit()
+
+for code, count in c.execute('SELECT code, count FROM event_counts ORDER BY code'):
+    print(f"{code}: {count}")
+
+conn.close()
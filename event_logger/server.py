@@ -0,0 +1,86 @@
+""" Production entry point: serves the API from server.workers uvicorn worker processes
+
+The Kafka consumer runs exactly once, in a background process of its own, instead of
+once per worker. python3 app.py still runs everything in one process for development.
+"""
+import multiprocessing
+import logging
+import logging.config
+import signal
+import sys
+import threading
+import shutil
+import uvicorn
+import yaml
+import os
+
+if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
+    app_conf_file = "/config/app_conf.yml"
+    log_conf_file = "/config/log_conf.yml"
+else:
+    app_conf_file = "app_conf.yml"
+    log_conf_file = "log_conf.yml"
+
+with open(app_conf_file, 'r') as f:
+    app_config = yaml.safe_load(f.read())
+
+with open(log_conf_file, 'r') as f:
+    log_config = yaml.safe_load(f.read())
+    logging.config.dictConfig(log_config)
+
+logger = logging.getLogger('basicLogger')
+
+
+def run_background():
+    """ Runs the event log consumer of app.py, exiting cleanly on SIGTERM """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    import app
+    app.run_background()
+
+
+def watch_background(background, stopping):
+    """ Shuts the server down if the background process dies, so the container is restarted """
+    background.join()
+    if not stopping.is_set():
+        logger.error("Background process exited with code %s, shutting down", background.exitcode)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+def prepare_metrics_dir():
+    """ Empties the directory every process writes its metrics samples to, and points them at it """
+    directory = app_config['metrics']['multiproc_dir']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = directory
+
+
+def main():
+    prepare_metrics_dir()
+
+    # The tables are created here, once, before the workers and the background process start.
+    # Imported once the metrics directory is set, they import their own copy
+    import app
+    app.create_tables()
+
+    stopping = threading.Event()
+    background = multiprocessing.get_context("spawn").Process(target=run_background, name="background")
+    background.start()
+    threading.Thread(target=watch_background, args=(background, stopping), daemon=True).start()
+
+    try:
+        uvicorn.run("app:app", host="0.0.0.0", port=app_config['server']['port'],
+                    workers=app_config['server']['workers'],
+                    timeout_graceful_shutdown=app_config['server']['shutdown_timeout_sec'])
+    finally:
+        stopping.set()
+        background.terminate()
+        background.join(app_config['server']['shutdown_timeout_sec'])
+        if background.is_alive():
+            logger.warning("Background process did not stop within %s seconds, killing it",
+                           app_config['server']['shutdown_timeout_sec'])
+            background.kill()
+
+
+if __name__ == "__main__":
+    main()
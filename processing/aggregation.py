@@ -0,0 +1,139 @@
+import io
+import numpy as np
+
+PERCENTILES = [50, 95, 99]
+
+# Columns of the power usage records summarized for the fleet and for each group
+POWER_USAGE_COLUMNS = ["power_W", "temperature_C", "state_of_charge"]
+
+
+def load_records(body):
+    """ Reads the consecutive .npy structured arrays sent by storage into one record array """
+    buffer = io.BytesIO(body)
+    chunks = []
+    while buffer.tell() < len(body):
+        chunks.append(np.load(buffer, allow_pickle=False))
+
+    if not chunks:
+        return None
+
+    return np.concatenate(chunks)
+
+
+def summarize(values):
+    """ Summary statistics of one column """
+    percentiles = np.percentile(values, PERCENTILES)
+
+    summary = {
+        "max": float(values.max()),
+        "min": float(values.min()),
+        "mean": float(values.mean()),
+        "stddev": float(values.std()),
+        "sum": float(values.sum())
+    }
+    for percentile, value in zip(PERCENTILES, percentiles):
+        summary[f"p{percentile}"] = float(value)
+
+    return summary
+
+
+def group_by(records, key):
+    """ Count, max, mean and stddev of each column for every distinct value of key """
+    keys, inverse, counts = np.unique(records[key], return_inverse=True, return_counts=True)
+
+    # Sorting by group lets every max be computed with a single reduceat over contiguous slices
+    order = np.argsort(inverse, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    columns = {}
+    for column in POWER_USAGE_COLUMNS:
+        values = records[column].astype(np.float64)
+        sums = np.bincount(inverse, weights=values, minlength=len(keys))
+        squares = np.bincount(inverse, weights=values * values, minlength=len(keys))
+        means = sums / counts
+        columns[column] = {
+            "max": np.maximum.reduceat(values[order], starts),
+            "mean": means,
+            "stddev": np.sqrt(np.maximum(squares / counts - means * means, 0))
+        }
+
+    groups = {}
+    for position, group_key in enumerate(keys):
+        group = {"count": int(counts[position])}
+        for column, aggregates in columns.items():
+            group[column] = {name: float(values[position]) for name, values in aggregates.items()}
+        groups[group_key.decode('utf-8')] = group
+
+    return groups
+
+
+def aggregate_power_usage(records):
+    """ Fleet wide summaries plus per device_type and per device breakdowns of power usage records """
+    aggregates = {"count": len(records)}
+    for column in POWER_USAGE_COLUMNS:
+        aggregates[column] = summarize(records[column])
+
+    aggregates["by_device_type"] = group_by(records, "device_type")
+    aggregates["by_device"] = group_by(records, "device_id")
+
+    return aggregates
+
+
+# numpy datetime units the rollup buckets are truncated to
+BUCKET_UNITS = {"minute": "m", "hour": "h", "day": "D"}
+
+# Record column each rollup scope is grouped by
+ROLLUP_SCOPES = {"device": "device_id", "device_type": "device_type"}
+
+
+def key_text(key):
+    """ A group key as text, the keys of bytes columns are decoded """
+    return key.decode('utf-8') if isinstance(key, bytes) else key
+
+
+def rollup_rows(records):
+    """ Rollup table rows of power usage records for every scope and bucket size
+
+    The device_id and device_type columns are either bytes or object columns of str.
+    """
+    rows = []
+    power = records["power_W"].astype(np.float64)
+    temperature = records["temperature_C"].astype(np.float64)
+    soc = records["state_of_charge"].astype(np.float64)
+
+    for scope, key in ROLLUP_SCOPES.items():
+        keys, key_index = np.unique(records[key], return_inverse=True)
+
+        for bucket_size, unit in BUCKET_UNITS.items():
+            buckets, bucket_index = np.unique(records["date_created"].astype(f"M8[{unit}]"), return_inverse=True)
+
+            # One group id per (key, bucket) pair
+            groups, inverse, counts = np.unique(key_index * len(buckets) + bucket_index,
+                                                return_inverse=True, return_counts=True)
+            order = np.argsort(inverse, kind="stable")
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+            sum_power = np.bincount(inverse, weights=power)
+            max_power = np.maximum.reduceat(power[order], starts)
+            sum_temperature = np.bincount(inverse, weights=temperature)
+            max_temperature = np.maximum.reduceat(temperature[order], starts)
+            sum_soc = np.bincount(inverse, weights=soc)
+            min_soc = np.minimum.reduceat(soc[order], starts)
+
+            bucket_starts = buckets.astype("M8[s]").astype(object)
+            for position, group in enumerate(groups.tolist()):
+                rows.append({
+                    "bucket_size": bucket_size,
+                    "scope": scope,
+                    "group_key": key_text(keys[group // len(buckets)]),
+                    "bucket_start": bucket_starts[group % len(buckets)],
+                    "count": int(counts[position]),
+                    "sum_power_W": float(sum_power[position]),
+                    "max_power_W": float(max_power[position]),
+                    "sum_temperature_C": float(sum_temperature[position]),
+                    "max_temperature_C": float(max_temperature[position]),
+                    "sum_state_of_charge": float(sum_soc[position]),
+                    "min_state_of_charge": float(min_soc[position])
+                })
+
+    return rows
@@ -1,29 +1,38 @@
 import connexion
 from connexion import NoContent
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, delete, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker
 from base import Base
 from stats import Statistics
+from rollup import Rollup
+from running_stats import RunningStats
+from event_stream import Broadcaster, EventStreamMiddleware
+from metrics import (RequestMetricsMiddleware, ConsumerLag, KAFKA_PRODUCED, KAFKA_CONSUMED,
+                     DB_COMMIT_SECONDS, DB_QUERY_SECONDS, BATCH_SIZE)
+from flask import request
+from connexion.jsonifier import JSONEncoder
+from werkzeug.http import http_date
+import hashlib
+import aggregation
+import numpy as np
 import datetime
 import requests
 from apscheduler.schedulers.background import BackgroundScheduler
 import yaml
 import logging
 import logging.config
-import numpy as np
-import copy
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 import os
 import json
-from pykafka import KafkaClient
+import message_bus
+import wire_format
+from contextlib import asynccontextmanager
+from threading import Thread
 import time
 
 
-if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
-    CORS(app.app)
-    app.app.config['CORS_HEADERS'] = 'Content-Type'
-
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
     app_conf_file = "/config/app_conf.yaml"
@@ -50,14 +59,30 @@ logger.info("Log Conf File: %s" % log_conf_file)
 
 # Create the database connection
 DB_ENGINE = create_engine(f"sqlite:///{app_config['datastore']['filename']}")
-Base.metadata.create_all(DB_ENGINE)
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
 
-def publish_event_to_event_log(client, code, message, event_type):
-    event_log_topic = client.topics[str.encode(app_config['events']['startup_topic'])]
-    event_log_producer = event_log_topic.get_sync_producer()
+def create_tables():
+    """ Creates the tables that do not exist yet
+
+    server.py calls it once before it starts the workers and the background process, which would
+    otherwise race to create them in a new database file.
+    """
+    Base.metadata.create_all(DB_ENGINE)
+
+# Detailed aggregates of the last window processed by populate_stats, also saved to stats.window_file
+# for the HTTP workers of server.py
+latest_window = None
+
+# Running statistics of push mode, only set in the process consuming the events topic. It saves
+# them to stats.running_file every stream.publish_sec for the HTTP workers of server.py
+running_stats = None
+
+
+def publish_event_to_event_log(bus, code, message, event_type):
+    event_log_topic = app_config['events']['startup_topic']
+    event_log_producer = bus.sync_producer(event_log_topic)
 
     
     event_msg = {
@@ -70,34 +95,90 @@ def publish_event_to_event_log(client, code, message, event_type):
     }
     
     event_log_producer.produce(json.dumps(event_msg).encode('utf-8'))
-    logger.info(f"Published message to Kafka topic '{event_log_topic}' with code {code}")
+    KAFKA_PRODUCED.labels(app_config['events']['startup_topic']).inc()
+    logger.info("Published message to Kafka topic '%s' with code %s", event_log_topic, code)
 
 
-def get_stats():
-    # get the latest row of stats from the database and return it as a dictionary
-    session = DB_SESSION()
-    stats = session.query(Statistics).order_by(Statistics.date_created.desc()).first()
+# Pushes each new statistics snapshot to the dashboard's /stats/stream subscribers
+stats_stream = Broadcaster()
 
-    if stats is not None:
-        results = stats.to_dict()
-        logger.info("Query for statistics successful")
-    else:
-        results = {}
+
+# Latest statistics row as served by /stats with its ETag, replaced whenever populate_stats writes one
+cached_stats = None
+
+
+def cache_stats(snapshot):
+    """ Makes snapshot the cached /stats response, tagged with a hash of its content """
+    global cached_stats
+
+    body = json.dumps(snapshot, cls=JSONEncoder, sort_keys=True)
+    cached_stats = (snapshot, hashlib.sha1(body.encode('utf-8')).hexdigest())
+
+
+def current_stats():
+    """ Returns the latest statistics and their ETag, or ({}, None) if there are none yet """
+    # in push mode the consuming process keeps the statistics in memory, fresher than the last checkpoint
+    if running_stats is not None:
+        cache_stats(running_stats.to_dict())
+
+    # only read from the database until populate_stats has written a row
+    elif cached_stats is None:
+        session = DB_SESSION()
+        stats = session.query(Statistics).order_by(Statistics.date_created.desc()).first()
+        if stats is not None:
+            cache_stats(stats.to_dict())
+        session.close()
+
+        if stats is None:
+            return {}, None
+
+    return cached_stats
+
+
+def get_stats():
+    results, etag = current_stats()
+    if etag is None:
         logger.error("No statistics found")
+        return results, 200
 
-    return results, 200
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={app_config['stats_cache']['max_age_sec']}"
+    }
+    if results.get('date_created') is not None:
+        headers["Last-Modified"] = http_date(results['date_created'].timestamp())
+
+    if request.if_none_match.contains(etag):
+        logger.debug("Statistics not modified since %s", etag)
+        return NoContent, 304, headers
+
+    logger.info("Query for statistics successful")
+    return results, 200, headers
+
+
+def fetch_records(url, start_timestamp, end_timestamp):
+    """ Gets the readings created in a time window from storage as a NumPy record array """
+    response = requests.get(url,
+                            params={'start_timestamp': start_timestamp, 'end_timestamp': end_timestamp},
+                            headers={'Accept': 'application/x-numpy-records'})
+    response.raise_for_status()
+
+    return aggregation.load_records(response.content)
 
 
 def populate_stats():
     """ Periodically update stats """
+    global latest_window
+
     # 1. Log an INFO message indicating periodic processing has started
     logger.info("Start Periodic Processing")
     logger.info("ASSIGNMENT2+1 Electric Boogaloo")
-    
+
     # 2. Read in the current statistics from the SQLite database (filename defined in your configuration)
     try:
         session = DB_SESSION()
-        stats = session.query(Statistics).order_by(Statistics.date_created.desc()).first()
+        with DB_QUERY_SECONDS.labels("latest_statistics").time():
+            stats = session.query(Statistics).order_by(Statistics.date_created.desc()).first()
         session.close()
     except Exception as e:
         logger.error(f"Exception during database access: {e}")
@@ -107,58 +188,54 @@ def populate_stats():
     if stats is None:
         logger.info("Stats table empty, adding default row now.")
         stats = Statistics(datetime.datetime.now(), 0, 0, 0, 0, 0)
-    
+
     # 3. Get the current datetime
     current_datetime = datetime.datetime.now()
+    start_timestamp = stats.date_created.strftime("%Y-%m-%dT%H:%M:%S")
+    end_timestamp = current_datetime.strftime("%Y-%m-%dT%H:%M:%S")
+
+    # 4. Get all new events since the last statistics from the Data Store Service as columnar records
     try:
-        # 4. Query the two GET endpoints from your Data Store Service (using requests.get) to get all new events from the last datetime you requested them (from your statistics) to the current datetime
-        new_power_usage_events = requests.get(app_config['power-usage']['url'], 
-                                            params={'start_timestamp': stats.date_created.strftime("%Y-%m-%dT%H:%M:%S"), 'end_timestamp': current_datetime.strftime("%Y-%m-%dT%H:%M:%S")})
-        new_location_events = requests.get(app_config['location']['url'], 
-                                        params={'start_timestamp': stats.date_created.strftime("%Y-%m-%dT%H:%M:%S"), 'end_timestamp': current_datetime.strftime("%Y-%m-%dT%H:%M:%S")})
+        power_usage_records = fetch_records(app_config['power-usage']['url'], start_timestamp, end_timestamp)
+        location_records = fetch_records(app_config['location']['url'], start_timestamp, end_timestamp)
     except Exception as e:
+        # 4.2. Log an ERROR message if the events could not be retrieved
         logger.error(f"Unable to GET request from Storage: {e}")
+        return NoContent, 404
+
+    num_power_usage_events = 0 if power_usage_records is None else len(power_usage_records)
+    num_location_events = 0 if location_records is None else len(location_records)
 
     # 4.1. Log an INFO message with the number of events received
-    logger.info(f"Received {len(new_power_usage_events.json())} power usage and {len(new_location_events.json())} location events")
+    logger.info("Received %d power usage and %d location events", num_power_usage_events, num_location_events)
 
-    # 4.2. Log an ERROR message if you did not get a 200 response code
-    if new_power_usage_events.status_code != 200 or new_location_events.status_code != 200:
-        logger.error("Failed to get events from Data Store Service")
-        return NoContent, 404
-    
-    messages_processed = len(new_power_usage_events.json()) + len(new_location_events.json())
+    messages_processed = num_power_usage_events + num_location_events
+    BATCH_SIZE.labels("window_events").observe(messages_processed)
     if messages_processed > app_config['message_threshold']:
-        publish_event_to_event_log(client, "0004", f"Processed more than {app_config['message_threshold']} messages.", "large_processor_event")
+        publish_event_to_event_log(bus, "0004", f"Processed more than {app_config['message_threshold']} messages.", "large_processor_event")
 
     # 5. Based on the new events from the Data Store Service:
-    try:
-        # 5.1. Calculate your updated statistics
-        if len(new_power_usage_events.json()) > 0:
-            sum_of_soc_readings = 0
-
-            for event in new_power_usage_events.json():
-                if event['power_data']['power_W'] > stats.max_power_W:
-                    stats.max_power_W = event['power_data']['power_W']
-
-                if event['power_data']['temperature_C'] > stats.max_temperature_C:
-                    stats.max_temperature_C = event['power_data']['temperature_C']
+    # 5.1. Calculate your updated statistics over the whole window at once
+    if num_power_usage_events > 0:
+        window = aggregation.aggregate_power_usage(power_usage_records)
 
-                sum_of_soc_readings += event['power_data']['state_of_charge_%']
+        stats.max_power_W = max(float(stats.max_power_W), window['power_W']['max'])
+        stats.max_temperature_C = max(float(stats.max_temperature_C), window['temperature_C']['max'])
+        stats.average_state_of_charge = ((float(stats.average_state_of_charge) * stats.total_power_usage_events) +
+                                         window['state_of_charge']['sum'])/(stats.total_power_usage_events + num_power_usage_events)
+        stats.total_power_usage_events += num_power_usage_events
 
-                # 5.2. Log a DEBUG message for each event processed that includes the trace_id 
-                logger.debug(f"event with trace_id {event['trace_id']} has been processed.")
+        window['start_timestamp'] = start_timestamp
+        window['end_timestamp'] = end_timestamp
+        latest_window = window
+        save_window(window)
 
-            stats.average_state_of_charge = ((stats.average_state_of_charge * stats.total_power_usage_events) + 
-                                            sum_of_soc_readings)/(stats.total_power_usage_events + len(new_power_usage_events.json()))
-            
-            stats.total_power_usage_events += len(new_power_usage_events.json())
-            if len(new_location_events.json()) > 0:
-                stats.total_location_events += len(new_location_events.json())
-    except Exception as e:
-        logger.error(f"Step 5: {e}")
+        try:
+            update_rollups(power_usage_records)
+        except Exception as e:
+            logger.error(f"Exception while updating rollups: {e}")
 
-    
+    stats.total_location_events += num_location_events
 
     # 5.3. Write the updated statistics to the SQLite database file (filename defined in your configuration)
     try:
@@ -173,31 +250,331 @@ def populate_stats():
             stats.total_location_events
         )
 
+        # Read before the commit expires the row's attributes
+        snapshot = updated_stats.to_dict()
         session.add(updated_stats)
-        session.commit()
+        with DB_COMMIT_SECONDS.labels("statistics").time():
+            session.commit()
         session.close()
     except Exception as e:
         logger.error(f"Exception during database access: {e}")
         return NoContent, 500
-    
+
+    cache_stats(snapshot)
+    stats_stream.publish(snapshot)
+
     # 5.4. Log a DEBUG message with your updated statistics values
-    logger.debug(f"The updated statistics is as follows: \
-                 Max Power (W)={stats.max_power_W}, \
-                 Max Temperature (C)={stats.max_temperature_C}, \
-                 Average State of Charge (%)={stats.average_state_of_charge}, \
-                 Total Location Events Processed={stats.total_location_events}, \
-                 Total Power Usage Events Processed={stats.total_power_usage_events}.")
+    logger.debug("The updated statistics is as follows: "
+                 "Max Power (W)=%s, Max Temperature (C)=%s, Average State of Charge (%%)=%s, "
+                 "Total Location Events Processed=%s, Total Power Usage Events Processed=%s.",
+                 stats.max_power_W, stats.max_temperature_C, stats.average_state_of_charge,
+                 stats.total_location_events, stats.total_power_usage_events)
     # 6. Log an INFO message indicating period processing has ended
     logger.info("The period processing has ended.")
 
 
+def get_window_stats():
+    """ Returns the detailed aggregates of the latest window of power usage events """
+    if latest_window is None:
+        logger.error("No window statistics found")
+        return {"message": "No window statistics yet"}, 404
+
+    return latest_window, 200
+
+
+def save_window(window):
+    """ Writes the latest window to stats.window_file, replacing the previous one atomically """
+    temp_file = app_config['stats']['window_file'] + ".tmp"
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(window, f)
+        os.replace(temp_file, app_config['stats']['window_file'])
+    except Exception as e:
+        logger.error(f"Exception while saving window statistics: {e}")
+
+
+def save_running_stats(snapshot):
+    """ Writes the running statistics to stats.running_file, replacing the previous ones atomically """
+    temp_file = app_config['stats']['running_file'] + ".tmp"
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(dict(snapshot, date_created=snapshot['date_created'].isoformat()), f)
+        os.replace(temp_file, app_config['stats']['running_file'])
+    except Exception as e:
+        logger.error(f"Exception while saving running statistics: {e}")
+
+
+def refresh_stats():
+    """ Reloads the cached statistics and window when the background process writes new ones
+
+    Checks the latest Statistics id, or the running statistics file's mtime in push mode, and the
+    window file's mtime every stream.publish_sec, so /stats and /stats/window are served from
+    memory in every HTTP worker.
+    """
+    global latest_window
+
+    last_id = None
+    last_running_mtime = None
+    last_window_mtime = None
+
+    while True:
+        try:
+            # In push mode the running statistics are fresher than the last checkpoint
+            if running_stats is None and app_config['stats']['mode'] == "push":
+                if os.path.exists(app_config['stats']['running_file']):
+                    running_mtime = os.stat(app_config['stats']['running_file']).st_mtime
+                    if running_mtime != last_running_mtime:
+                        with open(app_config['stats']['running_file'], 'r') as f:
+                            snapshot = json.load(f)
+                        snapshot['date_created'] = datetime.datetime.fromisoformat(snapshot['date_created'])
+                        cache_stats(snapshot)
+                        stats_stream.publish(snapshot)
+                        last_running_mtime = running_mtime
+
+            elif running_stats is None:
+                session = DB_SESSION()
+                latest_id = session.scalar(select(func.max(Statistics.id)))
+                if latest_id is not None and latest_id != last_id:
+                    stats = session.get(Statistics, latest_id)
+                    cache_stats(stats.to_dict())
+                    stats_stream.publish(cached_stats[0])
+                    last_id = latest_id
+                session.close()
+
+            if os.path.exists(app_config['stats']['window_file']):
+                window_mtime = os.stat(app_config['stats']['window_file']).st_mtime
+                if window_mtime != last_window_mtime:
+                    with open(app_config['stats']['window_file'], 'r') as f:
+                        latest_window = json.load(f)
+                    last_window_mtime = window_mtime
+        except Exception as e:
+            logger.error(f"Exception while refreshing statistics: {e}")
+
+        time.sleep(app_config['stream']['publish_sec'])
+
+
+def update_rollups(records):
+    """ Merges the per device and per device_type buckets of power usage records into the rollups table """
+    rows = aggregation.rollup_rows(records)
+
+    stmt = sqlite_insert(Rollup)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["bucket_size", "scope", "group_key", "bucket_start"],
+        set_={
+            "count": Rollup.count + stmt.excluded["count"],
+            "sum_power_W": Rollup.sum_power_W + stmt.excluded.sum_power_W,
+            "max_power_W": func.max(Rollup.max_power_W, stmt.excluded.max_power_W),
+            "sum_temperature_C": Rollup.sum_temperature_C + stmt.excluded.sum_temperature_C,
+            "max_temperature_C": func.max(Rollup.max_temperature_C, stmt.excluded.max_temperature_C),
+            "sum_state_of_charge": Rollup.sum_state_of_charge + stmt.excluded.sum_state_of_charge,
+            "min_state_of_charge": func.min(Rollup.min_state_of_charge, stmt.excluded.min_state_of_charge)
+        })
+
+    with DB_COMMIT_SECONDS.labels("rollups").time(), DB_ENGINE.begin() as connection:
+        connection.execute(stmt, rows)
+
+    logger.debug("Updated %d rollup buckets", len(rows))
+
+
+def get_device_rollups(device_id, bucket, start_timestamp, end_timestamp):
+    """ Returns the rollup time series of one device """
+    return get_rollups("device", device_id, bucket, start_timestamp, end_timestamp)
+
+
+def get_device_type_rollups(device_type, bucket, start_timestamp, end_timestamp):
+    """ Returns the rollup time series of one device type """
+    return get_rollups("device_type", device_type, bucket, start_timestamp, end_timestamp)
+
+
+def get_rollups(scope, group_key, bucket, start_timestamp, end_timestamp):
+    """ Returns the rollup buckets of a device or device type in a time range """
+    try:
+        start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S")
+        end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S")
+    except ValueError as e:
+        logger.error(f"Invalid rollups time range: {e}")
+        return {"message": "Invalid timestamp, expected YYYY-MM-DDTHH:MM:SS"}, 400
+
+    session = DB_SESSION()
+    with DB_QUERY_SECONDS.labels("rollups").time():
+        rollups = session.scalars(select(Rollup).where(Rollup.bucket_size == bucket,
+                                                       Rollup.scope == scope,
+                                                       Rollup.group_key == group_key,
+                                                       Rollup.bucket_start >= start_timestamp_datetime,
+                                                       Rollup.bucket_start < end_timestamp_datetime)
+                                                .order_by(Rollup.bucket_start))
+        results = [rollup.to_dict() for rollup in rollups]
+    session.close()
+
+    logger.info("Query for %s %s rollups of %s returns %d buckets", bucket, scope, group_key, len(results))
+
+    return results, 200
+
+
+def compact_history():
+    """ Downsamples old Statistics rows and deletes expired rollup buckets """
+    now = datetime.datetime.now()
+    hourly_cutoff = now - datetime.timedelta(hours=app_config['retention']['statistics_raw_hours'])
+    daily_cutoff = now - datetime.timedelta(days=app_config['retention']['statistics_hourly_days'])
+
+    with DB_ENGINE.begin() as connection:
+        # Statistics rows are cumulative, so keeping the last row of each hour (or day) loses nothing but resolution
+        for cutoff, bucket_format in [(hourly_cutoff, "%Y-%m-%d %H"), (daily_cutoff, "%Y-%m-%d")]:
+            last_in_bucket = (select(func.max(Statistics.id))
+                              .where(Statistics.date_created < cutoff)
+                              .group_by(func.strftime(bucket_format, Statistics.date_created)))
+            deleted = connection.execute(delete(Statistics).where(Statistics.date_created < cutoff,
+                                                                  Statistics.id.not_in(last_in_bucket)))
+            logger.info("Compacted %d statistics rows older than %s", deleted.rowcount, cutoff)
+
+        for bucket_size, days in app_config['retention']['rollup_days'].items():
+            cutoff = now - datetime.timedelta(days=days)
+            deleted = connection.execute(delete(Rollup).where(Rollup.bucket_size == bucket_size,
+                                                              Rollup.bucket_start < cutoff))
+            logger.info("Deleted %d %s rollup buckets older than %s", deleted.rowcount, bucket_size, cutoff)
+
+
+def load_latest_stats():
+    """ Reads the latest statistics row, or default values if none exist yet """
+    session = DB_SESSION()
+    stats = session.query(Statistics).order_by(Statistics.date_created.desc()).first()
+    session.close()
+
+    if stats is None:
+        logger.info("Stats table empty, starting from default values.")
+        stats = Statistics(datetime.datetime.now(), 0, 0, 0, 0, 0)
+
+    return stats
+
+
+def fold_event(event, pending_rollup_events):
+    """ Folds an event message into the running statistics and queues a power usage event for the rollups
+
+    Raises KeyError, TypeError or ValueError for a malformed event before changing either.
+    """
+    if event['type'] == "power_usage":
+        payload = event['payload']
+        power_data = payload['power_data']
+        rollup_event = (str(payload['device_id']), str(payload['device_type']), event['datetime'],
+                        float(power_data['power_W']), float(power_data['state_of_charge_%']),
+                        float(power_data['temperature_C']))
+        # Checked here, as checkpoint_stats converts a whole checkpoint's events at once
+        np.datetime64(event['datetime'], 's')
+        running_stats.update(event['type'], payload)
+        pending_rollup_events.append(rollup_event)
+    else:
+        running_stats.update(event['type'], event['payload'])
+
+
+def consume_events(bus):
+    """ Updates the running statistics from the events topic and checkpoints them to the database """
+    # Offsets are committed together with the checkpoint, so a restart resumes from the stats it last saved
+    consumer = bus.consumer(app_config['events']['topic'], group="processing_group", offset_reset="latest",
+                            timeout_ms=app_config['stats']['checkpoint_sec'] * 1000)
+
+    next_checkpoint = time.time() + app_config['stats']['checkpoint_sec']
+    next_publish = time.time() + app_config['stream']['publish_sec']
+    # Power usage events since the last checkpoint, rolled up when it is written
+    pending_rollup_events = []
+    consumed = KAFKA_CONSUMED.labels(app_config['events']['topic'])
+    lag = ConsumerLag([consumer], app_config['metrics']['lag_interval_sec'])
+
+    try:
+        while True:
+            msg = consumer.consume()
+            lag.update()
+            if msg is not None:
+                consumed.inc()
+                try:
+                    fold_event(wire_format.decode(msg.value), pending_rollup_events)
+                except (ValueError, KeyError, TypeError) as e:
+                    # Committed past with the next checkpoint like any other consumed message
+                    logger.error("Skipping event message that cannot be processed at offset %d of partition %d: %s",
+                                 msg.offset, msg.partition_id, e)
+
+            # The running statistics change with every event, subscribers get them at most every publish_sec
+            if time.time() >= next_publish:
+                snapshot = running_stats.to_dict()
+                stats_stream.publish(snapshot)
+                save_running_stats(snapshot)
+                next_publish = time.time() + app_config['stream']['publish_sec']
+
+            if time.time() >= next_checkpoint:
+                if checkpoint_stats(consumer, pending_rollup_events):
+                    pending_rollup_events = []
+                next_checkpoint = time.time() + app_config['stats']['checkpoint_sec']
+    finally:
+        # Checkpoint what was consumed since the last checkpoint when the process is stopped
+        checkpoint_stats(consumer, pending_rollup_events)
+
+
+def checkpoint_stats(consumer, rollup_events):
+    """ Writes the running statistics and rollups to the database, then commits the consumed offsets """
+    updated_stats = running_stats.checkpoint()
+    if updated_stats is None:
+        return True
+
+    try:
+        session = DB_SESSION()
+        session.add(updated_stats)
+        with DB_COMMIT_SECONDS.labels("statistics").time():
+            session.commit()
+        session.close()
+
+        if rollup_events:
+            BATCH_SIZE.labels("checkpoint_events").observe(len(rollup_events))
+            # Object columns keep the keys whole, however long and in whatever script
+            update_rollups(np.array(rollup_events, dtype=[("device_id", "O"), ("device_type", "O"),
+                                                          ("date_created", "M8[s]"), ("power_W", "f8"),
+                                                          ("state_of_charge", "f8"), ("temperature_C", "f8")]))
+    except Exception as e:
+        logger.error(f"Exception during database access: {e}")
+        # keep the values pending so the next checkpoint writes them
+        running_stats.changed = True
+        return False
+
+    consumer.commit()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Checkpointed running statistics: %s", running_stats.to_dict())
+    return True
+
+
 def init_scheduler():
     sched = BackgroundScheduler(daemon=True)
-    sched.add_job(populate_stats, 'interval', seconds=app_config['scheduler']['period_sec'])
+    if app_config['stats']['mode'] != "push":
+        sched.add_job(populate_stats, 'interval', seconds=app_config['scheduler']['period_sec'])
+    sched.add_job(compact_history, 'interval', seconds=app_config['retention']['period_sec'])
     sched.start()
 
 
-app = connexion.FlaskApp(__name__, specification_dir='')
+def run_background():
+    """ Connects to the message bus and runs the statistics consumer and scheduler, once however many HTTP workers serve the API """
+    global bus, running_stats
+
+    bus = message_bus.connect(app_config['events'], app_config['max_retries'], app_config['sleep_time'])
+    publish_event_to_event_log(bus, "0003", "Processor successfully started.", "processor_startup")
+
+    init_scheduler()
+
+    if app_config['stats']['mode'] == "push":
+        running_stats = RunningStats(load_latest_stats())
+        consume_events(bus)
+    else:
+        # populate_stats and compact_history run on the scheduler's thread
+        while True:
+            time.sleep(60)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """ Starts reloading the statistics written by the background process when a worker starts """
+    t1 = Thread(target=refresh_stats)
+    t1.daemon = True
+    t1.start()
+    yield
+
+
+app = connexion.FlaskApp(__name__, specification_dir='', lifespan=lifespan)
 app.add_api("openapi.yaml", base_path="/processing", strict_validation=True, validate_responses=True)
 
 app.add_middleware(
@@ -208,24 +585,21 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    EventStreamMiddleware,
+    position=MiddlewarePosition.BEFORE_SWAGGER,
+    path="/processing/stats/stream",
+    broadcaster=stats_stream,
+    keepalive_sec=app_config['stream']['keepalive_sec'],
+)
+# Inside the stream middleware, so the open streams are not timed as requests
+app.add_middleware(RequestMetricsMiddleware, position=MiddlewarePosition.BEFORE_SWAGGER)
 
 if __name__ == "__main__":
-    retry_count = 0
-    # Initialize KafkaClient with your Kafka server details
-    while (retry_count < app_config['max_retries']):
-        logger.info("Attempting to connect to Kafka. Attempt #: %s", retry_count + 1)
-        try:
-            client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
-            break
-        except Exception as e:
-            logger.error("Failed to connect to Kafka on attempt #:%s, error: %s", retry_count + 1, e)
-            time.sleep(app_config['sleep_time'])
-            retry_count += 1
-    else:
-        logger.error("Exceeded maximum number of retries (%s) for Kafka connection", app_config['max_retries'])
-
-    publish_event_to_event_log(client, "0003", "Processor successfully started.", "processor_startup")
-
-    init_scheduler()
-    app.run(host='0.0.0.0', port=8100)
+    """ Development server, the consumer, scheduler and API share one process """
+    create_tables()
 
+    t1 = Thread(target=run_background)
+    t1.daemon = True
+    t1.start()
+    app.run(host='0.0.0.0', port=app_config['server']['port'])
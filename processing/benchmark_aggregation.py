@@ -0,0 +1,85 @@
+""" Times the window aggregation on synthetic power usage records
+
+Usage: python3 benchmark_aggregation.py [--sizes 10000 100000 1000000 10000000] [--devices 10000]
+
+The per-event Python loop populate_stats used before is timed next to it up to --loop-max events,
+not counting the time it took to build the dicts from the JSON response.
+"""
+import argparse
+import time
+import uuid
+import numpy as np
+import aggregation
+
+DEVICE_TYPES = [b"10k", b"20k", b"30k", b"50k"]
+
+
+def make_records(size, num_devices, rng):
+    """ Builds size synthetic power usage records spread over num_devices devices """
+    device_ids = np.array([str(uuid.UUID(int=int(i))).encode('utf-8') for i in rng.integers(0, 2**63, num_devices)])
+    device_types = np.array(DEVICE_TYPES)[rng.integers(0, len(DEVICE_TYPES), num_devices)]
+    devices = rng.integers(0, num_devices, size)
+
+    records = np.empty(size, dtype=[("device_id", "S36"), ("device_type", "S3"), ("power_W", "f8"),
+                                    ("state_of_charge", "i4"), ("temperature_C", "f8")])
+    records["device_id"] = device_ids[devices]
+    records["device_type"] = device_types[devices]
+    records["power_W"] = rng.uniform(0, 5000, size)
+    records["state_of_charge"] = rng.integers(0, 101, size)
+    records["temperature_C"] = rng.normal(35, 5, size)
+
+    return records
+
+
+def python_loop(events):
+    """ The per-event loop populate_stats ran over the JSON readings """
+    max_power_W = 0
+    max_temperature_C = 0
+    sum_of_soc_readings = 0
+    for event in events:
+        if event['power_data']['power_W'] > max_power_W:
+            max_power_W = event['power_data']['power_W']
+        if event['power_data']['temperature_C'] > max_temperature_C:
+            max_temperature_C = event['power_data']['temperature_C']
+        sum_of_soc_readings += event['power_data']['state_of_charge_%']
+
+    return max_power_W, max_temperature_C, sum_of_soc_readings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the processing window aggregation")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000, 10000000])
+    parser.add_argument("--devices", type=int, default=10000)
+    parser.add_argument("--loop-max", type=int, default=1000000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+
+    # "totals" is the max/max/sum the old loop computed, "full" adds percentiles, stddev and the breakdowns
+    print(f"{'events':>10} {'totals (s)':>11} {'full (s)':>9} {'events/s':>12} {'python loop (s)':>16}")
+    for size in args.sizes:
+        records = make_records(size, args.devices, rng)
+
+        start = time.perf_counter()
+        records["power_W"].max(), records["temperature_C"].max(), records["state_of_charge"].sum()
+        totals = time.perf_counter() - start
+
+        start = time.perf_counter()
+        aggregation.aggregate_power_usage(records)
+        full = time.perf_counter() - start
+
+        loop = ""
+        if size <= args.loop_max:
+            events = [{"power_data": {"power_W": p, "temperature_C": t, "state_of_charge_%": s}}
+                      for p, t, s in zip(records["power_W"].tolist(),
+                                         records["temperature_C"].tolist(),
+                                         records["state_of_charge"].tolist())]
+            start = time.perf_counter()
+            python_loop(events)
+            loop = f"{time.perf_counter() - start:.3f}"
+
+        print(f"{size:>10} {totals:>11.4f} {full:>9.3f} {size / full:>12.0f} {loop:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -19,5 +19,22 @@ c.execute('''
            `total_location_events` INTEGER NOT NULL)
           ''')
 
+c.execute('''
+          CREATE TABLE rollups
+          (`id` INTEGER PRIMARY KEY ASC, 
+           `bucket_size` VARCHAR(10) NOT NULL,
+           `scope` VARCHAR(20) NOT NULL,
+           `group_key` VARCHAR(250) NOT NULL,
+           `bucket_start` VARCHAR(100) NOT NULL,
+           `count` INTEGER NOT NULL,
+           `sum_power_W` FLOAT NOT NULL,
+           `max_power_W` FLOAT NOT NULL,
+           `sum_temperature_C` FLOAT NOT NULL,
+           `max_temperature_C` FLOAT NOT NULL,
+           `sum_state_of_charge` FLOAT NOT NULL,
+           `min_state_of_charge` FLOAT NOT NULL,
+           CONSTRAINT uq_rollups_bucket UNIQUE (`bucket_size`, `scope`, `group_key`, `bucket_start`))
+          ''')
+
 conn.commit()
 conn.close()
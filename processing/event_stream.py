@@ -0,0 +1,96 @@
+import asyncio
+import json
+import threading
+from connexion.jsonifier import JSONEncoder
+
+
+class Broadcaster:
+    """ Latest snapshot of a stats endpoint, pushed to every Server-Sent Events subscriber
+
+    A snapshot is serialized once when it is published, however many clients are subscribed.
+    """
+
+    def __init__(self):
+        """ Initializes a broadcaster with no snapshot and no subscribers """
+        self.lock = threading.Lock()
+        self.message = None
+        self.subscribers = set()
+
+    def publish(self, snapshot):
+        """ Serializes snapshot as an SSE message and wakes every subscriber, unless it is unchanged """
+        message = ("data: " + json.dumps(snapshot, cls=JSONEncoder) + "\n\n").encode('utf-8')
+
+        with self.lock:
+            if message == self.message:
+                return
+            self.message = message
+            subscribers = list(self.subscribers)
+
+        # Subscribers wait on the event loop, publish is called from the consumer and scheduler threads
+        for loop, updated in subscribers:
+            loop.call_soon_threadsafe(updated.set)
+
+
+class EventStreamMiddleware:
+    """ ASGI middleware serving a Broadcaster as a text/event-stream response on path
+
+    Subscribers are served on the event loop, so an open stream does not hold one of the
+    worker threads the Flask handlers run on.
+    """
+
+    def __init__(self, app, path, broadcaster, keepalive_sec=15):
+        self.app = app
+        self.path = path
+        self.broadcaster = broadcaster
+        self.keepalive_sec = keepalive_sec
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        loop = asyncio.get_running_loop()
+        updated = asyncio.Event()
+        closed = False
+
+        async def wait_for_disconnect():
+            nonlocal closed
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            closed = True
+            updated.set()
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream"),
+                        (b"cache-control", b"no-cache"),
+                        # Stops nginx from buffering the stream
+                        (b"x-accel-buffering", b"no")]
+        })
+
+        subscriber = (loop, updated)
+        with self.broadcaster.lock:
+            self.broadcaster.subscribers.add(subscriber)
+        disconnect_task = asyncio.create_task(wait_for_disconnect())
+
+        try:
+            sent = None
+            while not closed:
+                updated.clear()
+                message = self.broadcaster.message
+                if message is not None and message is not sent:
+                    await send({"type": "http.response.body", "body": message, "more_body": True})
+                    sent = message
+
+                try:
+                    await asyncio.wait_for(updated.wait(), self.keepalive_sec)
+                except asyncio.TimeoutError:
+                    # A comment line keeps proxies from closing an idle stream
+                    await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+        finally:
+            with self.broadcaster.lock:
+                self.broadcaster.subscribers.discard(subscriber)
+            disconnect_task.cancel()
+
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
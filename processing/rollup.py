@@ -0,0 +1,38 @@
+from sqlalchemy import Column, Integer, String, DateTime, Float, UniqueConstraint
+from base import Base
+
+
+class Rollup(Base):
+    """ Rollup of the power usage events of one device or device type in one time bucket """
+
+    __tablename__ = "rollups"
+    __table_args__ = (
+        UniqueConstraint("bucket_size", "scope", "group_key", "bucket_start", name="uq_rollups_bucket"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    bucket_size = Column(String(10), nullable=False)
+    scope = Column(String(20), nullable=False)
+    group_key = Column(String(250), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    count = Column(Integer, nullable=False)
+    sum_power_W = Column(Float, nullable=False)
+    max_power_W = Column(Float, nullable=False)
+    sum_temperature_C = Column(Float, nullable=False)
+    max_temperature_C = Column(Float, nullable=False)
+    sum_state_of_charge = Column(Float, nullable=False)
+    min_state_of_charge = Column(Float, nullable=False)
+
+    def to_dict(self):
+        """ Dictionary Representation of a rollup bucket """
+        dict = {}
+        dict['bucket_start'] = self.bucket_start
+        dict['count'] = self.count
+        dict['mean_power_W'] = self.sum_power_W / self.count
+        dict['max_power_W'] = self.max_power_W
+        dict['mean_temperature_C'] = self.sum_temperature_C / self.count
+        dict['max_temperature_C'] = self.max_temperature_C
+        dict['mean_state_of_charge'] = self.sum_state_of_charge / self.count
+        dict['min_state_of_charge'] = self.min_state_of_charge
+
+        return dict
@@ -0,0 +1,72 @@
+from stats import Statistics
+import datetime
+import threading
+
+
+class RunningStats:
+    """ Statistics updated in memory one event at a time """
+
+    def __init__(self, stats):
+        """ Initializes the running statistics from the latest Statistics row """
+        self.lock = threading.Lock()
+        self.date_created = stats.date_created
+        self.total_power_usage_events = stats.total_power_usage_events
+        self.max_power_W = float(stats.max_power_W)
+        self.average_state_of_charge = float(stats.average_state_of_charge)
+        self.max_temperature_C = float(stats.max_temperature_C)
+        self.total_location_events = stats.total_location_events
+        self.changed = False
+
+    def update(self, event_type, payload):
+        """ Folds a single power usage or location event into the statistics
+
+        Raises KeyError, TypeError or ValueError for a malformed power usage payload, leaving the statistics unchanged.
+        """
+        if event_type == "power_usage":
+            power_data = payload['power_data']
+            power_W = float(power_data['power_W'])
+            temperature_C = float(power_data['temperature_C'])
+            state_of_charge = float(power_data['state_of_charge_%'])
+
+        with self.lock:
+            if event_type == "power_usage":
+                self.total_power_usage_events += 1
+                self.max_power_W = max(self.max_power_W, power_W)
+                self.max_temperature_C = max(self.max_temperature_C, temperature_C)
+                # Running mean, so the sum of every SoC reading never has to be kept
+                self.average_state_of_charge += ((state_of_charge - self.average_state_of_charge) /
+                                                 self.total_power_usage_events)
+            elif event_type == "location":
+                self.total_location_events += 1
+            else:
+                return
+
+            self.date_created = datetime.datetime.now()
+            self.changed = True
+
+    def checkpoint(self):
+        """ Returns a Statistics row of the current values, or None if nothing changed since the last checkpoint """
+        with self.lock:
+            if not self.changed:
+                return None
+            self.changed = False
+
+            return Statistics(self.date_created,
+                              self.total_power_usage_events,
+                              self.max_power_W,
+                              self.average_state_of_charge,
+                              self.max_temperature_C,
+                              self.total_location_events)
+
+    def to_dict(self):
+        """ Dictionary Representation of the running statistics """
+        with self.lock:
+            dict = {}
+            dict['date_created'] = self.date_created
+            dict['total_power_usage_events'] = self.total_power_usage_events
+            dict['total_location_events'] = self.total_location_events
+            dict['max_power_W'] = self.max_power_W
+            dict['average_state_of_charge'] = self.average_state_of_charge
+            dict['max_temperature_C'] = self.max_temperature_C
+
+            return dict
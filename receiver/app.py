@@ -1,19 +1,29 @@
 import connexion
 from connexion import NoContent
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import VALIDATOR_MAP
 import json
+import orjson
 from datetime import datetime
 import requests
 import yaml
 import logging
 import logging.config
 import uuid
-from pykafka import KafkaClient
+import message_bus
+import wire_format
+from async_producer import AsyncProducer
+from recent_events import RecentEvents, consolidate_snapshots, merge_snapshots, read_snapshot, worker_snapshot, worker_snapshots
+from reading_validator import CompiledJSONRequestBodyValidator, ReadingValidator
+from cached_clock import CachedClock
+from metrics import RequestMetricsMiddleware, KAFKA_PRODUCED, BATCH_SIZE
+from connexion.middleware import MiddlewarePosition
+import queue
+from contextlib import asynccontextmanager
+from threading import Thread
 import time
 import os
 
-MAX_EVENTS = 5
-EVENT_FILE = "events.json"
-
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
     app_conf_file = "/config/app_conf.yml"
@@ -38,12 +48,32 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
+# Load the reading schemas from openapi.yaml, the readings of a batch are validated one by one
+# in the handler against these definitions by validators compiled once at startup
+with open("openapi.yaml", 'r') as f:
+    openapi_spec = yaml.safe_load(f.read())
+
+READING_VALIDATORS = {
+    "power_usage": ReadingValidator(openapi_spec, "PowerUsageReading"),
+    "location": ReadingValidator(openapi_spec, "LocationReading")
+}
+
+# Received datetime of the Kafka messages, formatted once per second instead of once per reading
+CLOCK = CachedClock("%Y-%m-%dT%H:%M:%S")
+
 
-def publish_startup_event(client):
+def encode_event(msg):
+    """ Encodes an event message in events.format, falling back to JSON for a reading its binary schema does not fit """
+    if app_config['events']['format'] == "binary":
+        encoded = wire_format.encode(msg)
+        if encoded is not None:
+            return encoded
+    return orjson.dumps(msg)
+
+
+def publish_startup_event(bus):
     """Publish a startup message to the 'event_log' topic"""
-    event_log_topic = client.topics[str.encode(app_config['events']['startup_topic'])]
-    
-    event_log_producer = event_log_topic.get_sync_producer()
+    event_log_producer = bus.sync_producer(app_config['events']['startup_topic'])
 
     startup_msg = {
         "type": "receiver_startup",
@@ -55,44 +85,63 @@ def publish_startup_event(client):
     }
     
     event_log_producer.produce(json.dumps(startup_msg).encode('utf-8'))
+    KAFKA_PRODUCED.labels(app_config['events']['startup_topic']).inc()
     logger.info("Published startup message to Kafka topic 'event_log'")
 
 
-retry_count = 0
-# Initialize KafkaClient with your Kafka server details
-while (retry_count < app_config['max_retries']):
-    logger.info("Attempting to connect to Kafka. Attempt #: %s", retry_count + 1)
-    try:
-        client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
-        topic = client.topics[str.encode(app_config['events']['topic'])]
-        producer = topic.get_sync_producer()
-        logger.info("Successfully connected to Kafka on attempt #: %s", retry_count + 1)
-        publish_startup_event(client)
-        break
-    except Exception as e:
-        logger.error("Failed to connect to Kafka on attempt #:%s, error: %s", retry_count + 1, e)
-        time.sleep(app_config['sleep_time'])
-        retry_count += 1
-else:
-    logger.error("Exceeded maximum number of retries (%s) for Kafka connection", app_config['max_retries'])
-    
+# Latest readings of each type received by this worker for /recent, snapshotted to disk by
+# persist_recent_events to a file of its own
+EVENT_TYPES = ["power_usage", "location"]
+recent_events = RecentEvents(EVENT_TYPES, app_config['recent']['max_events'])
+recent_snapshot = worker_snapshot(app_config['recent']['filename'], os.getpid())
+
+# Created by connect_producers when a worker starts
+producer = None
+batch_producer = None
+
+
+def connect_producers():
+    """ Connects to the message bus and creates the producers of the readings """
+    global producer, batch_producer
+
+    bus = message_bus.connect(app_config['events'], app_config['max_retries'], app_config['sleep_time'])
+    if app_config['producer']['mode'] == "async":
+        producer = AsyncProducer(bus.producer(app_config['events']['topic'],
+                                              linger_ms=app_config['producer']['linger_ms'],
+                                              min_queued_messages=app_config['producer']['min_queued_messages'],
+                                              max_queued_messages=app_config['producer']['queue_size'],
+                                              compression=app_config['producer']['compression']),
+                                 app_config['producer']['queue_size'])
+    else:
+        producer = bus.sync_producer(app_config['events']['topic'])
+    # Batch endpoints produce asynchronously and wait on the delivery reports for the whole batch
+    batch_producer = bus.producer(app_config['events']['topic'],
+                                  linger_ms=app_config['batch']['linger_ms'],
+                                  min_queued_messages=app_config['batch']['max_items'],
+                                  max_queued_messages=app_config['batch']['max_queued_messages'])
+
 
 #  Your functions here
 def report_power_usage_reading(body):
     body['trace_id'] = str(uuid.uuid4())
     
-    logger.info(f"Received event power-usage request with a trace id of {body['trace_id']}")
+    logger.info("Received event power-usage request with a trace id of %s", body['trace_id'])
 
     # Construct the message
     msg = {
         "type": "power_usage",  # Your event type
-        "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "datetime": CLOCK.now(),
         "payload": body
     }
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
+    try:
+        producer.produce(encode_event(msg), partition_key=body['device_id'].encode('utf-8'))
+    except queue.Full:
+        logger.error("Producer queue full, rejected power-usage event (Id: %s)", body['trace_id'])
+        return {"message": "Receiver is overloaded, retry later"}, 503
 
-    logger.info(f"Produced power-usage event to Kafka (Id: {body['trace_id']})")
+    KAFKA_PRODUCED.labels(app_config['events']['topic']).inc()
+    logger.info("Produced power-usage event to Kafka (Id: %s)", body['trace_id'])
+    recent_events.add("power_usage", [body])
 
     return NoContent, 201
 
@@ -100,56 +149,164 @@ def report_power_usage_reading(body):
 def report_location_reading(body):
     body['trace_id'] = str(uuid.uuid4())
     
-    logger.info(f"Received event location request with a trace id of {body['trace_id']}")
+    logger.info("Received event location request with a trace id of %s", body['trace_id'])
     
     # Construct the message
     msg = {
         "type": "location",  # Your event type
-        "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "datetime": CLOCK.now(),
         "payload": body
     }
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
+    try:
+        producer.produce(encode_event(msg), partition_key=body['device_id'].encode('utf-8'))
+    except queue.Full:
+        logger.error("Producer queue full, rejected location event (Id: %s)", body['trace_id'])
+        return {"message": "Receiver is overloaded, retry later"}, 503
 
-    logger.info(f"Produced location event to Kafka (Id: {body['trace_id']})")
+    KAFKA_PRODUCED.labels(app_config['events']['topic']).inc()
+    logger.info("Produced location event to Kafka (Id: %s)", body['trace_id'])
+    recent_events.add("location", [body])
 
     return NoContent, 201
 
 
-def save_event(event_message, event_type):
-    with open(EVENT_FILE, "r") as json_file:
-        events = json.load(json_file)
+def report_power_usage_batch(body):
+    """ Receives a batch of power usage readings """
+    return report_reading_batch(body, "power_usage")
 
-    events[event_type]["count"] += 1
 
-    # format the event message based on the event type
-    if event_type == "power_usage":
-        formatted_event_message = {
-            "message_data": f"{event_message['device_type']} unit with device id {event_message['device_id']} outputted {event_message['power_data']['power_W']} watts of power and the battery is currently at {event_message['power_data']['state_of_charge_%']}%.",
-            "received_timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-        }
-    elif event_type == "location":
-        formatted_event_message = {
-            "message_data": f"{event_message['device_type']} unit with device id {event_message['device_id']} is currently located at {event_message['location_data']['gps_latitude']}, {event_message['location_data']['gps_longitude']}.",
-            "received_timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+def report_location_batch(body):
+    """ Receives a batch of location readings """
+    return report_reading_batch(body, "location")
+
+
+def report_reading_batch(readings, event_type):
+    """ Validates each reading of a batch and produces the accepted ones to Kafka in one batch """
+    if len(readings) > app_config['batch']['max_items']:
+        return {"message": f"Batch exceeds the maximum of {app_config['batch']['max_items']} readings"}, 400
+
+    validator = READING_VALIDATORS[event_type]
+    received_datetime = CLOCK.now()
+
+    results = []
+    messages = []
+    for index, reading in enumerate(readings):
+        # The spec accepts any item, the reading schemas reject the ones that are not objects
+        error = validator.error(reading)
+        if error is not None:
+            results.append({"index": index, "status": "rejected", "message": error.message})
+            continue
+
+        reading['trace_id'] = str(uuid.uuid4())
+        results.append({"index": index, "status": "accepted", "trace_id": reading['trace_id']})
+
+        msg = {
+            "type": event_type,
+            "datetime": received_datetime,
+            "payload": reading
         }
+        # Keyed by device, so each device's readings stay in order on one partition
+        messages.append((index, encode_event(msg), reading['device_id'].encode('utf-8')))
 
-    # insert the formatted event message at the beginning of the list of recent messages
-    events[event_type]["recent"].insert(0, formatted_event_message)
+    delivery_errors = message_bus.produce_batch(batch_producer,
+                                                [(msg_bytes, partition_key) for _, msg_bytes, partition_key in messages],
+                                                app_config['batch']['delivery_timeout_sec'])
 
-    # check if the number of messages is now exceeding MAX_EVENTS, in which case remove the oldest message
-    if len(events[event_type]["recent"]) > MAX_EVENTS:
-        events[event_type]["recent"].pop()
-    
-    # write the updated events to the file
-    with open(EVENT_FILE, "w") as json_file:
-        json.dump(events, json_file)
+    for (index, _, _), error in zip(messages, delivery_errors):
+        if error is not None:
+            results[index] = {"index": index, "status": "rejected", "message": error}
+
+    recent_events.add(event_type, [readings[result['index']] for result in results if result['status'] == "accepted"])
+
+    accepted = sum(1 for result in results if result['status'] == "accepted")
+    KAFKA_PRODUCED.labels(app_config['events']['topic']).inc(accepted)
+    BATCH_SIZE.labels(f"{event_type}_readings").observe(len(readings))
+
+    logger.info("Produced %d of %d readings from %s batch to Kafka", accepted, len(readings), event_type)
+
+    return {"accepted": accepted, "rejected": len(results) - accepted, "results": results}, 207
+
+
+def get_producer_stats():
+    """ Returns the Kafka producer counters """
+    if app_config['producer']['mode'] == "async":
+        stats = producer.stats()
+    else:
+        stats = {}
+    stats["mode"] = app_config['producer']['mode']
+
+    return stats, 200
+
+
+def get_recent_events():
+    """ Returns the number of readings received and the latest ones of each event type, across every worker
+
+    The readings of the other workers are read from their snapshots, so they show up to
+    recent.snapshot_sec late.
+    """
+    snapshots = [recent_events.to_dict()]
+    for filename in [app_config['recent']['filename']] + worker_snapshots(app_config['recent']['filename']):
+        if filename != recent_snapshot:
+            snapshots.append(read_snapshot(filename))
+
+    return merge_snapshots(snapshots, EVENT_TYPES, app_config['recent']['max_events']), 200
+
+
+def persist_recent_events():
+    """ Periodically snapshots the recent events to disk, off the request path """
+    while True:
+        time.sleep(app_config['recent']['snapshot_sec'])
+        try:
+            recent_events.save(recent_snapshot)
+        except Exception as e:
+            logger.error("Failed to save recent events: %s", e)
+
+
+def stop_producers():
+    """ Sends the messages still queued by the producers and saves the recent events """
+    for name, kafka_producer in (("producer", producer), ("batch producer", batch_producer)):
+        if kafka_producer is None:
+            continue
+        try:
+            kafka_producer.stop()
+        except Exception as e:
+            logger.error("Failed to stop %s: %s", name, e)
+
+    recent_events.save(recent_snapshot)
+    logger.info("Drained producers and saved recent events")
+
+
+def startup():
+    """ Runs once per server before the workers start: merges the recent events of the previous run and announces the receiver """
+    consolidate_snapshots(app_config['recent']['filename'], EVENT_TYPES, app_config['recent']['max_events'])
+    bus = message_bus.connect(app_config['events'], app_config['max_retries'], app_config['sleep_time'])
+    publish_startup_event(bus)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """ Connects the producers and starts the recent events snapshots when a worker starts, drains the producers when it stops """
+    connect_producers()
+    t1 = Thread(target=persist_recent_events)
+    t1.daemon = True
+    t1.start()
+    yield
+    stop_producers()
+
+
+# Request bodies are checked by validators compiled once per operation instead of once per request
+BODY_VALIDATORS = MediaTypeDict(dict(VALIDATOR_MAP["body"], **{"*/*json": CompiledJSONRequestBodyValidator}))
+
+app = connexion.FlaskApp(__name__, specification_dir='', lifespan=lifespan)
+app.add_api("openapi.yaml", base_path="/receiver", strict_validation=True, validate_responses=True,
+            validator_map={"body": BODY_VALIDATORS})
+app.add_middleware(RequestMetricsMiddleware, position=MiddlewarePosition.BEFORE_SWAGGER)
 
 
 def main():
-    app = connexion.FlaskApp(__name__, specification_dir='')
-    app.add_api("openapi.yaml", base_path="/receiver", strict_validation=True, validate_responses=True)
-    app.run(host='0.0.0.0', port=8080)
+    """ Development server, production runs server.py """
+    startup()
+    app.run(host='0.0.0.0', port=app_config['server']['port'])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger('basicLogger')
+
+
+class AsyncProducer:
+    """ Kafka producer that queues messages in memory and sends them in batches from a background thread """
+
+    def __init__(self, producer, queue_size):
+        """ Initializes the producer around a message bus producer() and starts its sender thread """
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.counters = {"queued": 0, "rejected": 0, "delivered": 0, "failed": 0}
+        self.lock = threading.Lock()
+
+        # The bus producer batches by size and time on its own, the bounded queue in front
+        # of it is what gives the request handlers backpressure
+        self.producer = producer
+
+        self.running = True
+        self.thread = threading.Thread(target=self.send_messages, daemon=True)
+        self.thread.start()
+
+    def produce(self, message, partition_key=None):
+        """ Queues a message for sending, raises queue.Full when the queue is at capacity """
+        try:
+            self.queue.put_nowait((message, partition_key))
+        except queue.Full:
+            self.increment("rejected")
+            raise
+        self.increment("queued")
+
+    def send_messages(self):
+        """ Hands queued messages to pykafka and collects their delivery reports """
+        while self.running or not self.queue.empty():
+            try:
+                message, partition_key = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                message = None
+
+            if message is not None:
+                try:
+                    self.producer.produce(message, partition_key=partition_key)
+                except Exception as e:
+                    logger.error("Failed to produce message to Kafka: %s", e)
+                    self.increment("failed")
+
+            # Delivery reports are only readable from the thread that produced the messages
+            self.collect_delivery_reports()
+
+        # Flush what pykafka still holds before the last delivery reports are collected
+        self.producer.stop()
+        self.collect_delivery_reports()
+
+    def collect_delivery_reports(self):
+        """ Updates the delivered and failed counters from the pending delivery reports """
+        while True:
+            try:
+                _, exc = self.producer.get_delivery_report(block=False)
+            except queue.Empty:
+                return
+            if exc is None:
+                self.increment("delivered")
+            else:
+                logger.error("Failed to deliver message to Kafka: %s", exc)
+                self.increment("failed")
+
+    def increment(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        """ Returns the producer counters and the current queue depth """
+        with self.lock:
+            stats = dict(self.counters)
+        stats["queue_depth"] = self.queue.qsize()
+        return stats
+
+    def stop(self):
+        """ Sends everything still queued and stops the producer """
+        self.running = False
+        self.thread.join()
+        logger.info("Stopped async Kafka producer: %s", self.stats())
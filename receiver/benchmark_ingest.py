@@ -0,0 +1,85 @@
+""" Times the CPU the receiver spends per reading on validation, the received timestamp and encoding
+
+Usage: python3 benchmark_ingest.py [--requests 100000]
+
+"before" is what a reading cost until the validators were compiled: Connexion building a
+jsonschema validator for the request body, datetime.now().strftime() and json.dumps().
+Kafka, Connexion's routing and the JSON parsing of the request body are left out, they
+are the same in both.
+"""
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime
+import orjson
+import yaml
+from connexion.json_schema import Draft4RequestValidator
+from jsonschema import Draft4Validator
+from reading_validator import ReadingValidator
+from cached_clock import CachedClock
+
+READINGS = {
+    "PowerUsageReading": ("power_usage", {
+        "device_id": "d290f1ee-6c54-4b01-90e6-d701748f0851",
+        "device_type": "30k",
+        "timestamp": "2024-01-04T09:12:33.001Z",
+        "power_data": {"power_W": 1100.5, "energy_out_Wh": 412.6, "state_of_charge_%": 77, "temperature_C": 34.2}
+    }),
+    "LocationReading": ("location", {
+        "device_id": "d290f1ee-6c54-4b01-90e6-d701748f0851",
+        "device_type": "30k",
+        "timestamp": "2024-01-04T09:12:33.001Z",
+        "location_data": {"gps_latitude": 49.253581, "gps_longitude": -123.001242}
+    })
+}
+
+
+def time_per_request(function, requests):
+    """ CPU microseconds per call of function """
+    start = time.process_time()
+    for _ in range(requests):
+        function()
+    return (time.process_time() - start) / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the receiver's per reading CPU")
+    parser.add_argument("--requests", type=int, default=100000)
+    args = parser.parse_args()
+
+    with open("openapi.yaml", 'r') as f:
+        openapi_spec = yaml.safe_load(f.read())
+
+    clock = CachedClock("%Y-%m-%dT%H:%M:%S")
+
+    print(f"{'schema':>17} {'step':>10} {'before (us)':>12} {'after (us)':>11} {'speedup':>8}")
+    for schema_name, (event_type, reading) in READINGS.items():
+        schema = {"$ref": f"#/components/schemas/{schema_name}", "components": openapi_spec['components']}
+        validator = ReadingValidator(openapi_spec, schema_name)
+        msg = {"type": event_type, "datetime": clock.now(), "payload": dict(reading, trace_id=str(uuid.uuid4()))}
+
+        steps = {
+            # Connexion creates the validator again on every request
+            "validate": (lambda: Draft4RequestValidator(schema, format_checker=Draft4Validator.FORMAT_CHECKER).validate(reading),
+                         lambda: validator.error(reading)),
+            "timestamp": (lambda: datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+                          clock.now),
+            "encode": (lambda: json.dumps(msg).encode('utf-8'),
+                       lambda: orjson.dumps(msg))
+        }
+
+        total_before = 0
+        total_after = 0
+        for step, (before, after) in steps.items():
+            before_us = time_per_request(before, args.requests)
+            after_us = time_per_request(after, args.requests)
+            total_before += before_us
+            total_after += after_us
+            print(f"{schema_name:>17} {step:>10} {before_us:>12.2f} {after_us:>11.2f} {before_us / after_us:>7.1f}x")
+
+        print(f"{schema_name:>17} {'total':>10} {total_before:>12.2f} {total_after:>11.2f} {total_before / total_after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import time
+from datetime import datetime
+
+
+class CachedClock:
+    """ The local time formatted with a strftime format, formatted at most once per second
+
+    The formatted second is swapped in as one tuple, so request threads can read it without a lock.
+    """
+
+    def __init__(self, time_format):
+        """ Initializes a clock formatting the time with time_format, which must not go below seconds """
+        self.time_format = time_format
+        self.current = (None, None)
+
+    def now(self):
+        """ Returns the current second formatted """
+        second = int(time.time())
+        current = self.current
+        if current[0] != second:
+            current = (second, datetime.fromtimestamp(second).strftime(self.time_format))
+            self.current = current
+        return current[1]
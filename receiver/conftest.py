@@ -0,0 +1,41 @@
+import os
+import shutil
+import sys
+
+import pytest
+import yaml
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """ app.py imported with the memory bus and its files in a temporary directory """
+    directory = tmp_path_factory.mktemp("receiver")
+    for name in ["app_conf.yml", "log_conf.yml", "openapi.yaml"]:
+        shutil.copy(os.path.join(SERVICE_DIR, name), directory)
+
+    with open(directory / "app_conf.yml", 'r') as f:
+        app_config = yaml.safe_load(f.read())
+    app_config["events"]["backend"] = "memory"
+    app_config["batch"]["max_items"] = 4
+    app_config["batch"]["delivery_timeout_sec"] = 1
+    app_config["recent"]["filename"] = str(directory / "events.json")
+    with open(directory / "app_conf.yml", 'w') as f:
+        yaml.safe_dump(app_config, f)
+
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        import app
+        yield app
+    finally:
+        os.chdir(cwd)
+        sys.modules.pop("app", None)
+
+
+@pytest.fixture(scope="session")
+def client(app_module):
+    """ Test client of the receiver, its lifespan connects the producers to the memory bus """
+    with app_module.app.test_client() as client:
+        yield client
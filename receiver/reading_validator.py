@@ -0,0 +1,83 @@
+import fastjsonschema
+from fastjsonschema import JsonSchemaValueException
+from connexion.validators import JSONRequestBodyValidator
+from jsonschema import Draft4Validator
+from jsonschema.exceptions import best_match
+
+# jsonschema's draft 4 format checker, which Connexion uses, does not check these formats
+# either, so both validators accept the same readings
+UNCHECKED_FORMATS = {name: lambda value: True for name in ["uuid", "date-time", "float", "double", "integer"]}
+
+
+def without_examples(schema):
+    """ Copy of schema without its example annotations
+
+    YAML loads the timestamp examples as datetimes, which the compiled code cannot embed.
+    """
+    if isinstance(schema, dict):
+        return {key: without_examples(value) for key, value in schema.items() if key != "example"}
+    if isinstance(schema, list):
+        return [without_examples(value) for value in schema]
+    return schema
+
+
+class SchemaValidator:
+    """ Validates values against a JSON schema with a validator compiled to Python code once
+
+    A valid value costs one call of the compiled function. Only an invalid value goes through
+    the jsonschema validator Connexion uses, so the error messages are the same as before.
+    """
+
+    def __init__(self, schema):
+        """ Compiles the validator of schema, whose $refs point into the components it embeds """
+        compiled_schema = dict(without_examples(schema), **{"$schema": "http://json-schema.org/draft-04/schema#"})
+        self.compiled = fastjsonschema.compile(compiled_schema, formats=UNCHECKED_FORMATS)
+        self.validator = Draft4Validator(schema, format_checker=Draft4Validator.FORMAT_CHECKER)
+
+    def is_valid(self, value):
+        """ Whether value is valid, checked by the compiled validator alone """
+        try:
+            self.compiled(value)
+            return True
+        except JsonSchemaValueException:
+            return False
+
+    def error(self, value):
+        """ Returns the ValidationError that best describes why value is invalid, or None if it is valid """
+        if self.is_valid(value):
+            return None
+        return best_match(self.validator.iter_errors(value))
+
+
+class ReadingValidator(SchemaValidator):
+    """ Validates readings against a schema of openapi.yaml, such as the items of a batch """
+
+    def __init__(self, openapi_spec, schema_name):
+        """ Compiles the validator of components/schemas/schema_name """
+        super().__init__({
+            "$ref": f"#/components/schemas/{schema_name}",
+            "components": openapi_spec['components']
+        })
+
+
+class CompiledJSONRequestBodyValidator(JSONRequestBodyValidator):
+    """ Connexion's JSON request body validator, checking the bodies with a SchemaValidator compiled once per operation
+
+    Connexion creates the body validator on every request, and it builds a jsonschema validator
+    for each body it checks. The body schema of an operation is the same object on every request,
+    so its SchemaValidator is compiled on the operation's first request and reused. An invalid
+    body still goes through Connexion's validation, so the 400 responses do not change.
+    """
+
+    # (schema, SchemaValidator) of each body schema by id, holding the schema keeps its id unique
+    schema_validators = {}
+
+    def _validate(self, body):
+        entry = self.schema_validators.get(id(self._schema))
+        if entry is None:
+            entry = (self._schema, SchemaValidator(self._schema))
+            self.schema_validators[id(self._schema)] = entry
+
+        if entry[1].is_valid(body):
+            return None
+        return super()._validate(body)
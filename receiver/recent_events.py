@@ -0,0 +1,123 @@
+from collections import deque
+from datetime import datetime
+import glob
+import json
+import os
+import threading
+
+
+def format_event(event_type, reading):
+    """ One line summary of a power usage or location reading """
+    if event_type == "power_usage":
+        return f"{reading['device_type']} unit with device id {reading['device_id']} outputted {reading['power_data']['power_W']} watts of power and the battery is currently at {reading['power_data']['state_of_charge_%']}%."
+    return f"{reading['device_type']} unit with device id {reading['device_id']} is currently located at {reading['location_data']['gps_latitude']}, {reading['location_data']['gps_longitude']}."
+
+
+class RecentEvents:
+    """ Count and fixed-size ring buffer of the latest readings of each event type, shared by the request threads
+
+    Readings are only formatted when the buffers are read or snapshotted, so recording one on the
+    request path is an append under a lock.
+    """
+
+    def __init__(self, event_types, max_events):
+        """ Initializes empty buffers holding max_events readings per event type """
+        self.lock = threading.Lock()
+        self.recent = {event_type: deque(maxlen=max_events) for event_type in event_types}
+        self.counts = {event_type: 0 for event_type in event_types}
+        self.changed = False
+
+    def add(self, event_type, readings):
+        """ Records readings of event_type received now, dropping the oldest ones past max_events """
+        received_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        with self.lock:
+            self.counts[event_type] += len(readings)
+            self.recent[event_type].extend((reading, received_timestamp) for reading in readings)
+            self.changed = True
+
+    def to_dict(self):
+        """ Dictionary Representation of the counts and recent readings, newest first """
+        with self.lock:
+            recent = {event_type: list(buffer) for event_type, buffer in self.recent.items()}
+            counts = dict(self.counts)
+
+        events = {}
+        for event_type, buffer in recent.items():
+            events[event_type] = {
+                "count": counts[event_type],
+                "recent": [{"message_data": format_event(event_type, reading),
+                            "received_timestamp": received_timestamp}
+                           for reading, received_timestamp in reversed(buffer)]
+            }
+
+        return events
+
+    def save(self, filename):
+        """ Writes a snapshot to filename if anything was recorded since the last one, replacing it atomically """
+        with self.lock:
+            if not self.changed:
+                return False
+            self.changed = False
+
+        temp_file = filename + ".tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(temp_file, filename)
+
+        return True
+
+
+# Every worker of server.py snapshots its own readings to worker_snapshot(filename, pid), /recent
+# merges them with filename, which holds the readings of the previous runs of the server
+
+
+def worker_snapshot(filename, pid):
+    """ The snapshot file of the worker process pid, events.json becoming events.<pid>.json """
+    root, extension = os.path.splitext(filename)
+    return f"{root}.{pid}{extension}"
+
+
+def worker_snapshots(filename):
+    """ The snapshot files of every worker, running or stopped, since the server started """
+    root, extension = os.path.splitext(filename)
+    return glob.glob(f"{glob.escape(root)}.*[0-9]{glob.escape(extension)}")
+
+
+def read_snapshot(filename):
+    """ The events of a snapshot written by RecentEvents.save(), empty if there is none """
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def merge_snapshots(snapshots, event_types, max_events):
+    """ Sums the counts of snapshots and keeps the newest max_events readings of each event type """
+    events = {}
+    for event_type in event_types:
+        parts = [snapshot[event_type] for snapshot in snapshots if event_type in snapshot]
+        recent = sorted((message for part in parts for message in part["recent"]),
+                        key=lambda message: message["received_timestamp"], reverse=True)
+        events[event_type] = {"count": sum(part["count"] for part in parts), "recent": recent[:max_events]}
+
+    return events
+
+
+def consolidate_snapshots(filename, event_types, max_events):
+    """ Merges the snapshots of the workers of the previous run into filename and deletes them
+
+    Run once per server, before its workers start, so none of them writes its snapshot meanwhile.
+    """
+    snapshots = worker_snapshots(filename)
+    if not snapshots:
+        return
+
+    events = merge_snapshots([read_snapshot(snapshot) for snapshot in [filename] + snapshots], event_types, max_events)
+    temp_file = filename + ".tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(events, f)
+    os.replace(temp_file, filename)
+
+    for snapshot in snapshots:
+        os.remove(snapshot)
@@ -0,0 +1,42 @@
+""" Production entry point: serves the API from server.workers uvicorn worker processes
+
+Each worker has its own Kafka producers, drained by the lifespan hook of app.py when the
+worker stops. The startup event is published once, by this process before the workers start.
+python3 app.py runs a single process for development.
+"""
+import shutil
+import uvicorn
+import yaml
+import os
+
+if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
+    app_conf_file = "/config/app_conf.yml"
+else:
+    app_conf_file = "app_conf.yml"
+
+with open(app_conf_file, 'r') as f:
+    app_config = yaml.safe_load(f.read())
+
+
+def prepare_metrics_dir():
+    """ Empties the directory every process writes its metrics samples to, and points them at it """
+    directory = app_config['metrics']['multiproc_dir']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = directory
+
+
+def main():
+    prepare_metrics_dir()
+
+    # Imported once the metrics directory is set, the workers import their own copy
+    import app
+    app.startup()
+
+    uvicorn.run("app:app", host="0.0.0.0", port=app_config['server']['port'],
+                workers=app_config['server']['workers'],
+                timeout_graceful_shutdown=app_config['server']['shutdown_timeout_sec'])
+
+
+if __name__ == "__main__":
+    main()
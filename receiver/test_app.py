@@ -0,0 +1,101 @@
+import uuid
+
+import message_bus
+import wire_format
+
+
+def power_usage_reading(device_id=None):
+    """ A valid power usage reading of a device """
+    return {
+        "device_id": device_id or str(uuid.uuid4()),
+        "device_type": "30k",
+        "timestamp": "2024-01-04T09:12:33.001Z",
+        "power_data": {"power_W": 1100.5, "energy_out_Wh": 412.6, "state_of_charge_%": 77, "temperature_C": 34.2}
+    }
+
+
+class FailingDeliveryProducer(message_bus.MemoryProducer):
+    """ Memory producer whose delivery reports fail for the readings of one device """
+
+    def __init__(self, topic, failing_key):
+        super().__init__(topic, delivery_reports=True)
+        self.failing_key = failing_key
+
+    def get_delivery_report(self, block=True, timeout=None):
+        message, exc = super().get_delivery_report(block, timeout)
+        if message.partition_key == self.failing_key:
+            exc = ConnectionError("broker unavailable")
+        return message, exc
+
+
+def produced_since(app_module, start):
+    """ The event messages produced to the events topic since it held start messages """
+    topic = message_bus.MEMORY_BUS.topic(app_module.app_config["events"]["topic"])
+    return [wire_format.decode(message.value) for message in topic.partitions[0][start:]]
+
+
+def events_produced(app_module):
+    """ The number of messages produced to the events topic so far """
+    return len(message_bus.MEMORY_BUS.topic(app_module.app_config["events"]["topic"]).partitions[0])
+
+
+def test_batch_reports_status_of_each_reading(app_module, client):
+    valid = [power_usage_reading(), power_usage_reading()]
+    missing_power_data = {key: value for key, value in power_usage_reading().items() if key != "power_data"}
+    start = events_produced(app_module)
+
+    response = client.post("/receiver/readings/power-usage:batch",
+                           json=[valid[0], missing_power_data, "not a reading", valid[1]])
+
+    assert response.status_code == 207
+    body = response.json()
+    assert (body["accepted"], body["rejected"]) == (2, 2)
+    assert [(result["index"], result["status"]) for result in body["results"]] == [
+        (0, "accepted"), (1, "rejected"), (2, "rejected"), (3, "accepted")]
+    assert "power_data" in body["results"][1]["message"]
+    assert "message" in body["results"][2]
+
+    # Only the accepted readings are produced, in order and with their trace ids
+    produced = produced_since(app_module, start)
+    assert [event["payload"]["device_id"] for event in produced] == [reading["device_id"] for reading in valid]
+    assert [event["payload"]["trace_id"] for event in produced] == [body["results"][0]["trace_id"],
+                                                                     body["results"][3]["trace_id"]]
+
+
+def test_batch_of_non_objects_is_rejected_item_by_item(app_module, client):
+    start = events_produced(app_module)
+
+    response = client.post("/receiver/readings/location:batch", json=[None, 1, [], "reading"])
+
+    assert response.status_code == 207
+    body = response.json()
+    assert (body["accepted"], body["rejected"]) == (0, 4)
+    assert [result["status"] for result in body["results"]] == ["rejected"] * 4
+    assert produced_since(app_module, start) == []
+
+
+def test_batch_over_max_items_is_rejected(app_module, client):
+    start = events_produced(app_module)
+
+    response = client.post("/receiver/readings/power-usage:batch",
+                           json=[power_usage_reading() for _ in range(app_module.app_config["batch"]["max_items"] + 1)])
+
+    assert response.status_code == 400
+    assert produced_since(app_module, start) == []
+
+
+def test_delivery_errors_reject_their_reading(app_module, client, monkeypatch):
+    failing = power_usage_reading()
+    topic = message_bus.MEMORY_BUS.topic(app_module.app_config["events"]["topic"])
+    monkeypatch.setattr(app_module, "batch_producer",
+                        FailingDeliveryProducer(topic, failing["device_id"].encode('utf-8')))
+
+    response = client.post("/receiver/readings/power-usage:batch",
+                           json=[power_usage_reading(), "not a reading", failing, power_usage_reading()])
+
+    assert response.status_code == 207
+    body = response.json()
+    assert (body["accepted"], body["rejected"]) == (2, 2)
+    assert [result["status"] for result in body["results"]] == ["accepted", "rejected", "rejected", "accepted"]
+    assert body["results"][2] == {"index": 2, "status": "rejected",
+                                  "message": "Failed to deliver reading: broker unavailable"}
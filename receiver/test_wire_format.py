@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+import wire_format
+
+POWER_USAGE = {
+    "type": "power_usage",
+    "datetime": "2024-01-01T00:00:00",
+    "payload": {
+        "device_id": "d290f1ee-6c54-4b01-90e6-d701748f0851",
+        "device_type": "30k",
+        "timestamp": "2024-01-04T09:12:33.001Z",
+        "power_data": {"power_W": 1100.5, "energy_out_Wh": 412.6, "state_of_charge_%": 77,
+                       "temperature_C": 34.2},
+        "trace_id": "9b7f6f42-44a2-4f0e-a0a4-6a7c1d1f2b1e"
+    }
+}
+
+LOCATION = {
+    "type": "location",
+    "datetime": "2024-01-01T00:00:00",
+    "payload": {
+        "device_id": "d290f1ee-6c54-4b01-90e6-d701748f0851",
+        "device_type": "30k",
+        "timestamp": "2024-01-04T09:12:33.001Z",
+        "location_data": {"gps_latitude": 49.253581, "gps_longitude": -123.001242},
+        "trace_id": "9b7f6f42-44a2-4f0e-a0a4-6a7c1d1f2b1e"
+    }
+}
+
+
+@pytest.mark.parametrize("message", [POWER_USAGE, LOCATION])
+def test_binary_round_trip(message):
+    encoded = wire_format.encode(message)
+
+    assert encoded[:1] == wire_format.MAGIC
+    assert wire_format.decode(encoded) == message
+    assert wire_format.message_type(encoded) == message["type"]
+
+
+def test_integer_fields_stay_integers():
+    decoded = wire_format.decode(wire_format.encode(POWER_USAGE))
+    state_of_charge = decoded["payload"]["power_data"]["state_of_charge_%"]
+
+    assert state_of_charge == 77
+    assert type(state_of_charge) is int
+
+
+def test_fractional_integer_field_is_not_encoded():
+    fractional = dict(POWER_USAGE, payload=dict(POWER_USAGE["payload"], power_data=dict(
+        POWER_USAGE["payload"]["power_data"], **{"state_of_charge_%": 77.5})))
+
+    assert wire_format.encode(fractional) is None
+
+
+def test_version_1_messages_still_decode():
+    encoded = wire_format.LAYOUTS[(1, 1)].encode(POWER_USAGE)
+    decoded = wire_format.decode(encoded)
+
+    # Version 1 encoded the state of charge as a float
+    assert decoded["payload"]["power_data"]["state_of_charge_%"] == 77.0
+    assert type(decoded["payload"]["power_data"]["state_of_charge_%"]) is float
+    assert decoded["payload"]["trace_id"] == POWER_USAGE["payload"]["trace_id"]
+
+
+def test_json_messages_still_decode():
+    value = json.dumps(POWER_USAGE).encode('utf-8')
+
+    assert wire_format.decode(value) == POWER_USAGE
+    assert wire_format.message_type(value) == "power_usage"
+
+
+def test_readings_that_do_not_fit_are_not_encoded():
+    extra_property = dict(POWER_USAGE, payload=dict(POWER_USAGE["payload"], note="extra"))
+    nul_in_string = dict(POWER_USAGE, payload=dict(POWER_USAGE["payload"], device_type="30k\x00"))
+
+    assert wire_format.encode(extra_property) is None
+    assert wire_format.encode(nul_in_string) is None
+    assert wire_format.encode({"type": "receiver_startup", "payload": {}}) is None
+
+
+def test_unknown_version_is_rejected():
+    encoded = bytearray(wire_format.encode(POWER_USAGE))
+    encoded[1] = wire_format.VERSION + 1
+
+    with pytest.raises(ValueError, match="version"):
+        wire_format.decode(bytes(encoded))
+    with pytest.raises(ValueError, match="version"):
+        wire_format.message_type(bytes(encoded))
+
+
+def test_unknown_type_is_rejected():
+    encoded = bytearray(wire_format.encode(LOCATION))
+    encoded[2] = 255
+
+    with pytest.raises(ValueError):
+        wire_format.decode(bytes(encoded))
+
+
+@pytest.mark.parametrize("length", [1, 2, 10])
+def test_truncated_message_is_rejected(length):
+    with pytest.raises(ValueError):
+        wire_format.decode(wire_format.encode(POWER_USAGE)[:length])
+
+
+def test_missing_string_is_rejected():
+    encoded = wire_format.encode(LOCATION)
+
+    with pytest.raises(ValueError):
+        wire_format.decode(encoded[:encoded.rindex(b"\x00")])
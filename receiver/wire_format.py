@@ -0,0 +1,210 @@
+import json
+import struct
+from operator import itemgetter
+
+# Every service reading or writing the events topic has the same copy of this module.
+# An event message is either the JSON envelope {"type", "datetime", "payload"} or its binary
+# encoding: MAGIC, the version of the format and the id of the event type, then the fields of the
+# type's schema in that version without their names. JSON text never starts with MAGIC, so
+# decode() reads both and a topic can switch format while older messages are still on it.
+
+MAGIC = b"\x00"
+VERSION = 2
+HEADER = struct.Struct("<BBB")
+
+# Every version ever produced, so their messages stay readable once a newer one is added.
+# A version's schemas are never changed, a field is added or removed in a new version.
+# Each field is a dotted path in the message and its kind:
+# - float: 8 byte double, JSON integers come back as floats
+# - int: 8 byte signed integer, a message with any other number there is sent as JSON instead
+# - str: UTF-8 without NUL characters, the strings are stored together after the numbers
+SCHEMAS = {
+    1: {
+        1: ("power_usage", [
+            ("datetime", "str"),
+            ("payload.device_id", "str"),
+            ("payload.device_type", "str"),
+            ("payload.timestamp", "str"),
+            ("payload.power_data.power_W", "float"),
+            ("payload.power_data.energy_out_Wh", "float"),
+            ("payload.power_data.state_of_charge_%", "float"),
+            ("payload.power_data.temperature_C", "float"),
+            ("payload.trace_id", "str")
+        ]),
+        2: ("location", [
+            ("datetime", "str"),
+            ("payload.device_id", "str"),
+            ("payload.device_type", "str"),
+            ("payload.timestamp", "str"),
+            ("payload.location_data.gps_latitude", "float"),
+            ("payload.location_data.gps_longitude", "float"),
+            ("payload.trace_id", "str")
+        ])
+    },
+    # The state of charge is a whole percentage, which version 1 turned into a float
+    2: {
+        1: ("power_usage", [
+            ("datetime", "str"),
+            ("payload.device_id", "str"),
+            ("payload.device_type", "str"),
+            ("payload.timestamp", "str"),
+            ("payload.power_data.power_W", "float"),
+            ("payload.power_data.energy_out_Wh", "float"),
+            ("payload.power_data.state_of_charge_%", "int"),
+            ("payload.power_data.temperature_C", "float"),
+            ("payload.trace_id", "str")
+        ]),
+        2: ("location", [
+            ("datetime", "str"),
+            ("payload.device_id", "str"),
+            ("payload.device_type", "str"),
+            ("payload.timestamp", "str"),
+            ("payload.location_data.gps_latitude", "float"),
+            ("payload.location_data.gps_longitude", "float"),
+            ("payload.trace_id", "str")
+        ])
+    }
+}
+
+# struct format character of each kind of number
+NUMBER_FORMATS = {"float": "d", "int": "q"}
+
+
+class Mismatch(Exception):
+    """ Raised while flattening a message that does not fit a layout """
+
+
+def flatten(template, message, values):
+    """ Copies the values of message into values at the indices of its template, which it has to match exactly """
+    if message.__class__ is not dict or len(message) != len(template):
+        raise Mismatch()
+    for key, source in template:
+        try:
+            value = message[key]
+        except KeyError:
+            raise Mismatch()
+        if source.__class__ is int:
+            values[source] = value
+        else:
+            flatten(source, value, values)
+
+
+class Layout:
+    """ The binary layout of one event type in one version: the numbers, then the strings """
+
+    def __init__(self, version, type_id, event_type, fields):
+        self.header = HEADER.pack(MAGIC[0], version, type_id)
+        self.event_type = event_type
+        kinds = [kind for _, kind in fields]
+
+        # Index of each field among the encoded values, the numbers first
+        order = ([position for position, kind in enumerate(kinds) if kind in NUMBER_FORMATS] +
+                 [position for position, kind in enumerate(kinds) if kind == "str"])
+        self.number_count = len(order) - kinds.count("str")
+        self.numbers = struct.Struct("<" + "".join(NUMBER_FORMATS[kinds[position]]
+                                                   for position in order[:self.number_count]))
+        self.size = len(order)
+
+        # The message as a template, [(key, index of its value or template of a nested object)].
+        # The envelope's type is the one part not encoded, it comes after the encoded values
+        self.template = [("type", self.size)]
+        for position, (path, _) in enumerate(fields):
+            template = self.template
+            *parents, key = path.split(".")
+            for parent in parents:
+                nested = next((source for name, source in template if name == parent), None)
+                if nested is None:
+                    nested = []
+                    template.append((parent, nested))
+                template = nested
+            template.append((key, order.index(position)))
+
+        # decode() appends each object to the values once built, the nested ones first, so the
+        # objects containing them pick them up like any other value
+        self.objects = []
+        self.plan(self.template)
+
+    def plan(self, template):
+        """ Adds the objects of a template to the ones decode() builds, returns the index it appends it at """
+        sources = [source if source.__class__ is int else self.plan(source) for _, source in template]
+        getter = itemgetter(*sources) if len(sources) > 1 else lambda values: (values[sources[0]],)
+        self.objects.append((tuple(key for key, _ in template), getter))
+        return self.size + len(self.objects)
+
+    def encode(self, message):
+        """ The encoded message, or None if it does not fit the layout """
+        values = [None] * (self.size + 1)
+        try:
+            flatten(self.template, message, values)
+            numbers = self.numbers.pack(*values[:self.number_count])
+            strings = values[self.number_count:self.size]
+            joined = "\x00".join(strings)
+        except (Mismatch, struct.error, TypeError):
+            return None
+
+        if joined.count("\x00") != len(strings) - 1:
+            return None
+        return b"".join([self.header, numbers, joined.encode('utf-8')])
+
+    def decode(self, value):
+        """ The event message of a binary message of this layout, raises ValueError for a malformed one """
+        try:
+            values = list(self.numbers.unpack_from(value, HEADER.size))
+        except struct.error as e:
+            raise ValueError(f"Truncated binary {self.event_type} message: {e}")
+        if self.size > self.number_count:
+            strings = value[HEADER.size + self.numbers.size:].decode('utf-8').split("\x00")
+            if len(strings) != self.size - self.number_count:
+                raise ValueError(f"Binary {self.event_type} message has {len(strings)} strings "
+                                 f"instead of {self.size - self.number_count}")
+            values.extend(strings)
+        values.append(self.event_type)
+
+        for keys, getter in self.objects:
+            values.append(dict(zip(keys, getter(values))))
+        return values[-1]
+
+
+LAYOUTS = {(version, type_id): Layout(version, type_id, event_type, fields)
+           for version, schemas in SCHEMAS.items()
+           for type_id, (event_type, fields) in schemas.items()}
+
+# Messages are encoded in the latest version
+ENCODERS = {layout.event_type: layout for (version, _), layout in LAYOUTS.items() if version == VERSION}
+
+
+def encode(message):
+    """ The binary encoding of an event message, or None if its type has no schema or it does not fit it
+
+    The caller then sends it as JSON, as readings with extra properties have to be.
+    """
+    layout = ENCODERS.get(message.get("type"))
+    if layout is None:
+        return None
+    return layout.encode(message)
+
+
+def layout_of(value):
+    """ The layout of a binary message, raises ValueError for a version or type this copy does not know """
+    try:
+        _, version, type_id = HEADER.unpack_from(value)
+    except struct.error as e:
+        raise ValueError(f"Truncated binary event message: {e}")
+    layout = LAYOUTS.get((version, type_id))
+    if layout is None:
+        raise ValueError(f"Unknown binary event message version {version} type {type_id}")
+    return layout
+
+
+def decode(value):
+    """ The event message of a JSON or binary message value, raises ValueError for a malformed one """
+    if value[:1] != MAGIC:
+        return json.loads(value)
+    return layout_of(value).decode(value)
+
+
+def message_type(value):
+    """ The event type of a JSON or binary message value, without decoding a binary one """
+    if value[:1] != MAGIC:
+        return json.loads(value)["type"]
+    return layout_of(value).event_type
@@ -1,18 +1,25 @@
 import connexion
 from connexion import NoContent
+from flask import Response, request
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import text
+from sqlalchemy import text, insert, select, tuple_
+from sqlalchemy.exc import DataError, DisconnectionError, IntegrityError, InterfaceError, OperationalError
+from sqlalchemy.sql.functions import now
 from base import Base
 from power_usage import PowerUsage
 from location import Location
+import export_formats
+from metrics import (RequestMetricsMiddleware, ConsumerLag, KAFKA_PRODUCED, KAFKA_CONSUMED,
+                     DB_COMMIT_SECONDS, DB_QUERY_SECONDS, BATCH_SIZE)
+from connexion.middleware import MiddlewarePosition
 import datetime
 import yaml
 import logging
 import logging.config
 import json
-from pykafka import KafkaClient
-from pykafka.common import OffsetType
+import message_bus
+import wire_format
 from threading import Thread
 import time
 import os
@@ -59,11 +66,9 @@ Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
 
-def publish_startup_event(client):
+def publish_startup_event(bus):
     """Publish a startup message to the 'event_log' topic"""
-    event_log_topic = client.topics[str.encode(app_config['events']['startup_topic'])]
-    
-    event_log_producer = event_log_topic.get_sync_producer()
+    event_log_producer = bus.sync_producer(app_config['events']['startup_topic'])
 
     startup_msg = {
         "type": "storage_startup",
@@ -75,6 +80,7 @@ def publish_startup_event(client):
     }
     
     event_log_producer.produce(json.dumps(startup_msg).encode('utf-8'))
+    KAFKA_PRODUCED.labels(app_config['events']['startup_topic']).inc()
     logger.info("Published startup message to Kafka topic 'event_log'")
 
 
@@ -83,8 +89,6 @@ def report_power_usage_reading(body):
 
     session = DB_SESSION()
 
-    print(body)
-
     power_usage_instance = PowerUsage(body['device_id'],
                                       body['device_type'],
                                       body['timestamp'],
@@ -93,14 +97,13 @@ def report_power_usage_reading(body):
                                       body['power_data']['state_of_charge_%'],
                                       body['power_data']['temperature_C'],
                                       body['trace_id'])
-    
-    print(power_usage_instance)
 
     session.add(power_usage_instance)
 
-    logger.debug(f"Stored event power_usage request with a trace_id of {body['trace_id']}")
+    logger.debug("Stored event power_usage request with a trace_id of %s", body['trace_id'])
 
-    session.commit()
+    with DB_COMMIT_SECONDS.labels("power_usage").time():
+        session.commit()
     session.close()
 
     return NoContent, 201
@@ -120,110 +123,246 @@ def report_location_reading(body):
 
     session.add(location_instance)
 
-    logger.debug(f"Stored event location request with a trace_id of {body['trace_id']}")
+    logger.debug("Stored event location request with a trace_id of %s", body['trace_id'])
 
-    session.commit()
+    with DB_COMMIT_SECONDS.labels("location").time():
+        session.commit()
     session.close()
 
     return NoContent, 201
 
 
-def retrieve_power_usage_readings(start_timestamp, end_timestamp):
-    session = DB_SESSION()
+def retrieve_power_usage_readings(start_timestamp, end_timestamp, limit=None, after_id=0):
+    """ Streams the power usage readings created in a time window """
     logger.info("Retrieving power usage readings from %s to %s", start_timestamp, end_timestamp)
 
+    return stream_readings(PowerUsage, start_timestamp, end_timestamp, limit, after_id)
+
+
+def retrieve_location_readings(start_timestamp, end_timestamp, limit=None, after_id=0):
+    """ Streams the location readings created in a time window """
+    logger.info("Retrieving location readings from %s to %s", start_timestamp, end_timestamp)
+
+    return stream_readings(Location, start_timestamp, end_timestamp, limit, after_id)
+
+
+def stream_readings(model, start_timestamp, end_timestamp, limit, after_id):
+    """ Queries a page of readings ordered by creation time and streams them back in the format the client accepts """
     start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S")
     end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S")
 
-    readings = session.query(PowerUsage).filter(PowerUsage.date_created >= start_timestamp_datetime,
-                                                PowerUsage.date_created < end_timestamp_datetime)
-    
-    results_list = []
+    # Selecting the table rather than the model returns Core rows and skips building ORM objects.
+    # Readings are ordered by (date_created, id) so each page is a range scan of the matching index
+    table = model.__table__
+    query = select(table).where(table.c.date_created >= start_timestamp_datetime,
+                                table.c.date_created < end_timestamp_datetime
+                                ).order_by(table.c.date_created, table.c.id)
+    if limit is not None:
+        query = query.limit(limit)
 
-    for reading in readings:
-        results_list.append(reading.to_dict())
+    mimetype = request.accept_mimetypes.best_match(export_formats.FORMATS, default=export_formats.JSON)
+    streamer = export_formats.STREAMERS[mimetype]
+    chunk_size = app_config['stream_chunk_size']
 
-    session.close()
+    def generate():
+        session = DB_SESSION()
+        try:
+            page_query = query
+            if after_id:
+                # Keyset pagination: the next page starts after the last reading returned, which is
+                # found by its id so that clients only need to pass that back
+                after_date_created = session.execute(
+                    select(table.c.date_created).where(table.c.id == after_id)).scalar()
+                if after_date_created is None:
+                    page_query = query.where(table.c.id > after_id)
+                else:
+                    page_query = query.where(tuple_(table.c.date_created, table.c.id) >
+                                             tuple_(after_date_created, after_id))
+
+            # yield_per keeps only one buffer of rows in memory and uses a server side cursor on MySQL
+            with DB_QUERY_SECONDS.labels(f"{model.__tablename__}_readings").time():
+                readings = session.execute(page_query.execution_options(yield_per=chunk_size))
+            yield from streamer(readings, model, chunk_size)
+        finally:
+            session.close()
+
+        logger.info("Streamed %s readings from %s to %s as %s", model.__tablename__, start_timestamp, end_timestamp, mimetype)
+
+    return Response(generate(), status=200, mimetype=mimetype)
+
+
+def power_usage_row(payload):
+    """ Maps a power usage payload to a row of the power_usage table """
+    return {
+        "device_id": payload['device_id'],
+        "device_type": payload['device_type'],
+        "timestamp": payload['timestamp'],
+        "energy_out_Wh": payload['power_data']['energy_out_Wh'],
+        "power_W": payload['power_data']['power_W'],
+        "state_of_charge": payload['power_data']['state_of_charge_%'],
+        "temperature_C": payload['power_data']['temperature_C'],
+        "trace_id": payload['trace_id']
+    }
 
-    logger.info("Query for power usage readings after %s returns %d results", start_timestamp, len(results_list))
 
-    return results_list, 200
+def location_row(payload):
+    """ Maps a location payload to a row of the location table """
+    return {
+        "device_id": payload['device_id'],
+        "device_type": payload['device_type'],
+        "timestamp": payload['timestamp'],
+        "gps_latitude": payload['location_data']['gps_latitude'],
+        "gps_longitude": payload['location_data']['gps_longitude'],
+        "trace_id": payload['trace_id']
+    }
 
 
-def retrieve_location_readings(start_timestamp, end_timestamp):
-    try:
-        session = DB_SESSION()
-        logger.info("Retrieving location readings from %s to %s", start_timestamp, end_timestamp)
+# Rows the database rejects, a batch failing with one is stored again row by row to find it
+REJECTED_ROW_ERRORS = (IntegrityError, DataError)
+# Errors of the connection to the database, a batch is retried as it is on these
+CONNECTION_ERRORS = (OperationalError, InterfaceError, DisconnectionError)
+
+ROW_BUILDERS = {
+    "power_usage": (PowerUsage, power_usage_row),
+    "location": (Location, location_row)
+}
+
+
+def message_rows(messages):
+    """ Maps event messages to (model, row) pairs, skipping the messages that do not have the fields of their type """
+    rows = []
+    for msg in messages:
+        try:
+            model, build_row = ROW_BUILDERS[msg["type"]]
+            rows.append((model, build_row(msg["payload"])))
+        except (KeyError, TypeError) as e:
+            logger.error("Skipping event message that cannot be stored, missing %s: %s", e, msg)
+    return rows
+
+
+def store_message_batch(rows):
+    """ Stores a batch of (model, row) pairs with one multi-row insert per event type in a single transaction """
+    power_usage_rows = [row for model, row in rows if model is PowerUsage]
+    location_rows = [row for model, row in rows if model is Location]
+
+    with DB_COMMIT_SECONDS.labels("events_batch").time(), DB_ENGINE.begin() as connection:
+        if power_usage_rows:
+            connection.execute(insert(PowerUsage).values(date_created=now()), power_usage_rows)
+        if location_rows:
+            connection.execute(insert(Location).values(date_created=now()), location_rows)
+
+    logger.debug("Stored %d power_usage and %d location events", len(power_usage_rows), len(location_rows))
+
+
+def store_rows(rows):
+    """ Stores rows in one transaction, retrying while the database cannot be reached
+
+    When the database rejects the batch, its rows are stored one per transaction so only the
+    rejected ones are skipped. Raises the connection error after max_retries attempts, so the
+    consumer stops before committing offsets past rows that were not stored.
+    """
+    for attempt in range(app_config['max_retries']):
+        try:
+            store_message_batch(rows)
+            return
+        except REJECTED_ROW_ERRORS as e:
+            if len(rows) == 1:
+                logger.error("Skipping row rejected by the database: %s, error: %s", rows[0][1], e)
+                return
+            logger.warning("Batch of %d rows rejected by the database, storing them one by one: %s", len(rows), e)
+            for row in rows:
+                store_rows([row])
+            return
+        except CONNECTION_ERRORS as e:
+            logger.error("Failed to store batch of %d rows on attempt #%s, error: %s", len(rows), attempt + 1, e)
+            error = e
+            time.sleep(app_config['sleep_time'])
 
-        start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S")
-        end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S")
+    logger.error("Could not store batch of %d rows after %s attempts, stopping before its offsets are committed",
+                 len(rows), app_config['max_retries'])
+    raise error
 
-        readings = session.query(Location).filter(Location.date_created >= start_timestamp_datetime, 
-                                                Location.date_created < end_timestamp_datetime)
-        results_list = []
 
-        for reading in readings:
-            print(reading.to_dict())
-            results_list.append(reading.to_dict())
+def consume_batch(consumer, batch_size, batch_timeout_sec):
+    """ Waits for a message, then gathers up to batch_size messages or until batch_timeout_sec has passed """
+    messages = []
+    deadline = None
 
-        session.close()
+    while len(messages) < batch_size:
+        if deadline is None:
+            # Blocks for up to consumer_timeout_ms while the topic is idle
+            msg = consumer.consume(block=True)
+        else:
+            msg = consumer.consume(block=False)
 
-        logger.info("Query for location readings after %s returns %d results", start_timestamp, len(results_list))
+        if msg is not None:
+            try:
+                messages.append(wire_format.decode(msg.value))
+            except ValueError as e:
+                logger.error("Skipping event message that cannot be decoded at offset %d of partition %d: %s",
+                             msg.offset, msg.partition_id, e)
+            if deadline is None:
+                deadline = time.time() + batch_timeout_sec
+        elif deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 0.01))
 
-        return results_list, 200
-    except Exception as e:
-        print(e)
+    return messages
 
 
-def process_messages():
-    # Create a consume on a consumer group, that only reads new messages
-    # (uncommitted messages) when the service re-starts (i.e., it doesn't read all the old messages from the history in the message queue).
-    consumer = topic.get_simple_consumer(consumer_group=b'event_group', reset_offset_on_start=False, auto_offset_reset=OffsetType.LATEST)
+def process_messages(bus):
+    # Create consumers on a consumer group, that only read new messages
+    # (uncommitted messages) when the service re-starts (i.e., they don't read all the old messages from the history in the message queue).
+    # The group is balanced: each consumer, here or in another replica of storage, stores the readings of its
+    # share of the partitions, and the receiver keys them by device so a device's readings stay in order
+    consumers = [bus.consumer(app_config['events']['topic'], group="event_group", offset_reset="latest",
+                              timeout_ms=app_config['consumer']['batch_timeout_ms'], balanced=True)
+                 for _ in range(app_config['consumer']['workers'])]
+    lag = ConsumerLag(consumers, app_config['metrics']['lag_interval_sec'])
 
-    # This is blocking - it will wait for a new message
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s" % msg)
-        
-        payload = msg["payload"]
+    message_bus.run_consumers(consumers, lambda consumer: store_messages(consumer, lag))
 
-        if msg["type"] == "power_usage": # Change this to your event type
-            # Store the event1 (i.e., the payload) to the DB
-            report_power_usage_reading(payload)
-        elif msg["type"] == "location": # Change this to your event type
-            # Store the event2 (i.e., the payload) to the DB
-            report_location_reading(payload)
-            
-        # Commit the new message as being read
-        consumer.commit_offsets()
+
+def store_messages(consumer, lag):
+    """ Stores the messages of a consumer a batch per transaction, committing the offsets once each batch is stored """
+    batch_size = app_config['consumer']['batch_size']
+    batch_timeout_sec = app_config['consumer']['batch_timeout_ms'] / 1000
+
+    while True:
+        messages = consume_batch(consumer, batch_size, batch_timeout_sec)
+        KAFKA_CONSUMED.labels(app_config['events']['topic']).inc(len(messages))
+        BATCH_SIZE.labels("consumed").observe(len(messages))
+        lag.update()
+
+        # The offsets are only committed once the batch is stored, store_rows raises otherwise
+        rows = message_rows(messages)
+        if rows:
+            store_rows(rows)
+
+        logger.info("Stored batch of %d messages", len(messages))
+
+        # Commit the batch as being read
+        consumer.commit()
 
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yaml", base_path="/storage", strict_validation=True, validate_responses=True)
+# Response validation buffers the whole body, which would undo the streaming of the GET endpoints
+app.add_api("openapi.yaml", base_path="/storage", strict_validation=True, validate_responses=False)
+app.add_middleware(RequestMetricsMiddleware, position=MiddlewarePosition.BEFORE_SWAGGER)
 
-if __name__ == "__main__":
-    """ Process event messages """
-    hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
 
-    retry_count = 0
+def run_background():
+    """ Connects to the message bus and stores event messages, runs once per deployment however many HTTP workers serve the API """
+    bus = message_bus.connect(app_config['events'], app_config['max_retries'], app_config['sleep_time'])
+    publish_startup_event(bus)
+    process_messages(bus)
 
-    while (retry_count < app_config['max_retries']):
-        logger.info("Attempting to connect to Kafka. Attempt #: %s", retry_count + 1)
-        try:
-            client = KafkaClient(hosts=hostname)
-            topic = client.topics[str.encode(app_config["events"]["topic"])]
-            logger.info("Successfully connected to Kafka on attempt #: %s", retry_count + 1)
-            publish_startup_event(client)
-            break
-        except Exception as e:
-            logger.error("Failed to connect to Kafka on attempt #:%s, error: %s", retry_count + 1, e)
-            time.sleep(app_config['sleep_time'])
-            retry_count += 1
-    else:
-        logger.error("Exceeded maximum number of retries (%s) for Kafka connection", app_config['max_retries'])
 
-    t1 = Thread(target=process_messages)
+if __name__ == "__main__":
+    """ Development server, the consumer and the API share one process """
+    t1 = Thread(target=run_background)
     t1.setDaemon(True)
     t1.start()
-    app.run(host='0.0.0.0', port=8090)
+    app.run(host='0.0.0.0', port=app_config['server']['port'])
@@ -0,0 +1,39 @@
+import os
+import shutil
+import sys
+
+import pytest
+import sqlalchemy
+import yaml
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """ app.py imported with the memory bus, a SQLite database instead of MySQL and its files in a temporary directory """
+    directory = tmp_path_factory.mktemp("storage")
+    for name in ["app_conf.yml", "log_conf.yml", "openapi.yaml"]:
+        shutil.copy(os.path.join(SERVICE_DIR, name), directory)
+
+    with open(directory / "app_conf.yml", 'r') as f:
+        app_config = yaml.safe_load(f.read())
+    app_config["events"]["backend"] = "memory"
+    app_config["sleep_time"] = 0
+    with open(directory / "app_conf.yml", 'w') as f:
+        yaml.safe_dump(app_config, f)
+
+    create_engine = sqlalchemy.create_engine
+    database_url = f"sqlite:///{directory / 'readings.sqlite'}"
+    sqlalchemy.create_engine = lambda url, **kwargs: create_engine(database_url)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        import app
+        sqlalchemy.create_engine = create_engine
+        app.Base.metadata.create_all(app.DB_ENGINE)
+        yield app
+    finally:
+        sqlalchemy.create_engine = create_engine
+        os.chdir(cwd)
+        sys.modules.pop("app", None)
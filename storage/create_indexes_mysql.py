@@ -0,0 +1,22 @@
+import mysql.connector
+
+# Adds the time range indexes to tables that were created before they were part of create_tables_mysql.py
+db_conn = mysql.connector.connect(
+    host="ec2-52-40-150-21.us-west-2.compute.amazonaws.com", 
+    user="", 
+    password="", 
+    database="events")
+
+c = db_conn.cursor()
+c.execute('''
+          CREATE INDEX ix_power_usage_date_created_id
+          ON power_usage (`date_created`, `id`)
+          ''')
+
+c.execute('''
+          CREATE INDEX ix_location_date_created_id
+          ON location (`date_created`, `id`)
+          ''')
+
+db_conn.commit()
+db_conn.close()
@@ -29,5 +29,15 @@ c.execute('''
            `trace_id` VARCHAR(250) NOT NULL)
           ''')
 
+c.execute('''
+          CREATE INDEX ix_power_usage_date_created_id
+          ON power_usage (`date_created`, `id`)
+          ''')
+
+c.execute('''
+          CREATE INDEX ix_location_date_created_id
+          ON location (`date_created`, `id`)
+          ''')
+
 conn.commit()
 conn.close()
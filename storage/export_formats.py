@@ -0,0 +1,101 @@
+import io
+import json
+import numpy as np
+from connexion.jsonifier import JSONEncoder
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+NUMPY_RECORDS = "application/x-numpy-records"
+
+# Formats a client can ask for in its Accept header, the first one is the default
+FORMATS = [JSON, NDJSON, NUMPY_RECORDS]
+
+# Record layout of each table for the NumPy format, "S" columns are sized per chunk
+RECORD_FIELDS = {
+    "power_usage": [
+        ("id", "i8"),
+        ("device_id", "S"),
+        ("device_type", "S"),
+        ("timestamp", "S"),
+        ("date_created", "M8[s]"),
+        ("energy_out_Wh", "f8"),
+        ("power_W", "f8"),
+        ("state_of_charge", "i4"),
+        ("temperature_C", "f8"),
+        ("trace_id", "S")
+    ],
+    "location": [
+        ("id", "i8"),
+        ("device_id", "S"),
+        ("device_type", "S"),
+        ("timestamp", "S"),
+        ("date_created", "M8[s]"),
+        ("gps_latitude", "f8"),
+        ("gps_longitude", "f8"),
+        ("trace_id", "S")
+    ]
+}
+
+
+def chunked(rows, chunk_size):
+    """ Groups an iterable of rows into lists of at most chunk_size rows """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def json_chunks(rows, model, chunk_size):
+    """ Streams rows as one JSON array, in the same shape as the model's to_dict() """
+    yield "["
+    first = True
+    for chunk in chunked(rows, chunk_size):
+        # to_dict() only reads attributes, so it works on Core rows without building ORM objects
+        body = ",".join(json.dumps(model.to_dict(row), cls=JSONEncoder) for row in chunk)
+        yield body if first else "," + body
+        first = False
+    yield "]"
+
+
+def ndjson_chunks(rows, model, chunk_size):
+    """ Streams rows as newline delimited JSON, one reading per line """
+    for chunk in chunked(rows, chunk_size):
+        yield "".join(json.dumps(model.to_dict(row), cls=JSONEncoder) + "\n" for row in chunk)
+
+
+def numpy_record_chunks(rows, model, chunk_size):
+    """ Streams rows as a sequence of .npy structured arrays of up to chunk_size records each
+
+    Clients read it back by calling numpy.load() on the body until it is exhausted.
+    """
+    fields = RECORD_FIELDS[model.__tablename__]
+
+    for chunk in chunked(rows, chunk_size):
+        columns = {}
+        dtype = []
+        for name, kind in fields:
+            values = [getattr(row, name) for row in chunk]
+            if kind == "S":
+                values = [value.encode('utf-8') for value in values]
+                kind = "S%d" % max(1, max(len(value) for value in values))
+            columns[name] = values
+            dtype.append((name, kind))
+
+        records = np.empty(len(chunk), dtype=dtype)
+        for name, _ in fields:
+            records[name] = columns[name]
+
+        buffer = io.BytesIO()
+        np.lib.format.write_array(buffer, records, allow_pickle=False)
+        yield buffer.getvalue()
+
+
+STREAMERS = {
+    JSON: json_chunks,
+    NDJSON: ndjson_chunks,
+    NUMPY_RECORDS: numpy_record_chunks
+}
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Double
+from sqlalchemy import Index, Column, Integer, String, DateTime, Double
 from sqlalchemy.sql.functions import now
 from base import Base
 import datetime
@@ -8,6 +8,9 @@ class Location(Base):
     """ Location """
 
     __tablename__ = "location"
+    __table_args__ = (
+        Index("ix_location_date_created_id", "date_created", "id"),
+    )
 
     id = Column(Integer, primary_key=True)
     device_id = Column(String(250), nullable=False)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Numeric
+from sqlalchemy import Index, Column, Integer, String, DateTime, Numeric
 from sqlalchemy.sql.functions import now
 from base import Base
 import datetime
@@ -8,6 +8,9 @@ class PowerUsage(Base):
     """ Power Usage """
 
     __tablename__ = "power_usage"
+    __table_args__ = (
+        Index("ix_power_usage_date_created_id", "date_created", "id"),
+    )
 
     id = Column(Integer, primary_key=True)
     device_id = Column(String(250), nullable=False)
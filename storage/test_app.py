@@ -0,0 +1,151 @@
+import datetime
+import json
+
+import pytest
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import OperationalError
+
+
+def power_usage_row(number, date_created):
+    """ A row of the power_usage table created at date_created """
+    return {"device_id": f"device-{number}", "device_type": "10k", "timestamp": "2024-01-01T00:00:00.000Z",
+            "date_created": date_created, "energy_out_Wh": 10, "power_W": 1000, "state_of_charge": 50,
+            "temperature_C": 20, "trace_id": f"trace-{number}"}
+
+
+def test_paging_walks_window_without_gaps_or_duplicates(app_module):
+    table = app_module.PowerUsage.__table__
+    start = datetime.datetime(2024, 1, 1)
+    # Batches share their date_created, and the ids of a window do not follow date_created order
+    dates = [start + datetime.timedelta(seconds=second) for second in [2, 0, 0, 1, 2, 0, 1, 1, 2, 0, -1, 5]]
+    with app_module.DB_ENGINE.begin() as connection:
+        connection.execute(delete(table))
+        connection.execute(insert(table), [power_usage_row(number, date) for number, date in enumerate(dates)])
+        rows = connection.execute(table.select()).all()
+    expected = [row.id for row in sorted(rows, key=lambda row: (row.date_created, row.id))
+                if start <= row.date_created < start + datetime.timedelta(seconds=5)]
+
+    client = app_module.app.test_client()
+    ids = []
+    after_id = 0
+    while True:
+        response = client.get("/storage/readings/power-usage", params={
+            "start_timestamp": "2024-01-01T00:00:00", "end_timestamp": "2024-01-01T00:00:05",
+            "limit": 3, "after_id": after_id})
+        assert response.status_code == 200
+        page = [reading["id"] for reading in response.json()]
+        if not page:
+            break
+        assert len(page) <= 3
+        ids.extend(page)
+        after_id = page[-1]
+
+    assert len(expected) == 10
+    assert ids == expected
+
+
+def power_usage_event(number):
+    """ A power usage event message as the receiver produces it """
+    return {"type": "power_usage", "datetime": "2024-01-01T00:00:00", "payload": {
+        "device_id": f"device-{number}", "device_type": "10k", "timestamp": "2024-01-01T00:00:00.000Z",
+        "power_data": {"power_W": 1000, "energy_out_Wh": 10, "state_of_charge_%": 50, "temperature_C": 20},
+        "trace_id": f"trace-{number}"}}
+
+
+def stored_trace_ids(app_module):
+    """ The trace ids of the power usage rows in the database, in insert order """
+    table = app_module.PowerUsage.__table__
+    with app_module.DB_ENGINE.connect() as connection:
+        return [row.trace_id for row in connection.execute(select(table.c.trace_id).order_by(table.c.id))]
+
+
+def clear_readings(app_module):
+    """ Deletes every reading, so each test starts from an empty database """
+    with app_module.DB_ENGINE.begin() as connection:
+        connection.execute(delete(app_module.PowerUsage.__table__))
+        connection.execute(delete(app_module.Location.__table__))
+
+
+def consume_new_messages(app_module, topic_name):
+    """ A memory topic of its own and a consumer of the messages produced to it from now on """
+    topic = app_module.message_bus.MEMORY_BUS.topic(topic_name)
+    consumer = app_module.message_bus.MEMORY_BUS.consumer(topic_name, group="storage_test", offset_reset="latest",
+                                                          timeout_ms=50)
+    return topic, consumer
+
+
+class StopConsuming(Exception):
+    """ Raised by a test to leave the endless loop of store_messages """
+
+
+def test_rejected_batch_is_stored_row_by_row(app_module):
+    clear_readings(app_module)
+    rows = app_module.message_rows([power_usage_event(0), power_usage_event(1), power_usage_event(2)])
+    # NOT NULL constraint, so the database rejects the whole multi-row insert
+    rows[1][1]["device_id"] = None
+
+    app_module.store_rows(rows)
+
+    assert stored_trace_ids(app_module) == ["trace-0", "trace-2"]
+
+
+def test_connection_errors_are_retried(app_module, monkeypatch):
+    clear_readings(app_module)
+    store_message_batch = app_module.store_message_batch
+    attempts = []
+
+    def flaky_store_message_batch(rows):
+        attempts.append(len(rows))
+        if len(attempts) < 3:
+            raise OperationalError("INSERT", {}, Exception("database is unavailable"))
+        store_message_batch(rows)
+
+    monkeypatch.setattr(app_module, "store_message_batch", flaky_store_message_batch)
+
+    app_module.store_rows(app_module.message_rows([power_usage_event(0), power_usage_event(1)]))
+
+    assert attempts == [2, 2, 2]
+    assert stored_trace_ids(app_module) == ["trace-0", "trace-1"]
+
+
+def test_offsets_are_not_committed_when_the_batch_is_not_stored(app_module, monkeypatch):
+    def failing_store_message_batch(rows):
+        raise OperationalError("INSERT", {}, Exception("database is unavailable"))
+
+    monkeypatch.setattr(app_module, "store_message_batch", failing_store_message_batch)
+    monkeypatch.setitem(app_module.app_config, "max_retries", 2)
+    topic, consumer = consume_new_messages(app_module, "failing_store")
+    producer = app_module.message_bus.MEMORY_BUS.sync_producer(topic.name)
+    producer.produce(json.dumps(power_usage_event(0)).encode('utf-8'))
+
+    with pytest.raises(OperationalError):
+        app_module.store_messages(consumer, app_module.ConsumerLag([consumer], 10))
+
+    assert "storage_test" not in topic.committed
+
+
+def test_offsets_are_committed_past_bad_messages(app_module, monkeypatch):
+    clear_readings(app_module)
+    topic, consumer = consume_new_messages(app_module, "bad_messages")
+    producer = app_module.message_bus.MEMORY_BUS.sync_producer(topic.name)
+    missing_power_data = power_usage_event(2)
+    del missing_power_data["payload"]["power_data"]
+    for value in [json.dumps(power_usage_event(0)).encode('utf-8'),
+                  b"garbage",
+                  app_module.wire_format.MAGIC + b"\x01",
+                  json.dumps({"type": "unknown", "payload": {}}).encode('utf-8'),
+                  json.dumps(missing_power_data).encode('utf-8'),
+                  app_module.wire_format.encode(power_usage_event(1))]:
+        producer.produce(value)
+
+    def commit_once():
+        consumer.__class__.commit(consumer)
+        raise StopConsuming()
+
+    monkeypatch.setattr(consumer, "commit", commit_once)
+
+    with pytest.raises(StopConsuming):
+        app_module.store_messages(consumer, app_module.ConsumerLag([consumer], 10))
+
+    assert stored_trace_ids(app_module) == ["trace-0", "trace-1"]
+    assert topic.committed["storage_test"] == {0: 5}